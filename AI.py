@@ -5,130 +5,809 @@ AI模块
 =======================
 说明：
     该模块用于与OpenAI的API交互，包括发送请求和处理响应。
+    请求基于 AsyncOpenAI，在 async_runtime 的后台事件循环中执行：
+    ask_async() 是核心实现，submit() 不等待结果，ask() 是等待结果的同步包装。
+    每次请求先经过 rate_limit 中的限流和会话预算检查，429/过载等错误按 RetryPolicy 退避重试。
+    设置了 cache (response_cache.ResponseCache) 时，对话状态完全相同的请求直接使用缓存的回复。
+    历史是一棵分支树：branch() 以 O(1) 分出新分支，checkout() 切换分支，revert()/reask() 丢弃的内容保留为分支。
+    attach_journal() 之后，历史的每次修改都写入会话日志；export_state()/import_state()/apply() 用于快照和恢复。
+    add_files() 加入文件内容时按 file_messages 的规则去重，同一文件的旧副本换成 diff 或删除。
     工作状态: Done
 """
-from openai import OpenAI
+import inspect
+import re
+import threading
+import time
+from concurrent.futures import Future
 from functools import wraps
+from typing import Callable
+
+import async_runtime
+import startup_profile
+from rate_limit import Budget, RetryPolicy, limiter_for, retry_after
+from response_cache import ResponseCache, cache_key
+from conversation import Branch, ConversationStore
+from file_messages import FILE_PREFIX, PayloadStore, digest, file_message, parse, superseded_message
+from token_counter import estimate_tokens
+
+
+def _error_message(e: Exception) -> str:
+    error = str(e)
+    if "429" in error or "overload" in error.lower():
+        return "服务器暂时过载，请稍后再试。"
+    elif "401" in error or "auth" in error.lower():
+        return "API密钥错误，请检查配置。"
+    elif "quota" in error.lower() or "balance" in error.lower():
+        return "API额度已用完，请充值或联系管理员。"
+    elif "content_filter" in error.lower():
+        return "内容被过滤，请尝试其他问题。"
+    else:
+        return f"处理请求时出错: {error}"
+
+
+class ErrorReply(str):
+    """
+    请求失败时代替回复返回的错误提示；error 是这个请求自己的异常，不会被同时进行的其他请求覆盖
+    """
+    error: Exception
+
+    def __new__(cls, error: Exception) -> "ErrorReply":
+        reply = super().__new__(cls, _error_message(error))
+        reply.error = error
+        return reply
+
+
+def request_error(reply: str) -> Exception | None:
+    """
+    ask / submit 返回的回复对应的异常，请求成功时为 None
+    """
+    return reply.error if isinstance(reply, ErrorReply) else None
 
 
 def handle_api_error(func: callable) -> callable:
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(self, *args, **kwargs):
+            try:
+                return await func(self, *args, **kwargs)
+            except Exception as e:
+                self.last_error = e
+                return ErrorReply(e)
+        return async_wrapper
+
     @wraps(func)
     def wrapper(self, *args, **kwargs):
         try:
             return func(self, *args, **kwargs)
         except Exception as e:
-            error = str(e)
-            if "429" in error or "overload" in error.lower():
-                return "服务器暂时过载，请稍后再试。"
-            elif "401" in error or "auth" in error.lower():
-                return "API密钥错误，请检查配置。"
-            elif "quota" in error.lower() or "balance" in error.lower():
-                return "API额度已用完，请充值或联系管理员。"
-            elif "content_filter" in error.lower():
-                return "内容被过滤，请尝试其他问题。"
-            else:
-                return f"处理请求时出错: {error}"
+            self.last_error = e
+            return ErrorReply(e)
     return wrapper
     
 
+# 各模型的上下文长度 (token)，未列出的模型使用 DEFAULT_CONTEXT_TOKENS
+MODEL_CONTEXT_TOKENS = {
+    "deepseek-ai/DeepSeek-V3": 64_000,
+    "deepseek-ai/DeepSeek-R1": 64_000,
+    "Qwen/Qwen2.5-72B-Instruct": 32_000,
+}
+DEFAULT_CONTEXT_TOKENS = 32_000
+
+SUMMARY_PREFIX = "SUMMARY "
+# 用户消息开头附加的项目上下文块 (完整上下文或变化，见 ProjectContexter)：标题和结尾各由一行 50 个 = 包围
+_CONTEXT_BLOCK = re.compile(r"\s*={50}[ \t]*\n[^\n]*\n={50}[ \t]*\n.*?^={50}[ \t]*(?:\n|$)", re.S | re.M)
+
+
+def _question(content: str) -> str:
+    """
+    去掉用户消息开头的项目上下文块，只留下用户的问题
+    """
+    while match := _CONTEXT_BLOCK.match(content):
+        content = content[match.end():]
+    return content
+
+
 class AI:
     def __init__(self, system_prompt: str, api_key: str, base_url: str,
                  model: str = "deepseek-ai/DeepSeek-V3",
-                 max_tokens: int = 1024, temperature: float = 0.7):
-        self.client = OpenAI(
-            api_key=api_key,
-            base_url=base_url
-        )
+                 max_tokens: int = 1024, temperature: float = 0.7,
+                 token_budget: int | None = None, keep_rounds: int = 2, summary_chars: int = 200,
+                 stream: bool = False, rpm: float | None = None, tpm: float | None = None,
+                 max_retries: int = 5, max_requests: int | None = None, max_total_tokens: int | None = None,
+                 cache: ResponseCache | None = None, file_dedup: str = "diff"):
+        """
+        Args:
+            stream: 是否以流式方式请求，流式时每个文本片段会传给 ask() 的 on_chunk
+            token_budget: 每次请求中历史消息的 token 上限，默认为模型上下文长度减去 max_tokens
+            keep_rounds: 压缩时至少原样保留的最近轮数 (包括正在提问的这一轮)
+            summary_chars: 摘要中每条被压缩的消息保留的字符数
+            rpm, tpm: 该接口每分钟的请求数和 token 数上限，同一 base_url 的所有 AI 实例共用
+            max_retries: 429、过载、5xx 或连接错误时最多重试的次数
+            max_requests, max_total_tokens: 本次会话的请求数和 token 总量预算
+            cache: 回复缓存，None 表示不使用
+            file_dedup: 同一文件再次读入时较早副本的处理方式，"diff" 换成差异 (差异太长时删除)，
+                "replace" 直接删除，"off" 保留
+        """
+        self.api_key = api_key
+        self.base_url = base_url
+        # 导入 openai 需要近一秒，客户端在第一次请求 (或 prepare_client()) 时才创建
+        self._client = None
+        self._client_lock = threading.Lock()
         self.system_prompt = system_prompt
         self.model = model
         self.max_tokens = max_tokens
         self.temperature = temperature
-        self.history = [{"role": "system", "content": self.system_prompt}]
+        self.token_budget = token_budget or MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS) - max_tokens
+        self.keep_rounds = max(1, keep_rounds)
+        self.summary_chars = summary_chars
+        # 当前分支；其 store 是消息列表及其索引 (轮次位置、各角色计数、token 估算)，
+        # archive 是被压缩掉的较早轮次，每一轮是从用户消息开始到下一条用户消息之前的消息列表
+        self.branch = Branch("main", ConversationStore(self.system_prompt, prefixes=(FILE_PREFIX, SUMMARY_PREFIX)), [])
+        self.branches: list[Branch] = [self.branch]
+        # 会话日志 (session_journal.SessionJournal)，None 表示不记录
+        self.journal = None
+        self.compactions = 0
+        self.evicted_files = 0
+        self.stream = stream
+        # 每次请求的耗时: {"stream", "ttft", "total", "chunks", "retries", "waited", "cached"}，
+        # ttft 为首个文本片段到达的时间，waited 为限流和重试退避等待的时间 (秒)，cached 表示回复来自缓存
+        self.timings: list[dict] = []
+        self.retry = RetryPolicy(max_retries)
+        self.limiter = limiter_for(base_url, rpm, tpm)
+        self.budget = Budget(max_requests, max_total_tokens)
+        self.retries = 0
+        self.retry_wait = 0.0
+        self.rate_wait = 0.0
+        # 最近一次请求失败的异常，成功时为 None；只用于显示，多个请求同时进行时会互相覆盖，
+        # 判断某个请求是否失败用 request_error(返回值)
+        self.last_error: Exception | None = None
+        self.cache = cache
+        # 撤回 (rewind / revert) 之后的下一次提问不使用缓存：重新提问是想得到不同的回答
+        self._skip_cache = False
+        self.file_dedup = file_dedup
+        # 文件消息的内容按哈希只保存一份
+        self.payloads = PayloadStore()
+        # 请求在事件循环线程中修改历史，主线程可能同时读入文件
+        self._lock = threading.RLock()
+    
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                with startup_profile.measure("openai client"):
+                    from openai import AsyncOpenAI
+                    # 重试由 RetryPolicy 负责，关闭 SDK 自带的重试以免重复等待
+                    self._client = AsyncOpenAI(
+                        api_key=self.api_key,
+                        base_url=self.base_url,
+                        max_retries=0
+                    )
+            return self._client
+
+    def prepare_client(self) -> None:
+        """
+        提前创建客户端，可以在用户输入第一个问题时于后台线程中调用
+        """
+        self.client
+
+    def ask(self, question: str, on_chunk: Callable[[str], None] | None = None, transient: str = "") -> str:
+        """
+        提问并返回完整回复 (同步，等待 ask_async 完成)
+
+        Args:
+            question: 问题
+            on_chunk: 流式模式下每收到一个文本片段就调用一次，用于实时显示 (在事件循环线程中调用)
+            transient: 只随这一次请求放在问题前面发送、不写入历史的内容 (例如自动检索的代码片段)
+        """
+        return async_runtime.run(self.ask_async(question, on_chunk, transient))
+    
+    def submit(self, question: str, on_chunk: Callable[[str], None] | None = None, transient: str = "") -> Future:
+        """
+        在后台提问，立即返回 Future，其结果为完整回复
+        """
+        return async_runtime.submit(self.ask_async(question, on_chunk, transient))
     
     @handle_api_error
-    def ask(self, question: str) -> str:
-        self._add_history("user", question)
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=self.history,
-            max_tokens=self.max_tokens,
-            temperature=self.temperature
-        )
-        assistant_response = response.choices[0].message.content
-        self._add_history("assistant", assistant_response)
+    async def ask_async(self, question: str, on_chunk: Callable[[str], None] | None = None,
+                        transient: str = "", use_cache: bool = True) -> str:
+        self.last_error = None
+        with self._lock:
+            use_cache = use_cache and not self._skip_cache
+            self._skip_cache = False
+            # 回复写回提问时所在的分支，即使请求期间切换了分支
+            store = self.store
+            user_message = store.append("user", question)
+            self._enforce_budget()
+            # 借出而不是复制：请求期间主线程若修改历史，store 会先复制再改
+            messages = store.borrow()
+            prompt_tokens = store.total_tokens
+        request = messages
+        if transient:
+            # 只在发送的副本中替换最后一条 (即这次的问题)，历史中保存的仍是原来的问题
+            request = messages[:-1] + [{"role": "user", "content": transient + question}]
+            prompt_tokens += estimate_tokens(transient)
+        timing = {"stream": self.stream, "ttft": None, "total": None, "chunks": 0, "retries": 0, "waited": 0.0,
+                  "cached": False}
+        self.timings.append(timing)
+        try:
+            assistant_response = await self._answer(request, prompt_tokens, timing, on_chunk, use_cache)
+        except BaseException:
+            # 请求失败或被取消时撤回这条问题，历史中不留下没有回答的一轮，可以直接重新提问
+            with self._lock:
+                store.release(messages)
+                store.remove(user_message)
+            raise
+        with self._lock:
+            store.release(messages)
+            store.append("assistant", assistant_response)
+        return assistant_response
+    
+    async def _answer(self, messages: list[dict], prompt_tokens: int, timing: dict,
+                      on_chunk: Callable[[str], None] | None, use_cache: bool = True) -> str:
+        cache, key = self.cache, None
+        if cache is not None:
+            key = cache_key(self.model, self.temperature, self.max_tokens, messages)
+            # 不使用缓存时仍然发送请求，新的回复替换缓存中旧的
+            cached = cache.get(key) if use_cache else None
+            if cached is not None:
+                timing.update(ttft=0.0, total=0.0, cached=True)
+                if self.stream and on_chunk is not None:
+                    timing["chunks"] = 1
+                    on_chunk(cached)
+                return cached
+        assistant_response = await self._request(messages, prompt_tokens, timing, on_chunk)
+        if key is not None and assistant_response:
+            cache.put(key, assistant_response, self.model)
         return assistant_response
     
-    def _add_history(self, role: str, content: str):
-        self.history.append({"role": role, "content": content})
+    async def _request(self, messages: list[dict], prompt_tokens: int, timing: dict,
+                       on_chunk: Callable[[str], None] | None) -> str:
+        import asyncio
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            self.budget.check(prompt_tokens)
+            waited = await self.limiter.acquire(prompt_tokens + self.max_tokens)
+            timing["waited"] += waited
+            self.rate_wait += waited
+            self.budget.spend(requests=1)
+            parts = []
+            usage = None
+            try:
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    max_tokens=self.max_tokens,
+                    temperature=self.temperature,
+                    stream=self.stream
+                )
+                if self.stream:
+                    # 流中途出错时异常同样会从这里抛出
+                    async for chunk in response:
+                        usage = getattr(chunk, "usage", None) or usage
+                        if not chunk.choices:
+                            continue
+                        content = chunk.choices[0].delta.content
+                        if not content:
+                            continue
+                        if timing["ttft"] is None:
+                            timing["ttft"] = time.perf_counter() - start
+                        timing["chunks"] += 1
+                        parts.append(content)
+                        if on_chunk is not None:
+                            on_chunk(content)
+                    assistant_response = "".join(parts)
+                else:
+                    assistant_response = response.choices[0].message.content
+                    usage = getattr(response, "usage", None)
+                    timing["ttft"] = time.perf_counter() - start
+                break
+            except Exception as e:
+                # 已经显示出去的片段无法收回，此时不再重试
+                delay = None if parts else self.retry.delay(attempt, e)
+                if delay is None:
+                    raise
+                if retry_after(e) is not None:
+                    self.limiter.block(delay)
+                attempt += 1
+                timing["retries"] += 1
+                timing["waited"] += delay
+                self.retries += 1
+                self.retry_wait += delay
+                await asyncio.sleep(delay)
+        timing["total"] = time.perf_counter() - start
+        used = getattr(usage, "total_tokens", None)
+        self.budget.spend(tokens=used or prompt_tokens + estimate_tokens(assistant_response))
+        return assistant_response
+    
+    @property
+    def store(self) -> ConversationStore:
+        return self.branch.store
+    
+    @property
+    def archive(self) -> list[list[dict]]:
+        return self.branch.archive
+    
+    @archive.setter
+    def archive(self, value: list[list[dict]]):
+        self.branch.archive = value
+    
+    def new_branch(self, name: str | None = None) -> Branch:
+        """
+        从当前状态分出一个新分支 (不切换)；消息列表写时复制，O(1)
+        """
+        with self._lock:
+            if name is None:
+                name = f"branch-{len(self.branches)}"
+            elif self.find_branch(name) is not None:
+                raise ValueError(f"分支已存在: {name}")
+            self._log({"op": "fork", "from": self.branches.index(self.branch), "name": name, "fork_round": len(self)})
+            branch = Branch(name, self.store.fork(), list(self.archive), self.branch, len(self))
+            self.branches.append(branch)
+            self._hook(branch)
+            return branch
+    
+    def find_branch(self, ref: str | int) -> Branch | None:
+        """
+        按序号或名称查找分支
+        """
+        if isinstance(ref, int) or str(ref).isdigit():
+            index = int(ref)
+            return self.branches[index] if 0 <= index < len(self.branches) else None
+        for branch in self.branches:
+            if branch.name == ref:
+                return branch
+        return None
+    
+    def checkout(self, ref: str | int) -> Branch:
+        """
+        切换到指定分支，只是替换当前分支的引用，O(1)
+        """
+        branch = self.find_branch(ref)
+        if branch is None:
+            raise KeyError(f"没有这个分支: {ref}")
+        with self._lock:
+            self._log({"op": "checkout", "b": self.branches.index(branch)})
+            self.branch = branch
+        return branch
+    
+    def _keep_discarded(self):
+        # revert/reask 之前把当前状态保留为一个分支，丢弃的回答之后还能切换回去
+        self.new_branch(f"{self.branch.name}@{len(self)}-{len(self.branches)}")
+    
+    def attach_journal(self, journal):
+        """
+        之后每次修改历史都写入 journal
+        """
+        with self._lock:
+            self.journal = journal
+            for branch in self.branches:
+                self._hook(branch)
+    
+    def _hook(self, branch: Branch):
+        if self.journal is None:
+            return
+        index = self.branches.index(branch)
+        branch.store.journal = lambda record: self.journal.write({**record, "b": index})
+    
+    def _log(self, record: dict):
+        if self.journal is not None:
+            self.journal.write(record)
+    
+    def export_state(self) -> dict:
+        """
+        所有分支的完整状态；同一个消息对象只保存一次，各分支按序号引用
+        """
+        with self._lock:
+            ids, messages = {}, []
+            
+            def ref(msg: dict) -> int:
+                index = ids.get(id(msg))
+                if index is None:
+                    index = ids[id(msg)] = len(messages)
+                    messages.append([msg["role"], msg["content"]])
+                return index
+            
+            branches = [{
+                "name": branch.name,
+                "parent": self.branches.index(branch.parent) if branch.parent is not None else None,
+                "fork_round": branch.fork_round,
+                "messages": [ref(msg) for msg in branch.store],
+                "archive": [[ref(msg) for msg in round_msgs] for round_msgs in branch.archive],
+            } for branch in self.branches]
+            return {
+                "messages": messages,
+                "branches": branches,
+                "current": self.branches.index(self.branch),
+                "compactions": self.compactions,
+                "evicted_files": self.evicted_files,
+            }
+    
+    def import_state(self, state: dict):
+        """
+        用 export_state() 的结果替换全部历史
+        """
+        messages = [{"role": role, "content": content} for role, content in state["messages"]]
+        tokens = [estimate_tokens(content) for _, content in state["messages"]]
+        prefixes = self.store.prefixes
+        # 内容完全相同的分支 (刚分出还没修改过) 共用同一个 store 的写时复制副本
+        stores = {}
+        branches = []
+        for data in state["branches"]:
+            key = tuple(data["messages"])
+            if key in stores:
+                store = stores[key].fork()
+            else:
+                store = stores[key] = ConversationStore.from_messages(
+                    [messages[i] for i in key], prefixes, [tokens[i] for i in key])
+            branches.append(Branch(data["name"], store,
+                                   [[messages[i] for i in round_msgs] for round_msgs in data["archive"]],
+                                   None, data["fork_round"]))
+        for branch, data in zip(branches, state["branches"]):
+            if data["parent"] is not None:
+                branch.parent = branches[data["parent"]]
+        with self._lock:
+            self.branches = branches
+            self.branch = branches[state["current"]]
+            self.compactions = state["compactions"]
+            self.evicted_files = state["evicted_files"]
+            for branch in branches:
+                self._hook(branch)
+    
+    def apply(self, record: dict):
+        """
+        重放一条会话日志记录
+        """
+        with self._lock:
+            op = record["op"]
+            if op == "fork":
+                parent = self.branches[record["from"]]
+                branch = Branch(record["name"], parent.store.fork(), list(parent.archive), parent, record["fork_round"])
+                self.branches.append(branch)
+                self._hook(branch)
+            elif op == "checkout":
+                self.branch = self.branches[record["b"]]
+            elif op == "archive_push":
+                branch = self.branches[record["b"]]
+                branch.archive.append(branch.store.messages[record["start"]:record["end"]])
+            elif op == "counters":
+                self.compactions = record["compactions"]
+                self.evicted_files = record["evicted_files"]
+            elif op == "archive_truncate":
+                branch = self.branches[record["b"]]
+                branch.archive = branch.archive[:record["n"]]
+            else:
+                self.branches[record["b"]].store.apply(record)
+    
+    @property
+    def history(self) -> list[dict]:
+        """
+        当前发给 OpenAI 的消息列表 (只读，修改请通过 store)
+        """
+        return self.store.messages
+    
+    def _add_history(self, role: str, content: str) -> dict:
+        with self._lock:
+            return self.store.append(role, content)
+    
+    def add_files(self, files: list[tuple[str, str]]) -> dict:
+        """
+        把文件内容作为 FILE 消息加入历史，同名文件的较早完整副本按 file_dedup 处理
+
+        Args:
+            files: (文件名, 内容) 列表，同名时以最后一个为准
+
+        Returns:
+            各文件的处理结果 {文件名: "added" | "updated" | "unchanged"}，以及 "superseded" (被换成 diff 的副本数)、
+            "dropped" (被删除的副本数)、"saved_tokens" (因此减少的 token 数)
+        """
+        latest = dict(files)
+        with self._lock:
+            store = self.store
+            copies: dict[str, list[int]] = {}
+            if store.count(FILE_PREFIX) and self.file_dedup != "off":
+                for i in range(self._live_start(), len(store)):
+                    message = store[i]
+                    parsed = parse(message["content"]) if message["role"] == "system" else None
+                    if parsed is not None and parsed[1] == "full" and parsed[0] in latest:
+                        copies.setdefault(parsed[0], []).append(i)
+            
+            result = {"superseded": 0, "dropped": 0, "saved_tokens": 0}
+            drop, appends = [], []
+            for name, text in latest.items():
+                content = self.payloads.intern(file_message(name, text))
+                indices = copies.get(name, [])
+                if indices and store[indices[-1]]["content"] == content:
+                    result[name] = "unchanged"
+                    indices = indices[:-1]
+                else:
+                    result[name] = "updated" if indices else "added"
+                    appends.append(content)
+                for i in indices:
+                    tokens = store.tokens(i)
+                    diff = superseded_message(name, store[i]["content"], content) if self.file_dedup == "diff" else None
+                    if diff is None:
+                        drop.append(i)
+                        result["dropped"] += 1
+                        result["saved_tokens"] += tokens
+                    else:
+                        store.replace(i, "system", diff)
+                        result["superseded"] += 1
+                        result["saved_tokens"] += tokens - store.tokens(i)
+            store.delete(drop)
+            for content in appends:
+                store.append("system", content)
+            if len(self.payloads) > 2 * store.count(FILE_PREFIX) + 64:
+                self.payloads.prune({message["content"] for branch in self.branches for message in branch.store
+                                     if message["content"].startswith(FILE_PREFIX)})
+        return result
+    
+    def file_stats(self) -> list[dict]:
+        """
+        当前历史中的文件消息: 文件名、类型 (full/diff)、哈希、字节数和 token 估算
+        """
+        with self._lock:
+            stats = []
+            if not self.store.count(FILE_PREFIX):
+                return stats
+            for i, message in enumerate(self.store):
+                parsed = parse(message["content"]) if message["role"] == "system" else None
+                if parsed is None:
+                    continue
+                # diff 的版本写成 "旧->新"
+                version = ("->".join(re.findall(r"@(\w+)", parsed[2].partition("\n")[0])) if parsed[1] == "diff"
+                           else digest(message["content"]))
+                stats.append({"name": parsed[0], "kind": parsed[1], "digest": version,
+                              "bytes": len(parsed[2].encode("utf-8")), "tokens": self.store.tokens(i), "index": i})
+            return stats
     
     def _clear_history_withstartswith(self, startswith: str):
-        self.history = [msg for msg in self.history if not msg["content"].startswith(startswith)]
+        with self._lock:
+            if startswith in self.store.prefix_counts:
+                self.store.remove_prefixed(startswith)
+            else:
+                self.store.delete([i for i, msg in enumerate(self.store) if msg["content"].startswith(startswith)])
     
     def clear_history(self):
-        self.history = [{"role": "system", "content": self.system_prompt}]
+        with self._lock:
+            self.store.reset(self.system_prompt)
+            self._log({"op": "archive_truncate", "b": self.branches.index(self.branch), "n": 0})
+            self.archive = []
     
     def system(self, content: str):
-        self.history[0] = {"role": "system", "content": content}
-        self.system_prompt = content
+        with self._lock:
+            self.store.replace(0, "system", content)
+            self.system_prompt = content
     
-    def revert(self, rounds: int = 1):
-        if rounds <= 0 or len(self.history) <= 1:
+    def history_tokens(self) -> int:
+        return self.store.total_tokens
+    
+    def _truncate(self, index: int):
+        self.store.truncate(index)
+    
+    def _live_start(self) -> int:
+        """
+        history 中第一条非固定消息的位置 (跳过系统提示词和摘要)
+        """
+        store = self.store
+        if len(store) > 1 and store[1]["role"] == "system" and store[1]["content"].startswith(SUMMARY_PREFIX):
+            return 2
+        return 1
+    
+    def _enforce_budget(self):
+        """
+        历史超出 token_budget 时，先删除较早的 FILE 消息，再把最早的若干轮压缩进摘要
+        """
+        store = self.store
+        total = store.total_tokens
+        if total <= self.token_budget:
+            return
+        
+        turns = store.turns
+        protected = turns[-1] if turns else len(store)
+        drop = []
+        if store.count(FILE_PREFIX):
+            for i in range(self._live_start(), protected):
+                if total <= self.token_budget:
+                    break
+                msg = store[i]
+                if msg["role"] == "system" and msg["content"].startswith(FILE_PREFIX):
+                    drop.append(i)
+                    total -= store.tokens(i)
+                    self.evicted_files += 1
+        store.delete(drop)
+        if total <= self.token_budget:
+            self._log_counters()
             return
         
-        keep_count = max(1, len(self.history) - rounds * 2)
-        self.history = self.history[:keep_count]
+        # 即使没有摘要也仍然超出预算的轮次肯定要移入 archive；逐轮移入并重写摘要再检查是平方级的，
+        # 所以先算出这些轮数，再二分查找包括重写后的摘要在内不超出预算的最少轮数，最后一次移入
+        turns = store.turns
+        most = max(0, len(turns) - self.keep_rounds)
+        fewest, removed, previous = 0, 0, 1
+        while fewest < most:
+            end = turns[fewest + 1]
+            removed += sum(store.tokens(i) for i in range(previous, end))
+            previous = end
+            if store.total_tokens - removed <= self.token_budget:
+                break
+            fewest += 1
+        if fewest < most and not self._fits_after(turns, most):
+            fewest = most
+        while fewest < most:
+            middle = (fewest + most) // 2
+            if self._fits_after(turns, middle):
+                most = middle
+            else:
+                fewest = middle + 1
+        if fewest:
+            for i in range(fewest):
+                self._log({"op": "archive_push", "b": self.branches.index(self.branch),
+                           "start": turns[i], "end": turns[i + 1]})
+                self.archive.append(store.messages[turns[i]:turns[i + 1]])
+            # 第一轮之前的零散消息 (例如首次提问前读入的文件) 和旧的摘要随这些轮次一起丢弃，摘要随后重写
+            store.splice(1, turns[fewest])
+            self._write_summary()
+            self.compactions += 1
+        self._log_counters()
     
-    def reask(self, round_index: int = -1) -> str:
-        if len(self.history) <= 1:
-            return "没有历史对话可以重新提问"
+    def _fits_after(self, turns: list[int], rounds: int) -> bool:
+        """
+        再把最早的 rounds 轮移入 archive 并重写摘要后，历史是否不超出预算 (不修改历史)
+        """
+        store = self.store
+        if rounds:
+            removed = sum(store.tokens(i) for i in range(1, turns[rounds]))
+            archive = self.archive + [store.messages[turns[i]:turns[i + 1]] for i in range(rounds)]
+        else:
+            removed = store.tokens(1) if self._live_start() == 2 else 0
+            archive = self.archive
+        summary = self._summary(archive)
+        return store.total_tokens - removed + estimate_tokens(summary or "") <= self.token_budget
+
+    def _log_counters(self):
+        self._log({"op": "counters", "compactions": self.compactions, "evicted_files": self.evicted_files})
+    
+    def _write_summary(self):
+        """
+        根据 archive 重新生成摘要消息，放在系统提示词之后
+        """
+        if self._live_start() == 2:
+            self.store.delete([1])
+        content = self._summary(self.archive)
+        if content is not None:
+            self.store.insert(1, "system", content)
+
+    def _summary(self, archive: list[list[dict]]) -> str | None:
+        if not archive:
+            return None
         
-        user_messages = []
-        for i, msg in enumerate(self.history):
-            if msg["role"] == "user":
-                user_messages.append((i, msg["content"]))
+        def _short(text: str) -> str:
+            text = " ".join(text.split())
+            return text if len(text) <= self.summary_chars else text[:self.summary_chars] + "..."
         
-        if not user_messages:
-            return "没有找到用户消息"
+        lines = []
+        for i, round_msgs in enumerate(archive):
+            for msg in round_msgs:
+                if msg["role"] == "user":
+                    lines.append(f"[{i}] 用户: {_short(_question(msg['content']))}")
+                elif msg["role"] == "assistant":
+                    lines.append(f"[{i}] AI: {_short(msg['content'])}")
+        # 摘要本身最多占预算的四分之一，超出时省略最早的内容
+        limit = self.token_budget // 4
+        # 二分查找最少需要省略的行数 (逐行删除再估算是平方级的)
+        omitted, most = 0, max(0, len(lines) - 1)
+        while omitted < most:
+            middle = (omitted + most) // 2
+            if estimate_tokens("\n".join(lines[middle:])) > limit:
+                omitted = middle + 1
+            else:
+                most = middle
+        lines = lines[omitted:]
+        header = SUMMARY_PREFIX + "以下是较早对话的摘要，原文已被压缩:"
+        if omitted:
+            header += f"\n(更早的 {omitted} 条消息已省略)"
+        return header + "\n" + "\n".join(lines)
+    
+    def _restore(self, round_index: int):
+        """
+        把 archive 中从 round_index 开始的轮次放回 history
+        """
+        if round_index >= len(self.archive):
+            return
+        restored = [msg for round_msgs in self.archive[round_index:] for msg in round_msgs]
+        self._log({"op": "archive_truncate", "b": self.branches.index(self.branch), "n": round_index})
+        self.archive = self.archive[:round_index]
+        self.store.splice(1, self._live_start(), restored)
+        self._write_summary()
+    
+    def revert(self, rounds: int = 1):
+        if rounds <= 0 or (len(self.store) <= 1 and not self.archive):
+            return
         
-        if round_index < 0:
-            round_index = len(user_messages) + round_index
+        with self._lock:
+            total_rounds = len(self.archive) + len(self.store.turns)
+            if not total_rounds:
+                return
+            self._keep_discarded()
+            self._skip_cache = True
+            target = max(0, total_rounds - rounds)
+            self._restore(target)
+            turns = self.store.turns
+            live_index = target - len(self.archive)
+            if live_index < len(turns):
+                self._truncate(turns[live_index])
+    
+    def rewind(self, round_index: int = -1) -> str:
+        """
+        撤回第 round_index 轮及之后的对话 (撤回前的状态保留为分支)，返回该轮的问题
+
+        Raises:
+            IndexError: 没有可撤回的轮次或索引超出范围
+        """
+        if len(self.store) <= 1 and not self.archive:
+            raise IndexError("没有历史对话可以重新提问")
         
-        if round_index < 0 or round_index >= len(user_messages):
-            return f"轮次索引超出范围: 0-{len(user_messages)-1}"
+        total_rounds = len(self.archive) + len(self.store.turns)
+        if not total_rounds:
+            raise IndexError("没有找到用户消息")
         
-        msg_index, question = user_messages[round_index]
+        if round_index < 0:
+            round_index = total_rounds + round_index
         
-        self.history = self.history[:msg_index]
+        if round_index < 0 or round_index >= total_rounds:
+            raise IndexError(f"轮次索引超出范围: 0-{total_rounds-1}")
         
+        with self._lock:
+            self._keep_discarded()
+            self._skip_cache = True
+            self._restore(round_index)
+            msg_index = self.store.turns[round_index - len(self.archive)]
+            question = self.store[msg_index]["content"]
+            self._truncate(msg_index)
+        return question
+    
+    def reask(self, round_index: int = -1) -> str:
+        try:
+            question = self.rewind(round_index)
+        except IndexError as e:
+            return str(e)
         return self.ask(question)
     
     def get_conversation_stats(self):
-        user_count = sum(1 for msg in self.history if msg["role"] == "user")
-        assistant_count = sum(1 for msg in self.history if msg["role"] == "assistant")
-        system_count = sum(1 for msg in self.history if msg["role"] == "system")
+        counts = self.store.counts
+        user_count = counts["user"]
+        assistant_count = counts["assistant"]
         
         return {
-            "total_messages": len(self.history),
+            "total_messages": len(self.store),
             "user_messages": user_count,
             "assistant_messages": assistant_count,
-            "system_messages": system_count,
-            "conversation_rounds": min(user_count, assistant_count)
+            "system_messages": counts["system"],
+            "conversation_rounds": len(self.archive) + min(user_count, assistant_count),
+            "history_tokens": self.store.total_tokens,
+            "token_budget": self.token_budget,
+            "compacted_rounds": len(self.archive),
+            "branch": self.branch.name,
+            "branches": len(self.branches),
+            "file_messages": self.store.count(FILE_PREFIX),
+            "evicted_files": self.evicted_files,
+            "requests_sent": self.budget.requests,
+            "tokens_used": self.budget.tokens,
+            "retries": self.retries,
+            "retry_wait": round(self.retry_wait, 3),
+            "rate_limit_wait": round(self.rate_wait, 3)
         }
     
     def __len__(self):
-        user_count = sum(1 for msg in self.history if msg["role"] == "user")
-        assistant_count = sum(1 for msg in self.history if msg["role"] == "assistant")
-        return min(user_count, assistant_count)
+        counts = self.store.counts
+        return len(self.archive) + min(counts["user"], counts["assistant"])
     
     def __getitem__(self, index: int):
         if index < 0 or index >= len(self):
             raise IndexError("对话轮数索引超出范围")
         
-        user_found = 0
-        for i, msg in enumerate(self.history):
-            if msg["role"] == "user":
-                if user_found == index:
-                    return [msg, self.history[i+1]] if i+1 < len(self.history) else [msg]
-                user_found += 1
-        return []
-
+        if index < len(self.archive):
+            return self.archive[index][:2]
+        i = self.store.turns[index - len(self.archive)]
+        return [self.store[i], self.store[i+1]] if i+1 < len(self.store) else [self.store[i]]
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+后台事件循环
+=======================
+说明：
+    整个程序共用一个在后台线程中运行的 asyncio 事件循环。
+    AI 请求 (AsyncOpenAI) 和上下文构建等耗时工作都提交到这里，主线程可以继续等待用户输入；
+    需要同步结果的地方用 run() 等待即可。
+    asyncio 在第一次 submit() 时才导入 (约 50ms)；in_thread() 使用普通线程池，启动阶段的后台工作不需要事件循环。
+    工作状态: Done
+"""
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable
+
+_loop = None
+_executor: ThreadPoolExecutor | None = None
+_lock = threading.Lock()
+
+
+def get_loop():
+    """
+    返回后台事件循环 (asyncio.AbstractEventLoop)，第一次调用时才导入 asyncio 并创建线程
+    """
+    global _loop
+    with _lock:
+        if _loop is None:
+            import asyncio
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="aicli-event-loop", daemon=True).start()
+            _loop = loop
+    return _loop
+
+
+def submit(coro: Awaitable) -> Future:
+    """
+    把协程交给后台事件循环，立即返回 concurrent.futures.Future
+    """
+    loop = get_loop()
+    import asyncio
+    return asyncio.run_coroutine_threadsafe(coro, loop)
+
+
+def run(coro: Awaitable) -> Any:
+    """
+    在后台事件循环中运行协程并等待结果；等待时按 Ctrl+C 会取消该协程
+    """
+    future = submit(coro)
+    try:
+        return future.result()
+    except KeyboardInterrupt:
+        future.cancel()
+        raise
+
+
+def in_thread(func: Callable, *args, **kwargs) -> Future:
+    """
+    在线程池中运行阻塞函数 (文件遍历、git 查询等)，不占用事件循环
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            # 与 asyncio.to_thread 默认线程池的大小相同
+            _executor = ThreadPoolExecutor(min(32, (os.cpu_count() or 1) + 4), thread_name_prefix="aicli-worker")
+    return _executor.submit(func, *args, **kwargs)
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""
+性能测试
+=======================
+说明：
+    各个热点路径的离线基准测试，在仓库根目录下用 python -m benchmarks.<name> 运行；
+    python -m benchmarks 运行全部测试并把结果写入 JSON (见 __main__.py)
+"""
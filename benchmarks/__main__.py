@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+基准测试套件
+=======================
+说明：
+    依次运行 SUITE 中的所有基准测试 (不访问网络)，结果写入一个 JSON 文件，可以与之前某次提交的结果比较。
+    每个测试在单独的子进程中运行：HOME 指向临时目录，API_KEY 使用假值，互不影响，也不会改动 ~/.aicli。
+    --compare 时比较两次结果中名字以 _s / _ms 结尾的耗时，变慢超过 --threshold 的列为回归，并以状态码 1 退出。
+    用法:
+        python -m benchmarks [名称 ...] [--quick] [--output results.json] [--compare baseline.json]
+        python -m benchmarks --list
+    工作状态: Done
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (名称, 模块, 完整运行的参数, --quick 时的参数；None 表示 --quick 时跳过)
+SUITE = [
+    ("parse", "bench_parse", [4.0], [1.0]),
+    ("file_tree_1k", "bench_file_tree", [1_000], [1_000]),
+    ("file_tree_10k", "bench_file_tree", [10_000], [10_000]),
+    ("file_tree_100k", "bench_file_tree", [100_000], None),
+    ("commands", "bench_commands", [300, 20], [100, 5]),
+    ("shell_session", "bench_shell_session", [1000], [200]),
+    ("history", "bench_history", [10_000], [2_000]),
+    ("cli", "bench_cli", [30, 2000], [10, 200]),
+    ("startup", "bench_startup", [10, 2000], [5, 200]),
+    ("git_state", "bench_git_state", [20_000, 200], [2_000, 50]),
+    ("search_index", "bench_search_index", [50_000], [5_000]),
+    ("patch", "bench_patch", [50.0], [50.0]),
+    ("file_transaction", "bench_file_transaction", [500], [100]),
+    ("snapshot_store", "bench_snapshot_store", [500], [100]),
+]
+
+# 子进程中运行一个测试，把 main() 的返回值写入 JSON
+CHILD = ("import json, sys\n"
+         "from importlib import import_module\n"
+         "result = import_module('benchmarks.' + sys.argv[1]).main(*json.loads(sys.argv[2]))\n"
+         "with open(sys.argv[3], 'w', encoding='utf-8') as f:\n"
+         "    json.dump(result, f)\n")
+
+
+def _git(*args: str) -> str | None:
+    try:
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_one(name: str, module: str, args: list, scratch: str) -> dict:
+    home = os.path.join(scratch, name)
+    os.makedirs(home)
+    out = os.path.join(scratch, f"{name}.json")
+    env = dict(os.environ, HOME=home, API_KEY="offline", AI_JOURNAL="0", PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-c", CHILD, module, json.dumps(args), out], cwd=ROOT, env=env)
+    wall = time.perf_counter() - start
+    if process.returncode != 0 or not os.path.exists(out):
+        raise RuntimeError(f"exit status {process.returncode}")
+    with open(out, encoding="utf-8") as f:
+        return {"module": module, "args": args, "wall_s": wall, "result": json.load(f)}
+
+
+def timings(result, prefix: str = "") -> dict[str, float]:
+    """
+    把一个测试的结果展开成 {"键路径": 秒}，只保留名字以 _s / _ms 结尾的数值
+    """
+    found = {}
+    if isinstance(result, dict):
+        for key, value in result.items():
+            path = f"{prefix}.{key}" if prefix else key
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                if key.endswith("_s"):
+                    found[path] = float(value)
+                elif key.endswith("_ms"):
+                    found[path] = value / 1000
+            else:
+                found.update(timings(value, path))
+    elif isinstance(result, list):
+        for i, value in enumerate(result):
+            found.update(timings(value, f"{prefix}[{i}]"))
+    return found
+
+
+def compare(baseline: dict, current: dict, threshold: float, floor: float) -> list[str]:
+    """
+    打印两次结果中耗时的变化，返回变慢超过 threshold 的指标；两边都小于 floor 秒的指标不比较 (噪声太大)
+    """
+    regressions = []
+    print(f"\ncompared with {baseline.get('commit') or 'baseline'} (threshold {threshold:.0%}):")
+    for name, entry in current["benchmarks"].items():
+        old_entry = baseline.get("benchmarks", {}).get(name)
+        if old_entry is None:
+            print(f"  {name}: not in baseline")
+            continue
+        if old_entry["args"] != entry["args"]:
+            print(f"  {name}: arguments differ ({old_entry['args']} -> {entry['args']}), skipped")
+            continue
+        old, new = timings(old_entry["result"]), timings(entry["result"])
+        for key in sorted(old.keys() & new.keys()):
+            if max(old[key], new[key]) < floor or old[key] <= 0:
+                continue
+            ratio = new[key] / old[key]
+            if abs(ratio - 1) <= threshold:
+                continue
+            regressed = ratio > 1 + threshold
+            if regressed:
+                regressions.append(f"{name}.{key}")
+            print(f"  {'REGRESSION' if regressed else 'improved  '} {name}.{key}: "
+                  f"{old[key] * 1000:.2f} ms -> {new[key] * 1000:.2f} ms ({ratio:.2f}x)")
+    if not regressions:
+        print("  no regressions")
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="offline benchmark suite")
+    parser.add_argument("names", nargs="*", help="benchmarks to run (default: all)")
+    parser.add_argument("--quick", action="store_true", help="smaller inputs, skip the slowest benchmarks")
+    parser.add_argument("--output", help="JSON file to write (default: benchmark-<commit>.json)")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON file of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.25, help="relative slowdown reported as a regression")
+    parser.add_argument("--floor", type=float, default=0.001, help="ignore timings below this many seconds")
+    parser.add_argument("--list", action="store_true", help="list the benchmarks and exit")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, module, full, quick in SUITE:
+            print(f"{name:<18} {module:<24} {full} {'(skipped with --quick)' if quick is None else quick}")
+        return 0
+    unknown = set(args.names) - {name for name, *_ in SUITE}
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    commit = _git("rev-parse", "--short", "HEAD")
+    report = {"commit": commit, "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+              "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "python": platform.python_version(),
+              "platform": platform.platform(), "cpus": os.cpu_count(), "quick": args.quick,
+              "benchmarks": {}, "failed": {}}
+    scratch = tempfile.mkdtemp(prefix="aicli_bench_suite_")
+    try:
+        for name, module, full, quick in SUITE:
+            if args.names and name not in args.names:
+                continue
+            params = quick if args.quick else full
+            if params is None:
+                continue
+            print(f"\n=== {name} ({module} {' '.join(map(str, params))}) ===", flush=True)
+            try:
+                report["benchmarks"][name] = run_one(name, module, params, scratch)
+            except Exception as e:
+                report["failed"][name] = str(e)
+                print(f"FAILED: {e}")
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    output = args.output or f"benchmark-{commit or 'unknown'}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\n{len(report['benchmarks'])} benchmarks written to {output}"
+          + (f", {len(report['failed'])} failed: {', '.join(report['failed'])}" if report["failed"] else ""))
+    status = 1 if report["failed"] else 0
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            if compare(json.load(f), report, args.threshold, args.floor):
+                status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
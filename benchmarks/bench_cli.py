@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+完整对话轮次基准测试
+=======================
+说明：
+    用假的 OpenAI 客户端 (立即按小片段流式返回预先写好的回复，不访问网络) 驱动 main.CLI，
+    测量完整一轮的本地耗时：提问 (附上下文和检索片段)、流式解析与显示、准备操作、
+    同意后执行 %%run、应用 %%create / %%patch (文件事务和快照)、%%read，以及之后在后台重建上下文
+    在临时项目目录中运行，HOME 指向临时目录 (必须在导入 main 之前设置，所以 main 在 main() 中才导入)
+    用法: python -m benchmarks.bench_cli [turns] [project_files]
+"""
+import io
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+
+def reply(turn: int, project: str) -> str:
+    return (f"好的，这是第 {turn} 轮的修改。\n"
+            f"先运行测试看看现在的结果。\n"
+            f"%%run echo turn {turn}\n"
+            f"%%create {os.path.join(project, f'generated_{turn}.py')}\n"
+            f"[file_start python]\n" + "".join(f"def step_{i}():\n    return {turn} + {i}\n" for i in range(30)) +
+            f"[file_end]\n"
+            f"%%patch {os.path.join(project, 'app.py')}\n"
+            f"[file_start diff]\n<<<<<<< SEARCH\nVALUE = {turn}\n=======\nVALUE = {turn + 1}\n>>>>>>> REPLACE\n[file_end]\n"
+            f"%%read {os.path.join(project, 'app.py')}\n"
+            f"修改完成后再运行一次测试即可。\n")
+
+
+class FakeCompletions:
+    """
+    chat.completions.create 的替代：流式时把回复切成 chunk_chars 个字符一段，像 SDK 一样异步迭代
+    """
+    def __init__(self, replies, chunk_chars: int = 8):
+        self.replies = replies
+        self.chunk_chars = chunk_chars
+        self.calls = 0
+
+    async def create(self, model, messages, max_tokens, temperature, stream):
+        text = self.replies(self.calls)
+        self.calls += 1
+        if not stream:
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=None)
+        return self._stream(text)
+
+    async def _stream(self, text: str):
+        for i in range(0, len(text), self.chunk_chars):
+            delta = SimpleNamespace(content=text[i:i + self.chunk_chars])
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+
+
+def main(turns: int = 30, project_files: int = 2000) -> dict[str, float]:
+    root = tempfile.mkdtemp(prefix="aicli_bench_cli_")
+    cwd = os.getcwd()
+    try:
+        project = os.path.join(root, "project")
+        for i in range(project_files):
+            directory = os.path.join(project, f"pkg{i % 20}")
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, f"module_{i}.py"), "w", encoding="utf-8") as f:
+                f.write(f"def handler_{i}(request):\n    return request * {i}\n")
+        with open(os.path.join(project, "app.py"), "w", encoding="utf-8") as f:
+            f.write("import os\n\nVALUE = 0\n\nprint(VALUE)\n")
+        os.environ.update(API_KEY="offline", HOME=os.path.join(root, "home"), AI_RETRIEVE_TOKENS="1500")
+        os.chdir(project)
+        from rich.console import Console
+        import main as app
+
+        cli = app.CLI()
+        cli.console = Console(file=io.StringIO(), width=120)
+        completions = FakeCompletions(lambda call: reply(call, project))
+        cli.ai._client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        durations = []
+        for turn in range(turns):
+            inputs = iter([f"第 {turn} 轮：请修改 app.py 并新增一个模块", "a"])
+            cli.console.input = lambda *args: next(inputs)
+            start = time.perf_counter()
+            cli.question()
+            cli.update()
+            durations.append(time.perf_counter() - start)
+        cli._wait_context()
+        with open(os.path.join(project, "app.py"), encoding="utf-8") as f:
+            assert f"VALUE = {turns}" in f.read()
+        assert os.path.exists(os.path.join(project, f"generated_{turns - 1}.py")) and completions.calls == turns
+
+        results = {"turns": turns, "project_files": project_files, "total_s": sum(durations),
+                   "first_turn_s": durations[0], "median_turn_s": statistics.median(durations),
+                   "history_messages": len(cli.ai.store), "history_tokens": cli.ai.history_tokens()}
+        print(f"project files:      {project_files}")
+        print(f"turns:              {turns} ({len(cli.ai.store)} messages, {cli.ai.history_tokens()} tokens in history)")
+        print(f"first turn:         {durations[0] * 1000:.0f} ms")
+        print(f"median turn:        {results['median_turn_s'] * 1000:.0f} ms")
+        print(f"total:              {results['total_s'] * 1000:.0f} ms")
+        return results
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+命令执行吞吐基准测试
+=======================
+说明：
+    Commandor.execute 每秒能执行的短命令数 (串行，以及与 Scheduler 并行执行 %%run 时相同的线程池)，
+    以及 execute (全部捕获) 与 stream (逐行读取，只保留开头和结尾) 处理大量输出时的吞吐
+    用法: python -m benchmarks.bench_commands [commands] [output_megabytes]
+"""
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from command_executor import Commandor
+
+
+def main(commands: int = 300, output_megabytes: int = 20) -> dict[str, float]:
+    root = tempfile.gettempdir()
+    executor = Commandor()
+    assert executor.execute(["echo", "1"], cwd=root).stdout == "1\n"
+
+    start = time.perf_counter()
+    for i in range(commands):
+        executor.execute(["echo", str(i)], cwd=root)
+    serial = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda i: executor.execute(["echo", str(i)], cwd=root), range(commands)))
+    parallel = time.perf_counter() - start
+
+    lines = output_megabytes * 1024 * 1024 // 64
+    printer = [sys.executable, "-c", f"import sys\nline = 'x' * 63 + '\\n'\nsys.stdout.write(line * {lines})"]
+    start = time.perf_counter()
+    captured = executor.execute(printer, cwd=root)
+    execute_output = time.perf_counter() - start
+    start = time.perf_counter()
+    streamed = executor.stream(printer, cwd=root)
+    stream_output = time.perf_counter() - start
+    assert captured.bytes_out == lines * 64 and streamed.lines_dropped == lines - executor.head_lines - executor.tail_lines
+
+    results = {"commands": commands, "serial_s": serial, "parallel_s": parallel,
+               "output_bytes": lines * 64, "execute_output_s": execute_output, "stream_output_s": stream_output}
+    print(f"short commands, serial:       {commands / serial:.0f} commands/s")
+    print(f"short commands, 8 threads:    {commands / parallel:.0f} commands/s")
+    print(f"{output_megabytes} MB output, execute:     {execute_output * 1000:.0f} ms "
+          f"({lines * 64 / execute_output / 1e6:.0f} MB/s)")
+    print(f"{output_megabytes} MB output, stream:      {stream_output * 1000:.0f} ms "
+          f"({lines * 64 / stream_output / 1e6:.0f} MB/s)")
+    return results
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
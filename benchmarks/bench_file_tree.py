@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+文件树基准测试
+=======================
+说明：
+    在约 10 万个条目的合成目录树上比较 ProjectContexter 冷启动 (首次遍历) 与热轮次 (缓存复用) 的耗时，
+    以及 _generate_file_tree (不经过 _see_files 的监视器逻辑) 和不带缓存的 get_simple_tree 的耗时
+    用法: python -m benchmarks.bench_file_tree [entries]
+"""
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+from project_context import ProjectContexter
+
+
+def make_tree(root: str, entries: int, fanout: int = 10, depth: int = 3) -> int:
+    """
+    生成 fanout ** depth 个叶子目录，把 entries 个文件平均分到叶子目录里
+    """
+    leaves = [root]
+    for _ in range(depth):
+        leaves = [os.path.join(p, f"d{i}") for p in leaves for i in range(fanout)]
+    per_leaf = max(1, entries // len(leaves))
+    count = 0
+    for leaf in leaves:
+        os.makedirs(leaf, exist_ok=True)
+        for i in range(per_leaf):
+            open(os.path.join(leaf, f"f{i}.txt"), "w").close()
+            count += 1
+    return count
+
+
+def timed(func, repeat: int = 1) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(entries: int = 100_000) -> dict[str, float]:
+    root = tempfile.mkdtemp(prefix="aicli_bench_tree_")
+    try:
+        count = make_tree(root, entries)
+        # 让目录的 mtime 脱离 racy 窗口，否则热轮次仍会重新列出所有目录
+        past = time.time() - 10
+        for dirpath, _, _ in os.walk(root):
+            os.utime(dirpath, (past, past))
+
+        contexter = ProjectContexter(root, look=False)
+
+        cold = timed(contexter._see_files)
+        warm = timed(contexter._see_files, repeat=5)
+
+        touched = os.path.join(root, "d0", "d0", "d0")
+        open(os.path.join(touched, "new.txt"), "w").close()
+        os.utime(touched, (past + 1, past + 1))
+        one_dir = timed(contexter._see_files)
+
+        contexter._nodes.clear()
+        generate_cold = timed(lambda: contexter._generate_file_tree(root))
+        generate_warm = timed(lambda: contexter._generate_file_tree(root), repeat=5)
+        simple = timed(contexter.get_simple_tree)
+
+        results = {"entries": count, "cold_s": cold, "warm_s": warm, "one_dir_changed_s": one_dir,
+                   "generate_cold_s": generate_cold, "generate_warm_s": generate_warm, "simple_tree_s": simple}
+        print(f"entries:            {count}")
+        print(f"cold turn:          {cold * 1000:.1f} ms")
+        print(f"warm turn:          {warm * 1000:.1f} ms  ({cold / warm:.1f}x)")
+        print(f"one dir changed:    {one_dir * 1000:.1f} ms")
+        print(f"_generate_file_tree cold / warm: {generate_cold * 1000:.1f} / {generate_warm * 1000:.1f} ms")
+        print(f"get_simple_tree:    {simple * 1000:.1f} ms")
+        return results
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
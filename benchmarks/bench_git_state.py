@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Git状态基准测试
+=======================
+说明：
+    在合成仓库上比较原来的两个串行 git 子进程 (log + status) 与 GitState 的耗时
+    用法: python -m benchmarks.bench_git_state [files] [commits]
+"""
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import time
+
+from git_state import GitState
+
+
+def make_repo(root: str, files: int, commits: int) -> None:
+    def git(*args):
+        subprocess.run(["git", "-c", "user.name=bench", "-c", "user.email=bench@local", *args],
+                       cwd=root, check=True, capture_output=True)
+
+    git("init", "-q")
+    for i in range(files):
+        sub = os.path.join(root, f"d{i % 100}")
+        os.makedirs(sub, exist_ok=True)
+        with open(os.path.join(sub, f"f{i}.txt"), "w") as f:
+            f.write(f"{i}\n")
+    git("add", "-A")
+    git("commit", "-qm", "initial")
+    for i in range(commits):
+        git("commit", "-q", "--allow-empty", "-m", f"commit {i}")
+    git("gc", "-q")
+    with open(os.path.join(root, "d0", "f0.txt"), "a") as f:
+        f.write("dirty\n")
+
+
+def legacy(root: str) -> tuple[str, str]:
+    log = subprocess.run(['git', 'log', '--oneline', '-5'], capture_output=True, text=True, cwd=root)
+    status = subprocess.run(['git', 'status', '--short'], capture_output=True, text=True, cwd=root)
+    return log.stdout.strip(), status.stdout.strip()
+
+
+def timed(func, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(files: int = 20_000, commits: int = 200) -> dict[str, float]:
+    root = tempfile.mkdtemp(prefix="aicli_bench_git_")
+    try:
+        make_repo(root, files, commits)
+        state = GitState()
+        assert state.query(root) == legacy(root)
+
+        results = {
+            "files": files,
+            "legacy_s": timed(lambda: legacy(root)),
+            "cold_s": timed(lambda: GitState().query(root)),
+            "warm_s": timed(lambda: state.query(root)),
+            "warm_watched_s": timed(lambda: state.query(root, root, 0)),
+        }
+        print(f"files / commits:            {files} / {commits}")
+        print(f"legacy (2 serial forks):    {results['legacy_s'] * 1000:.1f} ms")
+        print(f"GitState cold:              {results['cold_s'] * 1000:.1f} ms")
+        print(f"GitState warm:              {results['warm_s'] * 1000:.1f} ms  (log cached, status forked)")
+        print(f"GitState warm + watcher:    {results['warm_watched_s'] * 1000:.1f} ms  (nothing forked)")
+        return results
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    main(*args)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+对话历史基准测试
+=======================
+说明：
+    在约 1 万条消息 (5000 轮问答，夹杂读入的文件) 的历史上测量 AI 的各个历史操作：
+    追加消息、add_files (需要在整个历史中查找同名文件的旧副本)、分支与切换、revert、
+    file_stats、get_conversation_stats、export_state / import_state (会话日志的快照与恢复)，
+    以及超出 token 预算时的压缩。不发送任何请求
+    用法: python -m benchmarks.bench_history [messages]
+"""
+import sys
+import time
+
+from AI import AI
+
+
+def timed(func, repeat: int = 1) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def source(name: str, version: int) -> str:
+    return "".join(f"def {name}_{i}(x):\n    return x * {i + version}\n" for i in range(40))
+
+
+def main(messages: int = 10_000) -> dict[str, float]:
+    ai = AI("You are a benchmark.", "offline", "http://127.0.0.1:9", token_budget=10 ** 9)
+    rounds = messages // 2
+
+    def build():
+        for i in range(rounds):
+            if i % 50 == 0:
+                ai.add_files([(f"file_{i % 20}.py", source(f"f{i % 20}", i))])
+            ai._add_history("user", f"Question {i}: please explain step {i} of the build and fix the failing test.")
+            ai._add_history("assistant", f"Answer {i}: " + "the fix is to adjust the parameter. " * 8)
+
+    build_s = timed(build)
+    total = len(ai.store)
+    add_files_s = timed(lambda: ai.add_files([(f"file_{i}.py", source(f"f{i}", -1)) for i in range(5)]))
+    append_s = timed(lambda: [ai._add_history("user", "one more question") for _ in range(1000)]) / 1000
+    file_stats_s = timed(ai.file_stats, repeat=3)
+    stats_s = timed(ai.get_conversation_stats, repeat=3)
+    branch_s = timed(lambda: ai.checkout(ai.new_branch().name))
+    write_after_branch_s = timed(lambda: ai._add_history("user", "first write after branching"))
+    revert_s = timed(lambda: ai.revert(10))
+    state = None
+
+    def export():
+        nonlocal state
+        state = ai.export_state()
+
+    export_s = timed(export)
+    import_s = timed(lambda: ai.import_state(state))
+    ai.token_budget = ai.history_tokens() // 2
+    compact_s = timed(ai._enforce_budget)
+
+    results = {"messages": total, "build_s": build_s, "append_s": append_s, "add_files_s": add_files_s,
+               "file_stats_s": file_stats_s, "conversation_stats_s": stats_s, "branch_checkout_s": branch_s,
+               "write_after_branch_s": write_after_branch_s, "revert_s": revert_s, "export_state_s": export_s,
+               "import_state_s": import_s, "compact_half_s": compact_s}
+    print(f"messages in history:          {total}")
+    print(f"build (append all):           {build_s * 1000:.0f} ms")
+    print(f"append one message:           {append_s * 1e6:.1f} us")
+    print(f"add_files (5 files, dedup):   {add_files_s * 1000:.2f} ms")
+    print(f"file_stats:                   {file_stats_s * 1000:.2f} ms")
+    print(f"get_conversation_stats:       {stats_s * 1e6:.1f} us")
+    print(f"new_branch + checkout:        {branch_s * 1e6:.1f} us")
+    print(f"first write after branching:  {write_after_branch_s * 1000:.2f} ms (copy on write)")
+    print(f"revert 10 rounds:             {revert_s * 1000:.2f} ms")
+    print(f"export_state / import_state:  {export_s * 1000:.0f} / {import_s * 1000:.0f} ms")
+    print(f"compact to half the tokens:   {compact_s * 1000:.0f} ms ({len(ai.archive)} rounds archived)")
+    return results
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000)
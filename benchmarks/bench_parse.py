@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+回复解析基准测试
+=======================
+说明：
+    测量 parse_ai_response 解析一段普通大小的回复 (几个操作、约 4KB) 与一段数 MB 的回复 (大量 %%create / %%edit
+    文件内容和说明文字) 的耗时，以及 StreamParser 按流式片段 (每段约 20 个字符) 喂入同一段大回复的耗时
+    用法: python -m benchmarks.bench_parse [megabytes]
+"""
+import random
+import sys
+import time
+
+from parse_airtn import StreamParser, parse_ai_response
+
+
+def make_reply(target_bytes: int, rng: random.Random) -> str:
+    parts = []
+    size = 0
+    n = 0
+    while size < target_bytes:
+        body = "\n".join(f"    value_{i} = compute({i}, retries={rng.randrange(5)})  # step {i}"
+                         for i in range(rng.randrange(10, 60)))
+        block = (f"下面修改第 {n} 个模块，补充缺失的参数检查。\n"
+                 f"%%run python -m pytest tests/test_{n}.py -q\n"
+                 f"%%{'edit' if n % 2 else 'create'} src\\module_{n}.py\n"
+                 f"[file_start python]\ndef handler_{n}(request):\n{body}\n    return request\n[file_end]\n"
+                 f"%%read src\\module_{n}.py 1-20\n")
+        parts.append(block)
+        size += len(block.encode("utf-8"))
+        n += 1
+    return "".join(parts)
+
+
+def timed(func, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def stream(text: str, size: int = 20) -> list:
+    parser = StreamParser()
+    items = []
+    for i in range(0, len(text), size):
+        items += parser.feed(text[i:i + size])
+    return items + parser.close()
+
+
+def main(megabytes: float = 4.0) -> dict[str, float]:
+    rng = random.Random(0)
+    small = make_reply(2 * 1024, rng)
+    large = make_reply(int(megabytes * 1024 * 1024), rng)
+    assert stream(large) == parse_ai_response(large)
+
+    small_s = timed(lambda: parse_ai_response(small), repeat=200)
+    large_s = timed(lambda: parse_ai_response(large))
+    stream_s = timed(lambda: stream(large))
+    size = len(large.encode("utf-8"))
+    results = {"small_bytes": len(small.encode("utf-8")), "small_s": small_s,
+               "large_bytes": size, "large_s": large_s, "large_stream_s": stream_s,
+               "operations": sum(not isinstance(item, str) for item in parse_ai_response(large))}
+    print(f"small reply ({results['small_bytes']} bytes):         {small_s * 1e6:.0f} us")
+    print(f"large reply ({size / 1e6:.1f} MB, {results['operations']} ops): "
+          f"{large_s * 1000:.0f} ms ({size / large_s / 1e6:.0f} MB/s)")
+    print(f"large reply streamed in 20-char chunks: {stream_s * 1000:.0f} ms ({size / stream_s / 1e6:.0f} MB/s)")
+    return results
+
+
+if __name__ == "__main__":
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 4.0)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+补丁编辑基准测试
+=======================
+说明：
+    对不同长度的合成源文件做少量修改，比较 AI 用 %%edit 重新输出整个文件与用 %%patch 只输出 diff 时，
+    回复的 token 数、按生成速度估算的生成耗时，以及本地解析和应用的耗时
+    生成耗时 = token 数 / tokens_per_second，默认 50 token/s，不调用 API
+    用法: python -m benchmarks.bench_patch [tokens_per_second]
+"""
+import difflib
+import random
+import sys
+import time
+
+from parse_airtn import parse_ai_response
+from patcher import parse_patch, apply_patch
+from token_counter import estimate_tokens
+
+
+def make_source(lines: int, rng: random.Random) -> list[str]:
+    out = []
+    while len(out) < lines:
+        n = len(out)
+        out += [f"def handler_{n}(request, retries={rng.randrange(5)}):",
+                f"    \"\"\"Handle request kind {n}.\"\"\"",
+                f"    value = request.get('field_{n}', {rng.randrange(1000)})",
+                f"    return value * {rng.randrange(2, 9)}",
+                ""]
+    return out[:lines]
+
+
+def edit_reply(name: str, new: list[str]) -> str:
+    return f"%%edit {name}\n[file_start python]\n" + "\n".join(new) + "\n[file_end]\n"
+
+
+def patch_reply(name: str, old: list[str], new: list[str]) -> str:
+    diff = list(difflib.unified_diff(old, new, lineterm="", n=3))[2:]
+    return f"%%patch {name}\n[file_start diff]\n" + "\n".join(diff) + "\n[file_end]\n"
+
+
+def timed(func, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(tokens_per_second: float = 50.0) -> list[dict]:
+    rng = random.Random(0)
+    results = []
+    print(f"{'file lines':>10} {'changes':>7} | {'edit tokens':>11} {'patch tokens':>12} | "
+          f"{'edit gen s':>10} {'patch gen s':>11} | {'edit local ms':>13} {'patch local ms':>14}")
+    for lines in (200, 2000):
+        for changes in (1, 5):
+            old = make_source(lines, rng)
+            new = list(old)
+            for at in rng.sample([i for i, line in enumerate(old) if line.startswith("    return")], changes):
+                new[at] = new[at].replace("return value", "return value + 1")
+            original = "\n".join(old) + "\n"
+            edit, patch = edit_reply("app.py", new), patch_reply("app.py", old, new)
+
+            def apply_edit():
+                return parse_ai_response(edit)[0].content + "\n"
+
+            def apply_diff():
+                return apply_patch(original, parse_patch(parse_ai_response(patch)[0].content)).text
+
+            assert apply_edit() == apply_diff() == "\n".join(new) + "\n"
+            row = {"lines": lines, "changes": changes,
+                   "edit_tokens": estimate_tokens(edit), "patch_tokens": estimate_tokens(patch),
+                   "edit_local_ms": timed(apply_edit) * 1000, "patch_local_ms": timed(apply_diff) * 1000}
+            row["edit_generate_s"] = row["edit_tokens"] / tokens_per_second
+            row["patch_generate_s"] = row["patch_tokens"] / tokens_per_second
+            results.append(row)
+            print(f"{lines:>10} {changes:>7} | {row['edit_tokens']:>11} {row['patch_tokens']:>12} | "
+                  f"{row['edit_generate_s']:>10.1f} {row['patch_generate_s']:>11.1f} | "
+                  f"{row['edit_local_ms']:>13.2f} {row['patch_local_ms']:>14.2f}")
+    print(f"(generation time estimated at {tokens_per_second:g} output tokens/s)")
+    return results
+
+
+if __name__ == "__main__":
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 50.0)
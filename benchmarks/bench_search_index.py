@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+检索索引基准测试
+=======================
+说明：
+    在合成的源码目录上测量 SearchIndex 首次建索引、无变化时的增量更新、修改少量文件后的更新以及查询的耗时
+    用法: python -m benchmarks.bench_search_index [files]
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from search_index import SearchIndex
+
+WORDS = ("config", "loader", "session", "journal", "branch", "token", "cache", "stream", "parser", "command",
+         "scheduler", "buffer", "timeout", "digest", "payload", "context", "snapshot", "index", "render", "client")
+
+# 再加上几千个由音节拼成的词，让词频分布接近真实代码 (少数常见词，大量少见词)
+SYLLABLES = ("ka", "lo", "mi", "ren", "tu", "sha", "vex", "dor", "pi", "qua", "zen", "bo", "lin", "tor", "fi")
+VOCABULARY = WORDS + tuple(a + b + c for a in SYLLABLES for b in SYLLABLES for c in SYLLABLES)
+
+
+def make_file(rng: random.Random, lines: int = 60) -> str:
+    out = []
+    for i in range(lines):
+        a, b = rng.sample(WORDS, 2)
+        c = rng.choice(VOCABULARY)
+        if i % 10 == 0:
+            out.append(f"class {a.title()}{b.title()}:")
+        else:
+            out.append(f"    def {a}_{b}(self, {c}_{i}):  # {rng.randrange(10 ** 6)} {c}")
+    return "\n".join(out) + "\n"
+
+
+def make_tree(root: str, files: int) -> list[str]:
+    rng = random.Random(0)
+    paths = []
+    for i in range(files):
+        directory = os.path.join(root, f"pkg{i // 1000}", f"mod{i // 100 % 10}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{rng.choice(WORDS)}_{i}.py")
+        with open(path, "w") as f:
+            f.write(make_file(rng))
+        paths.append(path)
+    return paths
+
+
+def timed(func, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(files: int = 50_000) -> dict[str, float]:
+    root = tempfile.mkdtemp(prefix="aicli_bench_index_")
+    try:
+        paths = make_tree(root, files)
+        index = SearchIndex()
+        build = index.update(paths)["seconds"]
+        unchanged = index.update(paths)["seconds"]
+        for path in paths[:10]:
+            with open(path, "a") as f:
+                f.write("def snapshot_render(): pass\n")
+        changed = index.update(paths)["seconds"]
+
+        queries = ["how does the config loader parse the session journal", "SchedulerBuffer timeout kamiren",
+                   "snapshot_render", "where is the payload digest computed for vexdorpi and zenbolin"]
+        query_ms = timed(lambda: [index.search(query) for query in queries]) / len(queries) * 1000
+        snippets_ms = timed(lambda: [index.snippets(query, 1500) for query in queries]) / len(queries) * 1000
+
+        stats = index.stats()
+        results = {"files": files, "chunks": stats["chunks"], "terms": stats["terms"], "build_s": build,
+                   "unchanged_s": unchanged, "changed_10_s": changed, "query_ms": query_ms, "snippets_ms": snippets_ms}
+        print(f"files:                {files} ({stats['chunks']} chunks, {stats['terms']} terms)")
+        print(f"initial build:        {build:.2f} s")
+        print(f"update, no changes:   {unchanged * 1000:.0f} ms")
+        print(f"update, 10 changed:   {changed * 1000:.0f} ms")
+        print(f"search:               {query_ms:.1f} ms/query")
+        print(f"search + snippets:    {snippets_ms:.1f} ms/query")
+        return results
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50_000)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+持久 Shell 会话基准测试
+=======================
+说明：
+    执行 1000 条短命令，比较每条命令启动一个进程 (Commandor.execute / stream、bash -c) 与 ShellSession 的耗时
+    用法: python -m benchmarks.bench_shell_session [commands]
+"""
+import sys
+import tempfile
+import time
+
+from command_executor import Commandor
+from shell_session import ShellSession
+
+
+def timed(func, commands: int) -> float:
+    start = time.perf_counter()
+    for i in range(commands):
+        func(i)
+    return time.perf_counter() - start
+
+
+def main(commands: int = 1000) -> dict[str, float]:
+    root = tempfile.gettempdir()
+    executor = Commandor()
+    session = ShellSession(cwd=root)
+    try:
+        session.start()
+        assert session.run("echo 1", cwd=root).stdout == executor.execute(["echo", "1"], cwd=root).stdout
+
+        results = {
+            "commands": commands,
+            "execute_s": timed(lambda i: executor.execute(["echo", str(i)], cwd=root), commands),
+            "stream_s": timed(lambda i: executor.stream(["echo", str(i)], cwd=root), commands),
+            "bash_c_s": timed(lambda i: executor.execute(["bash", "-c", f"echo {i}"], cwd=root), commands),
+            "session_s": timed(lambda i: session.run(f"echo {i}", cwd=root), commands),
+        }
+        print(f"commands:                       {commands}")
+        for name, key in (("execute (subprocess.run)", "execute_s"), ("stream (Popen)", "stream_s"),
+                          ("bash -c per command", "bash_c_s"), ("persistent ShellSession", "session_s")):
+            seconds = results[key]
+            print(f"{name + ':':<32}{seconds * 1000:.0f} ms  ({seconds / commands * 1e6:.0f} us/command)")
+        print(f"speedup vs bash -c:             {results['bash_c_s'] / results['session_s']:.1f}x")
+        return results
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
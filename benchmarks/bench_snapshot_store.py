@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+文件快照基准测试
+=======================
+说明：
+    一轮修改涉及几百个文件时，比较执行前 SnapshotStore.capture() (reflink/硬链接) 的耗时
+    与直接读取、哈希并压缩所有文件的耗时，以及之后在后台入库 (ingest) 和撤销的耗时
+    用法: python -m benchmarks.bench_snapshot_store [files]
+"""
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+from file_transaction import FileTransaction, Staging
+from snapshot_store import SnapshotStore
+
+
+def main(files: int = 500) -> dict[str, float]:
+    root = tempfile.mkdtemp(prefix="aicli_bench_snap_")
+    try:
+        work = os.path.join(root, "work")
+        os.makedirs(work)
+        paths = []
+        for i in range(files):
+            path = os.path.join(work, f"module_{i}.py")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(f"def handler_{i}(request):\n    return request * {i}\n" * 200)
+            paths.append(path)
+        store = SnapshotStore(os.path.join(root, "snapshots"))
+        staging = Staging(os.path.join(root, "staging"))
+
+        start = time.perf_counter()
+        for path in paths:
+            with open(path, "rb") as f:
+                data = f.read()
+            hashlib.sha256(data).hexdigest()
+            zlib.compress(data, 1)
+        eager = time.perf_counter() - start
+
+        turn = store.begin("bench", work)
+        start = time.perf_counter()
+        store.capture(turn, paths, "edit")
+        capture = time.perf_counter() - start
+
+        transaction = FileTransaction(os.path.join(root, "transactions"))
+        for path in paths:
+            transaction.write(path, staging.stage(path, "changed\n"))
+        transaction.commit()
+        store.finish(turn)
+        start = time.perf_counter()
+        store.ingest(turn)
+        ingest = time.perf_counter() - start
+
+        start = time.perf_counter()
+        store.undo(1, staging)
+        undo = time.perf_counter() - start
+        with open(paths[0], encoding="utf-8") as f:
+            assert f.read().startswith("def handler_0")
+
+        stats = store.stats()
+        results = {"files": files, "eager_s": eager, "capture_s": capture, "ingest_s": ingest, "undo_s": undo,
+                   "stored_bytes": stats["bytes"]}
+        print(f"files:                                 {files} ({sum(map(os.path.getsize, paths)) // 1024} KB)")
+        print(f"read + hash + compress before editing: {eager * 1000:.1f} ms")
+        print(f"capture() before editing:              {capture * 1000:.1f} ms")
+        print(f"ingest() afterwards (background):      {ingest * 1000:.1f} ms, {stats['bytes'] // 1024} KB stored")
+        print(f"undo of the whole round:               {undo * 1000:.1f} ms")
+        return results
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+启动耗时基准测试
+=======================
+说明：
+    在一个临时的项目目录中多次启动 main.py，测量从启动进程到第一个提示符 (ASK ...>>>) 出现在输出中的时间，
+    以及输出提示符时 openai 是否已经在 sys.modules 中 (应当推迟到第一个提示符之后，在后台导入)
+    main.py 通过 PROBE 启动：它包装 sys.stdout，在提示符写出的同时检查 sys.modules 并把结果追加到输出中
+    不调用 API，API_KEY 使用假值，HOME 指向临时目录
+    用法: python -m benchmarks.bench_startup [runs] [project_files]
+"""
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+PROMPT = b">>> "
+MARK = b"[bench] openai imported at first prompt: "
+# 以 python -c PROBE main.py 运行：提示符写出时 (后台导入 openai 之前一刻) 检查 sys.modules
+PROBE = ("import os, runpy, sys\n"
+         "class Probe:\n"
+         "    def __init__(self, stream):\n"
+         "        self.stream, self.seen = stream, False\n"
+         "    def write(self, text):\n"
+         "        if not self.seen and '>>> ' in text:\n"
+         "            self.seen = True\n"
+         f"            text += '\\n{MARK.decode()}' + str('openai' in sys.modules) + '\\n'\n"
+         "        return self.stream.write(text)\n"
+         "    def __getattr__(self, name):\n"
+         "        return getattr(self.stream, name)\n"
+         "sys.stdout = Probe(sys.stdout)\n"
+         "sys.argv = sys.argv[1:]\n"
+         "sys.path.insert(0, os.path.dirname(sys.argv[0]))\n"
+         "runpy.run_path(sys.argv[0], run_name='__main__')\n")
+
+
+def make_project(root: str, files: int) -> None:
+    os.makedirs(root, exist_ok=True)
+    for i in range(files):
+        directory = os.path.join(root, f"pkg{i % 20}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"module_{i}.py"), "w", encoding="utf-8") as f:
+            f.write(f"VALUE = {i}\n")
+
+
+def time_to_prompt(cwd: str, env: dict) -> tuple[float, bool]:
+    """
+    返回 (到第一个提示符的秒数, 此时 openai 是否已导入)
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-c", PROBE, MAIN], cwd=cwd, env=env,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = b""
+    elapsed = None
+    try:
+        while elapsed is None or not output.split(MARK, 1)[-1].endswith(b"\n"):
+            chunk = process.stdout.read1(4096)
+            if not chunk:
+                raise RuntimeError(f"main.py exited before the first prompt:\n{output.decode(errors='replace')}")
+            output += chunk
+            if elapsed is None and PROMPT in output:
+                elapsed = time.perf_counter() - start
+        return elapsed, output.split(MARK, 1)[1].startswith(b"True")
+    finally:
+        process.kill()
+        process.wait()
+
+
+def main(runs: int = 10, project_files: int = 2000) -> dict[str, float]:
+    root = tempfile.mkdtemp(prefix="aicli_bench_startup_")
+    try:
+        project = os.path.join(root, "project")
+        make_project(project, project_files)
+        env = dict(os.environ, API_KEY="bench", HOME=os.path.join(root, "home"), AI_JOURNAL="0", COLUMNS="120")
+        # 第一次运行生成 __pycache__ (与平时使用相同)，不计入结果
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+        time_to_prompt(project, env)
+        samples = [time_to_prompt(project, env) for _ in range(runs)]
+        times = [elapsed for elapsed, _ in samples]
+        openai_runs = sum(imported for _, imported in samples)
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        interpreter = time.perf_counter() - start
+        results = {"runs": runs, "project_files": project_files, "median_s": statistics.median(times),
+                   "min_s": min(times), "interpreter_s": interpreter, "openai_imported_runs": openai_runs}
+        print(f"project files:               {project_files}")
+        print(f"bare interpreter start:      {interpreter * 1000:.0f} ms")
+        print(f"first prompt (median of {runs}): {results['median_s'] * 1000:.0f} ms")
+        print(f"first prompt (best):         {results['min_s'] * 1000:.0f} ms")
+        print(f"openai imported at prompt:   {openai_runs}/{runs} runs" + (" (should be 0)" if openai_runs else ""))
+        return results
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -6,12 +6,22 @@
 说明：
     当AI输出命令时，会在此处调用命令，至于对工作环境 (即cwd) 的管理还是留给另一个模块吧
     并没有做安全检查，因为AI输出的命令会先被人工检查一遍，确认 (enter y) 之后再执行，所以没有必要禁止一些命令的运行
+    stream() 用 Popen 逐行读取输出并实时回调，CommandResult 中只保留开头和结尾的若干行 (中间的行丢弃并计数)，
+    输出再多内存占用也有上限；超过总时长或长时间没有输出时结束整个进程组。
+    stream() 默认继承终端的输入 (命令可以提问、等待确认)；设置了时长上限或 interactive=False 时才不接收输入
     工作状态: Done
 """
+import locale
+import os
+import signal
 import subprocess as subp
+import threading
+import time
+from collections import deque
 from dataclasses import dataclass
 from enum import Enum
 import platform
+from typing import Callable
 
 
 class RunMode(Enum):
@@ -25,11 +35,85 @@ class CommandResult:
     stdout: str | None = None
     stderr: str | None = None
     error: Exception | None = None
+    bytes_out: int = 0
+    lines_dropped: int = 0
+    duration: float | None = None
+    # "timeout" 或 "idle"，表示因超时被结束
+    timed_out: str | None = None
+    # 在持久 shell 会话中执行时，命令结束后 shell 所在的目录
+    cwd: str | None = None
+
+
+class OutputBuffer:
+    def __init__(self, head: int = 200, tail: int = 200):
+        """
+        只保留前 head 行和最后 tail 行的输出缓冲
+        """
+        self.head_size = head
+        self.head: list[str] = []
+        self.tail: deque[str] = deque(maxlen=tail)
+        self.lines = 0
+        self.bytes = 0
+
+    @property
+    def dropped(self) -> int:
+        return self.lines - len(self.head) - len(self.tail)
+
+    def add(self, line: str, size: int) -> None:
+        self.lines += 1
+        self.bytes += size
+        if len(self.head) < self.head_size:
+            self.head.append(line)
+        elif self.tail.maxlen:
+            self.tail.append(line)
+
+    def text(self) -> str:
+        if not self.dropped:
+            return "".join(self.head) + "".join(self.tail)
+        return "".join(self.head) + f"... ({self.dropped} lines dropped) ...\n" + "".join(self.tail)
+
+
+def kill_process_group(process: subp.Popen, grace: float = 2.0) -> None:
+    """
+    结束进程及其启动的所有子进程 (进程需以新进程组启动)：先请求退出，grace 秒后强制结束
+    """
+    try:
+        if os.name == "nt":
+            process.send_signal(signal.CTRL_BREAK_EVENT)
+        else:
+            os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=grace)
+    except (OSError, subp.TimeoutExpired):
+        pass
+    # 进程本身已退出时，同组里忽略了 SIGTERM 的子进程也一起结束
+    try:
+        if os.name == "nt":
+            subp.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], capture_output=True)
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    process.wait()
+
 
 class Commandor:
-    def __init__(self):
+    def __init__(self, head_lines: int = 200, tail_lines: int = 200,
+                 timeout: float | None = None, idle_timeout: float | None = None):
+        """
+        Args:
+            head_lines / tail_lines: stream() 在结果中保留的开头、结尾行数 (stdout 和 stderr 分别计算)
+            timeout: stream() 默认的总时长上限 (秒)，None 表示不限
+            idle_timeout: stream() 默认的无输出时长上限 (秒)，None 表示不限
+
+        设置 self.session (shell_session.ShellSession) 后，stream() 在这个持久 shell 中执行命令
+        """
         self.last_result: CommandResult | None = None
         self.is_windows = "win" in platform.system().lower()
+        self.head_lines = head_lines
+        self.tail_lines = tail_lines
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.session = None
 
     def execute(
         self,
@@ -70,6 +154,7 @@ class Commandor:
             **kwargs
         }
 
+        start = time.perf_counter()
         try:
             result = subp.run(cmd, **run_kwargs)
 
@@ -77,7 +162,9 @@ class Commandor:
                 success=result.returncode == 0,
                 returncode=result.returncode,
                 stdout=result.stdout,
-                stderr=result.stderr
+                stderr=result.stderr,
+                bytes_out=len((result.stdout or "").encode()) + len((result.stderr or "").encode()),
+                duration=time.perf_counter() - start
             )
 
             if re_raise and result.returncode != 0:
@@ -121,7 +208,151 @@ class Commandor:
         
         self.last_result = cmd_result
         return cmd_result
-    
+
+    def stream(
+        self,
+        cmd: str | list[str],
+        on_line: Callable[[str, str], None] | None = None,
+        timeout: float | None = None,
+        idle_timeout: float | None = None,
+        re_raise: bool = False,
+        interactive: bool = True,
+        **kwargs
+    ) -> CommandResult:
+        """
+        执行命令，逐行回调输出，结果中只保留开头和结尾的输出
+
+        Args:
+            cmd: 要执行的命令，字符串或列表
+            on_line: 每读到一行时调用 on_line(stream, line)，stream 为 "stdout" 或 "stderr"，
+                两个管道由不同线程读取，回调已加锁，不会同时调用
+            timeout: 总时长上限 (秒)，默认使用构造时的设置
+            idle_timeout: stdout 和 stderr 都没有输出的时长上限 (秒)，默认使用构造时的设置
+            re_raise: 是否重新抛出异常，默认False
+            interactive: 是否让命令读取终端的输入，与其他命令同时执行时应为 False
+            **kwargs: 其他参数，参考subprocess.Popen (cwd、env、shell 等)
+
+        Examples:
+            >>> cmd = Commandor(head_lines=2, tail_lines=2)
+            >>> result = cmd.stream(["python", "-c", "for i in range(10): print(i)"], shell=False)
+            >>> print(result.stdout, result.lines_dropped)
+            0
+            1
+            ... (6 lines dropped) ...
+            8
+            9
+             6
+        """
+        if not isinstance(cmd, (str, list)):
+            raise TypeError("Expected str or list, got", type(cmd))
+        timeout = self.timeout if timeout is None else timeout
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        if self.session is not None:
+            self.last_result = self.session.run(cmd, cwd=kwargs.get("cwd"), on_line=on_line, timeout=timeout,
+                                                idle_timeout=idle_timeout, head_lines=self.head_lines,
+                                                tail_lines=self.tail_lines)
+            if re_raise and self.last_result.error is not None:
+                raise self.last_result.error
+            if re_raise and self.last_result.returncode != 0:
+                raise subp.CalledProcessError(self.last_result.returncode, cmd, output=self.last_result.stdout,
+                                              stderr=self.last_result.stderr)
+            return self.last_result
+        import shlex
+        cmd = shlex.split(cmd) if isinstance(cmd, str) else cmd
+        if kwargs.get("shell") is None:
+            kwargs["shell"] = self.is_windows
+        limited = timeout is not None or idle_timeout is not None
+        if limited or not interactive:
+            # 有时长上限时，等待输入的命令应该因超时结束，而不是卡住界面
+            kwargs.setdefault("stdin", subp.DEVNULL)
+        if limited:
+            # 以新进程组启动，超时时可以结束它启动的所有子进程；
+            # 没有时长上限时留在终端的前台进程组中，与 execute 一样可以读取终端的输入
+            if os.name == "nt":
+                kwargs.setdefault("creationflags", subp.CREATE_NEW_PROCESS_GROUP)
+            else:
+                kwargs.setdefault("start_new_session", True)
+
+        buffers = {"stdout": OutputBuffer(self.head_lines, self.tail_lines),
+                   "stderr": OutputBuffer(self.head_lines, self.tail_lines)}
+        lock = threading.Lock()
+        last_output = [time.monotonic()]
+        encoding = locale.getpreferredencoding(False)
+
+        def read(pipe, name: str):
+            buffer = buffers[name]
+            for raw in iter(pipe.readline, b""):
+                line = raw.decode(encoding, errors="replace")
+                with lock:
+                    last_output[0] = time.monotonic()
+                    buffer.add(line, len(raw))
+                    if on_line is not None:
+                        on_line(name, line)
+            pipe.close()
+
+        start = time.perf_counter()
+        try:
+            process = subp.Popen(cmd, stdout=subp.PIPE, stderr=subp.PIPE, **kwargs)
+        except FileNotFoundError as e:
+            if re_raise:
+                raise e
+            self.last_result = CommandResult(success=False, returncode=1, error=e, stderr=f"Command not found: {cmd[0]}")
+            return self.last_result
+        except Exception as e:
+            if re_raise:
+                raise e
+            self.last_result = CommandResult(success=False, returncode=1, error=e)
+            return self.last_result
+
+        readers = [threading.Thread(target=read, args=(process.stdout, "stdout"), daemon=True),
+                   threading.Thread(target=read, args=(process.stderr, "stderr"), daemon=True)]
+        for reader in readers:
+            reader.start()
+
+        timed_out = None
+        started = time.monotonic()
+        while True:
+            try:
+                process.wait(timeout=0.1)
+                break
+            except subp.TimeoutExpired:
+                pass
+            now = time.monotonic()
+            if timeout is not None and now - started > timeout:
+                timed_out = "timeout"
+            elif idle_timeout is not None and now - last_output[0] > idle_timeout:
+                timed_out = "idle"
+            if timed_out:
+                kill_process_group(process)
+                break
+        # 命令退出后，留在后台的子进程可能仍持有管道，不无限等待
+        for reader in readers:
+            reader.join(timeout=1)
+
+        with lock:
+            stdout, stderr = buffers["stdout"].text(), buffers["stderr"].text()
+            cmd_result = CommandResult(
+                success=process.returncode == 0 and timed_out is None,
+                returncode=process.returncode,
+                stdout=stdout,
+                stderr=stderr,
+                bytes_out=buffers["stdout"].bytes + buffers["stderr"].bytes,
+                lines_dropped=buffers["stdout"].dropped + buffers["stderr"].dropped,
+                duration=time.perf_counter() - start,
+                timed_out=timed_out
+            )
+        if timed_out:
+            limit = timeout if timed_out == "timeout" else idle_timeout
+            reason = "timed out" if timed_out == "timeout" else "produced no output"
+            cmd_result.stderr += f"Command {reason} after {limit}s and was killed\n"
+            cmd_result.error = subp.TimeoutExpired(cmd, limit, output=stdout, stderr=stderr)
+            if re_raise:
+                raise cmd_result.error
+        elif re_raise and process.returncode != 0:
+            raise subp.CalledProcessError(process.returncode, cmd, output=stdout, stderr=stderr)
+        self.last_result = cmd_result
+        return cmd_result
+
     def __call__(
             self,
             cmd: str | list[str],
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+对话存储组件
+=======================
+说明：
+    保存 AI 的消息列表，并在每次追加、截断、删除时同步维护：
+    各角色的消息数、第 n 轮用户消息在列表中的位置 (turns)、每条消息的 token 估算值及总和、带特定前缀的消息数。
+    因此轮次查找、统计、回退都是 O(1) 或均摊 O(1)，只有删除中间消息、插入摘要这类少见操作才整体重建索引。
+    messages 就是发给 OpenAI 的列表本身；请求期间用 borrow() 借出，
+    借出期间如果有修改，会先复制一份再改 (写时复制)，请求看到的列表不会变化，平时也不必每次请求都复制。
+    fork() 同样基于写时复制：fork 本身是 O(1) 的，但之后任一方第一次修改时要浅复制一次列表 (O(n) 个指针，
+    消息对象本身不复制；截断时只复制保留的部分)，因此撤回、重新提问 (会自动分出分支) 仍有一次 O(n) 的列表复制。
+    没有改成父指针 + 尾部列表的持久结构，是因为每次请求都要把消息作为一个连续的列表发给 API，
+    那样会把这次复制挪到每一次请求上。各分支共用同一批消息对象，FILE 内容在内存中只有一份。
+    Branch 是对话树上的一个分支，AI 切换分支只是切换指向的 Branch。
+    设置了 journal 时，每次修改都会以一条记录 (dict) 调用它，用于写入会话日志 (session_journal)。
+    工作状态: Done
+"""
+from typing import Callable, Iterable
+
+from token_counter import estimate_tokens
+
+ROLES = ("system", "user", "assistant")
+
+
+class ConversationStore:
+    def __init__(self, system_prompt: str, prefixes: Iterable[str] = ()):
+        """
+        Args:
+            system_prompt: 第一条系统消息
+            prefixes: 需要计数的消息前缀 (例如 "FILE ")，用于 count() 和 remove_prefixed()
+        """
+        self.prefixes = tuple(prefixes)
+        self._messages: list[dict] = []
+        self._tokens: list[int] = []
+        self._turns: list[int] = []
+        self.total_tokens = 0
+        self.counts = dict.fromkeys(ROLES, 0)
+        self.prefix_counts = dict.fromkeys(self.prefixes, 0)
+        self._borrowed = 0
+        # 与 fork() 出的其它 store 共用列表
+        self._shared = False
+        self.journal: Callable[[dict], None] | None = None
+        self.append("system", system_prompt)
+
+    @classmethod
+    def from_messages(cls, messages: list[dict], prefixes: Iterable[str] = (),
+                      tokens: list[int] | None = None) -> "ConversationStore":
+        """
+        直接用已有的消息对象构建 (恢复会话时使用，消息对象不复制)
+
+        Args:
+            tokens: 与 messages 对应的 token 估算值，已知时不再重新估算
+        """
+        store = cls.__new__(cls)
+        store.prefixes = tuple(prefixes)
+        store.journal = None
+        if tokens is None:
+            tokens = [estimate_tokens(message["content"]) for message in messages]
+        store._rebuild(list(zip(messages, tokens)))
+        return store
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __getitem__(self, index):
+        return self._messages[index]
+
+    def __iter__(self):
+        return iter(self._messages)
+
+    @property
+    def messages(self) -> list[dict]:
+        """
+        当前消息列表 (只读，不要直接修改)
+        """
+        return self._messages
+
+    @property
+    def turns(self) -> list[int]:
+        """
+        每条用户消息在 messages 中的位置 (只读)
+        """
+        return self._turns
+
+    def tokens(self, index: int) -> int:
+        return self._tokens[index]
+
+    def count(self, prefix: str) -> int:
+        return self.prefix_counts[prefix]
+
+    def borrow(self) -> list[dict]:
+        """
+        借出消息列表供一次请求使用，用完后调用 release()
+        """
+        self._borrowed += 1
+        return self._messages
+
+    def release(self, messages: list[dict]) -> None:
+        if messages is self._messages and self._borrowed:
+            self._borrowed -= 1
+
+    def fork(self) -> "ConversationStore":
+        """
+        O(1) 复制出一个内容相同的 store，双方在各自第一次修改前都共用同一组列表；
+        第一次修改时由 _writable() 浅复制列表，这一步是 O(n) 的
+        """
+        other = ConversationStore.__new__(ConversationStore)
+        other.prefixes = self.prefixes
+        other._messages, other._tokens, other._turns = self._messages, self._tokens, self._turns
+        other.total_tokens = self.total_tokens
+        other.counts = dict(self.counts)
+        other.prefix_counts = dict(self.prefix_counts)
+        other._borrowed = 0
+        other.journal = None
+        self._shared = other._shared = True
+        return other
+
+    def _log(self, record: dict) -> None:
+        if self.journal is not None:
+            self.journal(record)
+
+    def _writable(self, keep: int | None = None) -> None:
+        """
+        修改前调用：列表被借出或与其它分支共用时先浅复制 (O(n)；keep 不为 None 时只复制前 keep 条)
+        """
+        if self._shared:
+            self._messages = self._messages[:keep]
+            self._tokens = self._tokens[:keep]
+            self._turns = list(self._turns)
+            self._shared = False
+            self._borrowed = 0
+        elif self._borrowed:
+            self._messages = self._messages[:keep]
+            self._borrowed = 0
+
+    def _account(self, message: dict, tokens: int, sign: int) -> None:
+        self.total_tokens += sign * tokens
+        self.counts[message["role"]] = self.counts.get(message["role"], 0) + sign
+        for prefix in self.prefixes:
+            if message["content"].startswith(prefix):
+                self.prefix_counts[prefix] += sign
+
+    def append(self, role: str, content: str) -> dict:
+        self._log({"op": "append", "role": role, "content": content})
+        self._writable()
+        message = {"role": role, "content": content}
+        tokens = estimate_tokens(content)
+        if role == "user":
+            self._turns.append(len(self._messages))
+        self._messages.append(message)
+        self._tokens.append(tokens)
+        self._account(message, tokens, 1)
+        return message
+
+    def replace(self, index: int, role: str, content: str) -> None:
+        """
+        原位替换一条消息 (角色是否为 user 不能改变，否则轮次表会失效)
+        """
+        self._writable()
+        old = self._messages[index]
+        if (old["role"] == "user") != (role == "user"):
+            raise ValueError("replace() 不能改变消息是否为用户消息")
+        self._log({"op": "replace", "i": index, "role": role, "content": content})
+        self._account(old, self._tokens[index], -1)
+        message = {"role": role, "content": content}
+        tokens = estimate_tokens(content)
+        self._messages[index] = message
+        self._tokens[index] = tokens
+        self._account(message, tokens, 1)
+
+    def truncate(self, index: int) -> None:
+        """
+        删除 index 及之后的消息，耗时只与删除的条数有关 (需要复制时只复制保留的部分)
+        """
+        if index >= len(self._messages):
+            return
+        self._log({"op": "truncate", "i": index})
+        for message, tokens in zip(self._messages[index:], self._tokens[index:]):
+            self._account(message, tokens, -1)
+        self._writable(index)
+        del self._messages[index:]
+        del self._tokens[index:]
+        while self._turns and self._turns[-1] >= index:
+            self._turns.pop()
+
+    def remove(self, message: dict) -> bool:
+        """
+        删除指定的消息对象；它在末尾时是 O(1)
+        """
+        if self._messages and self._messages[-1] is message:
+            self.truncate(len(self._messages) - 1)
+            return True
+        for i in range(len(self._messages) - 1, -1, -1):
+            if self._messages[i] is message:
+                self.delete([i])
+                return True
+        return False
+
+    def remove_prefixed(self, prefix: str) -> int:
+        """
+        删除所有以 prefix 开头的消息，没有这类消息时不做任何事
+        """
+        if not self.prefix_counts[prefix]:
+            return 0
+        indices = [i for i, message in enumerate(self._messages) if message["content"].startswith(prefix)]
+        self.delete(indices)
+        return len(indices)
+
+    def delete(self, indices: Iterable[int]) -> None:
+        drop = set(indices)
+        if not drop:
+            return
+        self._log({"op": "delete", "indices": sorted(drop)})
+        self._rebuild([(message, tokens) for i, (message, tokens) in enumerate(zip(self._messages, self._tokens))
+                       if i not in drop])
+
+    def insert(self, index: int, role: str, content: str) -> dict:
+        self._log({"op": "insert", "i": index, "role": role, "content": content})
+        message = {"role": role, "content": content}
+        kept = list(zip(self._messages, self._tokens))
+        kept.insert(index, (message, estimate_tokens(content)))
+        self._rebuild(kept)
+        return message
+
+    def splice(self, start: int, end: int, messages: list[dict] = ()) -> None:
+        """
+        用 messages 替换 [start, end) 范围内的消息 (压缩和恢复较早轮次时使用)
+        """
+        self._log({"op": "splice", "start": start, "end": end,
+                   "messages": [[message["role"], message["content"]] for message in messages]})
+        pairs = list(zip(self._messages, self._tokens))
+        pairs[start:end] = [(message, estimate_tokens(message["content"])) for message in messages]
+        self._rebuild(pairs)
+
+    def reset(self, system_prompt: str) -> None:
+        self._log({"op": "reset", "content": system_prompt})
+        journal, self.journal = self.journal, None
+        self._rebuild([])
+        self.append("system", system_prompt)
+        self.journal = journal
+
+    def apply(self, record: dict) -> None:
+        """
+        重放一条 journal 记录 (不会再次写入 journal)
+        """
+        journal, self.journal = self.journal, None
+        try:
+            match record["op"]:
+                case "append":
+                    self.append(record["role"], record["content"])
+                case "replace":
+                    self.replace(record["i"], record["role"], record["content"])
+                case "truncate":
+                    self.truncate(record["i"])
+                case "delete":
+                    self.delete(record["indices"])
+                case "insert":
+                    self.insert(record["i"], record["role"], record["content"])
+                case "splice":
+                    self.splice(record["start"], record["end"],
+                                [{"role": role, "content": content} for role, content in record["messages"]])
+                case "reset":
+                    self.reset(record["content"])
+                case op:
+                    raise ValueError(f"未知的记录类型: {op}")
+        finally:
+            self.journal = journal
+
+    def _rebuild(self, pairs: list[tuple[dict, int]]) -> None:
+        # 整体重建时直接换成新列表，借出的旧列表保持不变
+        self._messages = [message for message, _ in pairs]
+        self._tokens = [tokens for _, tokens in pairs]
+        self._borrowed = 0
+        self._shared = False
+        self._turns = [i for i, message in enumerate(self._messages) if message["role"] == "user"]
+        self.total_tokens = sum(self._tokens)
+        self.counts = dict.fromkeys(ROLES, 0)
+        self.prefix_counts = dict.fromkeys(self.prefixes, 0)
+        for message in self._messages:
+            self.counts[message["role"]] = self.counts.get(message["role"], 0) + 1
+            for prefix in self.prefixes:
+                if message["content"].startswith(prefix):
+                    self.prefix_counts[prefix] += 1
+
+
+class Branch:
+    __slots__ = ("name", "store", "archive", "parent", "fork_round")
+
+    def __init__(self, name: str, store: ConversationStore, archive: list[list[dict]],
+                 parent: "Branch | None" = None, fork_round: int = 0):
+        """
+        Args:
+            name: 分支名
+            store: 该分支当前的消息
+            archive: 该分支被压缩掉的较早轮次 (各轮的消息列表与父分支共用)
+            parent: 从哪个分支分出
+            fork_round: 分出时父分支已有的轮数
+        """
+        self.name = name
+        self.store = store
+        self.archive = archive
+        self.parent = parent
+        self.fork_round = fork_round
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+文件消息组件
+=======================
+说明：
+    读入的文件以 "FILE <文件名>\n<内容>" 的系统消息加入对话，这里负责这类消息的格式和去重。
+    同一个文件再次读入时，历史中较早的完整副本被替换成到新版本的 unified diff (diff 不够短时直接删除)，
+    内容没变时不再重复加入；因此历史中每个文件只有最新的一份完整内容。
+    消息内容按哈希保存在 PayloadStore 中，相同内容的消息共用同一个字符串对象，各分支也只保存一份。
+    工作状态: Done
+"""
+import difflib
+import hashlib
+
+FILE_PREFIX = "FILE "
+# 被新版本取代的副本的第二行
+SUPERSEDED = "[旧版本 @{old}，已被之后 @{new} 的版本取代，以下为两者的差异]"
+
+
+def digest(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:12]
+
+
+def file_message(name: str, text: str) -> str:
+    return f"{FILE_PREFIX}{name}\n{text}"
+
+
+def parse(content: str) -> tuple[str, str, str] | None:
+    """
+    拆分文件消息
+
+    Returns:
+        (文件名, 类型, 正文)，类型为 "full" 或 "diff"；不是文件消息时返回 None
+    """
+    if not content.startswith(FILE_PREFIX):
+        return None
+    header, _, body = content.partition("\n")
+    kind = "diff" if body.startswith(SUPERSEDED[:5]) else "full"
+    return header[len(FILE_PREFIX):], kind, body
+
+
+def superseded_message(name: str, old_content: str, new_content: str, max_ratio: float = 0.5) -> str | None:
+    """
+    较早的完整副本被新版本取代后的内容：到新版本的 diff；diff 超过原内容的 max_ratio 时返回 None (直接删除)
+    """
+    old_text = parse(old_content)[2]
+    new_text = parse(new_content)[2]
+    old, new = digest(old_content), digest(new_content)
+    diff = "".join(difflib.unified_diff(old_text.splitlines(keepends=True), new_text.splitlines(keepends=True),
+                                        f"{name}@{old}", f"{name}@{new}", n=1))
+    if len(diff) > len(old_text) * max_ratio:
+        return None
+    return file_message(name, SUPERSEDED.format(old=old, new=new) + "\n" + diff)
+
+
+class PayloadStore:
+    def __init__(self):
+        # 哈希 -> 消息内容
+        self._payloads: dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._payloads)
+
+    def intern(self, content: str) -> str:
+        """
+        返回内容相同的已保存字符串 (没有时保存 content 本身)
+        """
+        return self._payloads.setdefault(digest(content), content)
+
+    def prune(self, live: set[str]) -> None:
+        """
+        只保留仍被消息引用的内容
+        """
+        self._payloads = {key: content for key, content in self._payloads.items() if content in live}
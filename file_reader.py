@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+文件读取组件
+=======================
+说明：
+    /readfiles、/readfile 和 %%read 把文件内容加入对话前在这里读取。
+    多个文件在线程池中并行读取；先读开头几 KB 判断是否为二进制文件，二进制文件不再继续读；
+    单个文件超过 max_file_bytes 时只保留开头 (在换行处截断)，所有文件合计超过 max_total_bytes 后其余文件跳过。
+    读到的内容按 (路径, 大小, mtime_ns) 缓存，文件没有变化时再次读取只需要一次 stat。
+    换行符统一为 \n (与文本模式读取相同)。
+    %%read <file> a-b 用 read_lines() 直接从磁盘读取指定的行，不受整个文件截断位置的影响；
+    行号超出文件范围或这些行超过 max_file_bytes 被截断时，在内容中说明。
+    工作状态: Done
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+SNIFF_BYTES = 8192
+
+# 跳过的原因
+BINARY = "binary"
+ENCODING = "not utf-8"
+BUDGET = "over budget"
+MISSING = "not found"
+UNREADABLE = "unreadable"
+
+
+@dataclass
+class ReadResult:
+    path: str
+    text: str | None = None
+    # 文件在磁盘上的大小
+    size: int = 0
+    skipped: str | None = None
+    truncated: bool = False
+    cached: bool = False
+
+    @property
+    def bytes(self) -> int:
+        return len(self.text.encode("utf-8")) if self.text is not None else 0
+
+
+@dataclass
+class IngestReport:
+    files: list[ReadResult] = field(default_factory=list)
+    skipped: list[ReadResult] = field(default_factory=list)
+    bytes: int = 0
+    duration: float = 0.0
+
+    @property
+    def truncated(self) -> list[ReadResult]:
+        return [result for result in self.files if result.truncated]
+
+    @property
+    def cached(self) -> int:
+        return sum(result.cached for result in self.files)
+
+    def reasons(self) -> dict[str, int]:
+        counts = {}
+        for result in self.skipped:
+            counts[result.skipped] = counts.get(result.skipped, 0) + 1
+        return counts
+
+
+class FileReader:
+    def __init__(self, max_file_bytes: int = 256 * 1024, max_total_bytes: int = 2 * 1024 * 1024,
+                 workers: int | None = None, cache_bytes: int = 64 * 1024 * 1024):
+        """
+        Args:
+            max_file_bytes: 单个文件最多读取的字节数，超出部分截断
+            max_total_bytes: 一次 read_many() 最多加入的字节数
+            workers: 读取线程数，默认为 CPU 数加 4 (至多 16)
+            cache_bytes: 内容缓存最多保存的字节数，按 LRU 淘汰
+        """
+        self.max_file_bytes = max_file_bytes
+        self.max_total_bytes = max_total_bytes
+        self.workers = workers or min(16, (os.cpu_count() or 1) + 4)
+        self.cache_bytes = cache_bytes
+        # 路径 -> (size, mtime_ns, max_file_bytes, ReadResult)
+        self._cache: OrderedDict[str, tuple[int, int, int, ReadResult]] = OrderedDict()
+        self._cache_size = 0
+        self._lock = threading.Lock()
+
+    def read(self, path: str) -> ReadResult:
+        """
+        读取单个文件 (受 max_file_bytes 限制，不受 max_total_bytes 限制)
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return ReadResult(path, skipped=MISSING)
+        except OSError:
+            return ReadResult(path, skipped=UNREADABLE)
+        return self._load(path, stat.st_size, stat.st_mtime_ns)
+
+    def read_lines(self, path: str, start: int, end: int) -> ReadResult:
+        """
+        读取第 start-end 行 (从 1 开始，包含 end)，这些行合计最多 max_file_bytes 字节
+        """
+        try:
+            size = os.stat(path).st_size
+            with open(path, "rb") as f:
+                if b"\0" in f.read(SNIFF_BYTES):
+                    return ReadResult(path, size=size, skipped=BINARY)
+        except FileNotFoundError:
+            return ReadResult(path, skipped=MISSING)
+        except OSError:
+            return ReadResult(path, skipped=UNREADABLE)
+        if start < 1 or end < start:
+            return ReadResult(path, f"[... invalid line range {start}-{end} ...]\n", size)
+        lines, used, last, truncated = [], 0, 0, False
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for number, line in enumerate(f, 1):
+                    if number > end:
+                        break
+                    last = number
+                    if number < start:
+                        continue
+                    used += len(line.encode("utf-8"))
+                    if used > self.max_file_bytes:
+                        truncated = True
+                        break
+                    lines.append(line)
+        except UnicodeDecodeError:
+            return ReadResult(path, size=size, skipped=ENCODING)
+        except OSError:
+            return ReadResult(path, size=size, skipped=UNREADABLE)
+        if lines and not lines[-1].endswith("\n"):
+            lines.append("\n")
+        if truncated:
+            lines.append(f"[... truncated after line {start + len(lines) - 1}, lines {start}-{end} are more than "
+                         f"{self.max_file_bytes} bytes ...]\n")
+        elif last < start:
+            lines.append(f"[... lines {start}-{end} are out of range, the file has {last} lines ...]\n")
+        elif last < end:
+            lines.append(f"[... the file ends at line {last} ...]\n")
+        return ReadResult(path, "".join(lines), size, truncated=truncated)
+
+    def read_many(self, paths: list[str]) -> IngestReport:
+        """
+        并行读取多个文件，按 paths 的顺序累计大小，超过 max_total_bytes 后的文件跳过
+        """
+        start = time.perf_counter()
+        report = IngestReport()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="aicli-read") as pool:
+            results = list(pool.map(self.read, paths))
+        for result in results:
+            if result.skipped is None and report.bytes + result.bytes > self.max_total_bytes:
+                result = ReadResult(result.path, size=result.size, skipped=BUDGET)
+            if result.skipped is not None:
+                report.skipped.append(result)
+                continue
+            report.files.append(result)
+            report.bytes += result.bytes
+        report.duration = time.perf_counter() - start
+        return report
+
+    def _load(self, path: str, size: int, mtime_ns: int) -> ReadResult:
+        with self._lock:
+            entry = self._cache.get(path)
+            if entry is not None and entry[:3] == (size, mtime_ns, self.max_file_bytes):
+                self._cache.move_to_end(path)
+                cached = entry[3]
+                return ReadResult(path, cached.text, cached.size, cached.skipped, cached.truncated, cached=True)
+        result = self._read_file(path, size)
+        if result.skipped in (None, BINARY, ENCODING):
+            self._remember(path, size, mtime_ns, result)
+        return result
+
+    def _read_file(self, path: str, size: int) -> ReadResult:
+        try:
+            with open(path, "rb") as f:
+                data = f.read(min(SNIFF_BYTES, self.max_file_bytes + 1))
+                if b"\0" in data:
+                    return ReadResult(path, size=size, skipped=BINARY)
+                if len(data) <= self.max_file_bytes:
+                    data += f.read(self.max_file_bytes + 1 - len(data))
+        except OSError:
+            return ReadResult(path, size=size, skipped=UNREADABLE)
+        truncated = len(data) > self.max_file_bytes
+        if truncated:
+            data = data[:self.max_file_bytes]
+            # 在最后一个换行处截断，避免截断多字节字符
+            cut = data.rfind(b"\n")
+            data = data[:cut + 1] if cut > 0 else data
+        try:
+            text = data.decode("utf-8")
+        except UnicodeDecodeError as e:
+            if not truncated or e.start < len(data) - 3:
+                return ReadResult(path, size=size, skipped=ENCODING)
+            text = data[:e.start].decode("utf-8")
+        # 与文本模式读取相同，\r\n 和 \r 都换成 \n，换行符不同的文件不会被当作内容有变化
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+        if truncated:
+            text += f"\n[... truncated, {size} bytes in total ...]\n"
+        return ReadResult(path, text, size, truncated=truncated)
+
+    def _remember(self, path: str, size: int, mtime_ns: int, result: ReadResult) -> None:
+        cost = result.bytes + len(path)
+        if cost > self.cache_bytes:
+            return
+        with self._lock:
+            old = self._cache.pop(path, None)
+            if old is not None:
+                self._cache_size -= old[3].bytes + len(path)
+            self._cache[path] = (size, mtime_ns, self.max_file_bytes, result)
+            self._cache_size += cost
+            while self._cache_size > self.cache_bytes:
+                old_path, old = self._cache.popitem(last=False)
+                self._cache_size -= old[3].bytes + len(old_path)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self._cache_size = 0
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+文件事务组件
+=======================
+说明：
+    %%edit / %%create / %%patch 的新内容先暂存在 ~/.aicli/staging 中，而不是写进工作目录，
+    不会在项目中留下临时文件，也不会触发项目自己的文件监视和构建。
+    同意后由 FileTransaction 逐个应用：新内容 fsync 后原子地 rename 到目标位置，被覆盖或删除的原文件先硬链接
+    (不支持时复制) 到事务目录中，并在修改之前把这一步写入回滚日志。
+    一批操作中任何一个失败时，按相反顺序撤销这批已经做过的所有修改；程序中途崩溃时，下次启动用 recover() 回滚。
+    每个事务在存在期间锁住自己目录中的锁文件并记录所属进程，recover() 只回滚所属进程已经退出的事务，
+    不会动另一个正在运行的实例中还没有提交的事务 (例如逐个确认时正在等待用户输入)。
+    文件内容逐个 fsync，目录的 fsync 合并到提交时每个目录只做一次。
+    暂存目录与目标不在同一个文件系统时，先复制到目标目录中的隐藏临时文件再 rename。
+    工作状态: Done
+"""
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+STAGING_DIRECTORY = os.path.join(os.path.expanduser("~"), ".aicli", "staging")
+TRANSACTION_DIRECTORY = os.path.join(os.path.expanduser("~"), ".aicli", "transactions")
+JOURNAL_NAME = "journal.jsonl"
+LOCK_NAME = "lock"
+OWNER_NAME = "owner.json"
+# 还没有写入所属进程的事务目录在这段时间 (秒) 内视为正在创建
+OWNER_GRACE = 60
+
+
+def _fsync_file(path: str) -> None:
+    with open(path, "rb+") as f:
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(path: str) -> None:
+    # Windows 上无法打开目录，rename 的持久性由文件系统保证
+    if os.name == "nt":
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class FileLock:
+    """
+    进程之间的互斥锁：锁住一个锁文件 (POSIX 上用 flock，Windows 上用 msvcrt.locking)，持有的进程退出时由系统释放
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """
+        blocking=False 时锁已被其他进程持有则返回 False
+        """
+        f = open(self.path, "a+b")
+        try:
+            if os.name == "nt":
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            f.close()
+            if blocking:
+                raise
+            return False
+        self._file = f
+        return True
+
+    def release(self) -> None:
+        if self._file is None:
+            return
+        if os.name == "nt":
+            import msvcrt
+            try:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            except OSError:
+                pass
+        self._file.close()
+        self._file = None
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+def _copy_metadata(source: str, target: str) -> None:
+    """
+    把原文件的权限位和所属用户/组复制到即将替换它的文件上；没有权限改所属时保留当前用户
+    """
+    try:
+        st = os.stat(source)
+    except OSError:
+        return
+    shutil.copymode(source, target)
+    if hasattr(os, "chown"):
+        try:
+            os.chown(target, st.st_uid, st.st_gid)
+        except OSError:
+            pass
+
+
+def _same_device(a: str, b: str) -> bool:
+    try:
+        return os.stat(a).st_dev == os.stat(b).st_dev
+    except OSError:
+        return False
+
+
+class Staging:
+    def __init__(self, directory: str = STAGING_DIRECTORY, max_age: float = 7 * 24 * 3600):
+        """
+        Args:
+            directory: 暂存目录，只有当前用户可以访问
+            max_age: 启动时删除超过该秒数的暂存文件 (崩溃遗留，且会话日志中已不再引用)
+        """
+        self.directory = directory
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.prune(max_age)
+
+    def stage(self, name: str, content: str | bytes) -> str:
+        """
+        暂存新内容 (bytes 原样写入)，返回暂存文件的路径
+        """
+        path = os.path.join(self.directory, f"{uuid.uuid4().hex[:12]}-{os.path.basename(name) or 'file'}")
+        if isinstance(content, bytes):
+            with open(path, "wb") as f:
+                f.write(content)
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(content)
+        return path
+
+    @staticmethod
+    def discard(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def prune(self, max_age: float) -> None:
+        cutoff = time.time() - max_age
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+
+class FileTransaction:
+    def __init__(self, directory: str = TRANSACTION_DIRECTORY):
+        """
+        Args:
+            directory: 存放各个事务的回滚日志和原文件备份的目录
+        """
+        self.directory = os.path.join(directory, f"{int(time.time())}-{uuid.uuid4().hex[:8]}")
+        # 已执行的步骤，回滚时倒序撤销
+        self.steps: list[dict] = []
+        # (路径, 异常)
+        self.failed: list[tuple[str, Exception]] = []
+        self._dirs: set[str] = set()
+        self._journal = None
+        self._owner: FileLock | None = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.steps)
+
+    def _start(self) -> None:
+        """
+        创建事务目录：先锁住锁文件，再记录所属进程，recover() 据此判断事务是否还有人持有
+        """
+        if self._owner is not None:
+            return
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        owner = FileLock(os.path.join(self.directory, LOCK_NAME))
+        owner.acquire()
+        self._owner = owner
+        with open(os.path.join(self.directory, OWNER_NAME), "w", encoding="utf-8") as f:
+            json.dump({"pid": os.getpid(), "started": time.time()}, f)
+
+    def _log(self, step: dict) -> None:
+        """
+        把步骤写入回滚日志并落盘
+        """
+        if self._journal is None:
+            self._start()
+            self._journal = open(os.path.join(self.directory, JOURNAL_NAME), "a", encoding="utf-8")
+        self._journal.write(json.dumps(step, ensure_ascii=False) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self.steps.append(step)
+
+    def _backup(self, path: str) -> str:
+        """
+        保存原文件：同一文件系统上用硬链接，不需要复制内容
+        """
+        self._start()
+        backup = os.path.join(self.directory, f"{len(self.steps)}-{uuid.uuid4().hex[:8]}")
+        try:
+            os.link(path, backup)
+        except OSError:
+            shutil.copy2(path, backup)
+            _fsync_file(backup)
+        return backup
+
+    def write(self, target: str, staged: str) -> None:
+        """
+        用暂存文件原子地替换 (或创建) target，暂存文件会被移走；
+        target 是符号链接时替换链接指向的文件，原文件的权限和所属用户保留到新文件上
+        """
+        target = os.path.realpath(os.path.abspath(target))
+        with self._lock:
+            exists = os.path.isfile(target)
+            backup = self._backup(target) if exists else None
+            self._log({"op": "write", "path": target, "backup": backup})
+            directory = os.path.dirname(target)
+            if _same_device(staged, directory):
+                if exists:
+                    _copy_metadata(target, staged)
+                _fsync_file(staged)
+                os.replace(staged, target)
+            else:
+                temp = os.path.join(directory, f".{os.path.basename(target)}.{uuid.uuid4().hex[:8]}.aicli-tmp")
+                try:
+                    shutil.copyfile(staged, temp)
+                    if exists:
+                        _copy_metadata(target, temp)
+                    _fsync_file(temp)
+                    os.replace(temp, target)
+                except BaseException:
+                    Staging.discard(temp)
+                    raise
+                Staging.discard(staged)
+            self._dirs.add(directory)
+
+    def write_text(self, target: str, content: str, staging: "Staging | None" = None) -> None:
+        staging = staging or Staging()
+        self.write(target, staging.stage(target, content))
+
+    def delete(self, target: str) -> None:
+        target = os.path.abspath(target)
+        with self._lock:
+            backup = self._backup(target)
+            self._log({"op": "delete", "path": target, "backup": backup})
+            os.remove(target)
+            self._dirs.add(os.path.dirname(target))
+
+    def rename(self, source: str, target: str) -> None:
+        source, target = os.path.abspath(source), os.path.abspath(target)
+        with self._lock:
+            if not os.path.lexists(source):
+                raise FileNotFoundError(f"No such file or directory: '{source}'")
+            backup = self._backup(target) if os.path.isfile(target) else None
+            os.rename(source, target)
+            # rename 成功之后才记录：失败时回滚不能把 (原本就存在的) target 移到 source
+            self._log({"op": "rename", "path": source, "target": target, "backup": backup})
+            self._dirs.update({os.path.dirname(source), os.path.dirname(target)})
+
+    def mkdir(self, path: str) -> None:
+        path = os.path.abspath(path)
+        with self._lock:
+            created = []
+            parent = path
+            while not os.path.exists(parent):
+                created.append(parent)
+                parent = os.path.dirname(parent)
+            self._log({"op": "mkdir", "path": path, "created": created})
+            os.makedirs(path, exist_ok=True)
+            self._dirs.update(os.path.dirname(p) for p in created)
+
+    def commit(self) -> None:
+        """
+        所有修改都已生效：每个涉及的目录 fsync 一次，然后删除回滚日志和备份
+        """
+        with self._lock:
+            for directory in self._dirs:
+                _fsync_dir(directory)
+            self._close()
+
+    def rollback(self) -> list[str]:
+        """
+        倒序撤销已执行的步骤，返回无法撤销的步骤的说明
+        """
+        with self._lock:
+            errors = _undo(self.steps)
+            for step in self.steps:
+                self._dirs.add(os.path.dirname(step["path"]))
+            for directory in self._dirs:
+                _fsync_dir(directory)
+            self._close()
+            return errors
+
+    def _close(self) -> None:
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        # 先删除回滚日志再释放锁：释放之后 recover() 即使抢先进入这个目录，也没有可回滚的步骤
+        try:
+            os.remove(os.path.join(self.directory, JOURNAL_NAME))
+        except OSError:
+            pass
+        if self._owner is not None:
+            self._owner.release()
+            self._owner = None
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.steps = []
+        self._dirs = set()
+
+    @staticmethod
+    def recover(directory: str = TRANSACTION_DIRECTORY) -> tuple[int, list[str]]:
+        """
+        回滚所属进程已经退出 (崩溃) 而没有提交的事务，返回 (回滚的事务数, 无法撤销的步骤)；
+        仍被其他进程持有的事务不动
+        """
+        try:
+            entries = sorted(os.scandir(directory), key=lambda entry: entry.name, reverse=True)
+        except OSError:
+            return 0, []
+        count, errors = 0, []
+        for entry in entries:
+            if not os.path.exists(os.path.join(entry.path, OWNER_NAME)):
+                # 所属进程刚创建目录、还没来得及锁住并记录自己
+                try:
+                    if time.time() - entry.stat().st_mtime < OWNER_GRACE:
+                        continue
+                except OSError:
+                    continue
+            owner = FileLock(os.path.join(entry.path, LOCK_NAME))
+            try:
+                if not owner.acquire(blocking=False):
+                    # 所属进程还在运行
+                    continue
+            except OSError:
+                continue
+            try:
+                steps = []
+                try:
+                    with open(os.path.join(entry.path, JOURNAL_NAME), "r", encoding="utf-8") as f:
+                        for line in f:
+                            try:
+                                steps.append(json.loads(line))
+                            except json.JSONDecodeError:
+                                # 崩溃时写了一半的最后一行，对应的修改还没有开始
+                                break
+                except OSError:
+                    pass
+                if steps:
+                    errors += _undo(steps)
+                    count += 1
+            finally:
+                owner.release()
+            shutil.rmtree(entry.path, ignore_errors=True)
+        return count, errors
+
+
+def _undo(steps: list[dict]) -> list[str]:
+    errors = []
+    for step in reversed(steps):
+        path, backup = step["path"], step.get("backup")
+        try:
+            match step["op"]:
+                case "write":
+                    if backup:
+                        os.replace(backup, path)
+                    elif os.path.exists(path):
+                        os.remove(path)
+                case "delete":
+                    os.replace(backup, path)
+                case "rename":
+                    if os.path.exists(step["target"]) and not os.path.exists(path):
+                        os.rename(step["target"], path)
+                    if backup:
+                        os.replace(backup, step["target"])
+                case "mkdir":
+                    for created in step["created"]:
+                        if os.path.isdir(created) and not os.listdir(created):
+                            os.rmdir(created)
+        except OSError as e:
+            errors.append(f"{step['op']} {path}: {e}")
+    return errors
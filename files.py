@@ -5,10 +5,13 @@
 =======================
 说明：
     该组件提供了对文件的基本操作，包括读取、写入、追加等。
+    传入 FileTransaction 时，写入、删除、重命名都通过事务完成 (原子替换，可整批回滚)，且不会预先创建空文件。
     工作状态: Done
 """
 import os
 
+from file_transaction import FileTransaction
+
 
 def _catch(func: callable) -> callable:
     def wrapper(*args, **kwargs):
@@ -21,9 +24,10 @@ def _catch(func: callable) -> callable:
 
 
 class FileChanger:
-    def __init__(self, file: str):
+    def __init__(self, file: str, transaction: FileTransaction | None = None):
         self.file = file
-        if not os.path.exists(self.file):
+        self.transaction = transaction
+        if transaction is None and not os.path.exists(self.file):
             with open(self.file, 'w', encoding='utf-8') as f:
                 f.write('')
     
@@ -38,14 +42,33 @@ class FileChanger:
     
     @_catch
     def rewrite(self, s: str) -> bool:
+        if self.transaction is not None:
+            self.transaction.write_text(self.file, s)
+            return
         with open(self.file, 'w', encoding='utf-8') as f:
             f.write(s)
     
+    @_catch
+    def replace(self, staged: str) -> bool:
+        """
+        用暂存的文件替换当前文件，暂存文件会被移走
+        """
+        if self.transaction is not None:
+            self.transaction.write(self.file, staged)
+            return
+        os.replace(staged, self.file)
+    
     @_catch
     def delete(self) -> bool:
+        if self.transaction is not None:
+            self.transaction.delete(self.file)
+            return
         os.remove(self.file)
     
     @_catch
     def rename(self, s: str) -> bool:
+        if self.transaction is not None:
+            self.transaction.rename(self.file, s)
+            return
         os.rename(self.file, s)
     
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+文件系统监视组件
+=======================
+说明：
+    在后台线程中监听 ProjectContexter.current_path 下的创建/删除/重命名事件，提前把文件树刷新好，
+    这样 CLI.update() 时不必再同步遍历目录。
+    Linux 上通过 watchdog 使用 inotify。watchdog 不可用或 inotify 启动失败 (例如 watch 数量达到上限) 时不启动后台线程，
+    由 ProjectContexter 照常在每轮提问前遍历目录：定时轮询在空闲时也会不停地遍历，比它替代的遍历更耗 CPU。
+    大量事件 (npm install、构建输出) 会先按目录去重，再在 debounce 时间内合并成一次刷新。
+    工作状态: Done
+"""
+import os
+import threading
+import time
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+
+class _Handler(FileSystemEventHandler):
+    def __init__(self, watcher: "Watcher"):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event) -> None:
+        if event.event_type in ("opened", "closed", "closed_no_write"):
+            return
+        self.watcher.touch(event.src_path)
+        if event.event_type not in ("created", "deleted", "moved"):
+            return
+        self.watcher.push(event.src_path)
+        if event.event_type == "moved":
+            self.watcher.push(event.dest_path)
+
+
+class Watcher:
+    def __init__(self, contexter, debounce: float = 0.2, max_delay: float = 2.0):
+        """
+        Args:
+            contexter: 要保持最新的 ProjectContexter
+            debounce: 最后一个事件之后安静多久才刷新 (秒)
+            max_delay: 事件持续不断时，距第一个事件最多多久必须刷新一次 (秒)
+        """
+        self.contexter = contexter
+        self.root = contexter.current_path
+        self.debounce = debounce
+        self.max_delay = max_delay
+        # 只有 inotify 等事件后端完成第一次全量校验后才为 True，此时 ProjectContexter 不再 stat 目录
+        self.trusted = False
+        self.backend: str | None = None
+        self.events = 0
+        self.refreshes = 0
+        # 工作区 (.git 以外) 任意文件变化的计数，GitState 以此判断 git status 能否复用
+        self.generation = 0
+        self._pending: set[str] = set()
+        self._pending_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._observer = None
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> bool:
+        """
+        开始监视；没有可用的事件后端时返回 False，不启动任何线程
+        """
+        if Observer is None:
+            return False
+        try:
+            observer = Observer()
+            observer.schedule(_Handler(self), self.root, recursive=True)
+            observer.start()
+        except OSError:
+            return False
+        self._observer = observer
+        self.backend = type(observer).__name__
+        self._thread = threading.Thread(target=self._run, name="aicli-fs-watcher", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self) -> None:
+        """
+        停止监视；不等待后台线程结束，因为它可能正在等待 ProjectContexter 的锁
+        """
+        self._stop.set()
+        self._wake.set()
+        self.trusted = False
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set()
+
+    def touch(self, path: str) -> None:
+        if isinstance(path, bytes):
+            path = os.fsdecode(path)
+        if f"{os.sep}.git{os.sep}" in path or path.endswith(f"{os.sep}.git"):
+            return
+        self.generation += 1
+
+    def push(self, path: str) -> None:
+        """
+        记录一个事件：只记录受影响的父目录，隐藏和排除目录下的事件直接丢弃
+        """
+        if isinstance(path, bytes):
+            path = os.fsdecode(path)
+        parent, name = os.path.split(path)
+        rel = os.path.relpath(parent, self.root)
+        parts = [] if rel == "." else rel.split(os.sep)
+        if parts and parts[0] == "..":
+            return
+        for part in parts + [name]:
+            if part.startswith('.') or part in self.contexter.exclude_dirs:
+                return
+        if len(parts) >= self.contexter.max_depth:
+            return
+        with self._pending_lock:
+            self._pending.add(parent)
+            self.events += 1
+        self._wake.set()
+
+    def pop_pending(self) -> set[str]:
+        with self._pending_lock:
+            pending, self._pending = self._pending, set()
+        return pending
+
+    def _run(self) -> None:
+        self._refresh()
+        self.trusted = True
+        while not self._stop.is_set():
+            self._wake.wait()
+            first = time.monotonic()
+            # 合并事件风暴：安静 debounce 秒，或距第一个事件超过 max_delay 秒后才刷新
+            while not self._stop.is_set():
+                self._wake.clear()
+                remaining = self.max_delay - (time.monotonic() - first)
+                if remaining <= 0 or not self._wake.wait(min(self.debounce, remaining)):
+                    break
+            self._refresh()
+
+    def _refresh(self) -> None:
+        if self._stop.is_set() or self.contexter.watcher is not self:
+            return
+        self.contexter._see_files()
+        self.refreshes += 1
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Git状态组件
+=======================
+说明：
+    为 ProjectContexter 提供 "最近更改" (git log --oneline -5) 和 "Git状态" (git status --short)，并缓存结果。
+    最近提交直接从 .git 目录读取 (HEAD、refs、packed-refs、松散对象和 pack 文件)，不需要启动 git 进程，
+    只在 HEAD 指向的提交变化时才重新读取；遇到读不了的仓库格式 (sha256、reftable、replace refs 等) 时退回到 git 命令。
+    git status 还取决于工作区中的文件内容，而这不会反映在 .git 中，
+    所以只有在文件监视器覆盖整个工作区时 (由调用者传入 watched_root 和 generation) 才缓存，否则每次都会执行，
+    需要执行 git 命令时两个查询并发运行。
+    工作状态: Done
+"""
+import heapq
+import os
+import struct
+import subprocess
+import zlib
+
+_OBJ_OFS_DELTA, _OBJ_REF_DELTA = 6, 7
+_TYPE_NAMES = {1: "commit", 2: "tree", 3: "blob", 4: "tag"}
+
+NO_CHANGES = "No recent changes found"
+NO_LOG = "Git not available or no changes"
+CLEAN = "Working directory clean"
+NO_STATUS = "Not a git repository or git not available"
+
+
+class _Unsupported(Exception):
+    """
+    无法直接从 .git 目录读取时抛出，调用者应退回到 git 命令
+    """
+
+
+def find_git_dir(path: str) -> tuple[str, str, str] | None:
+    """
+    从 path 开始向上查找仓库
+
+    Returns:
+        (工作区根目录, git 目录, 公共 git 目录)，不在仓库中时返回 None
+    """
+    path = os.path.abspath(path)
+    while True:
+        dot_git = os.path.join(path, ".git")
+        if os.path.isdir(dot_git):
+            git_dir = dot_git
+            break
+        if os.path.isfile(dot_git):
+            # 子模块与 git worktree 的 .git 是一个指向真实目录的文件
+            with open(dot_git, "r", encoding="utf-8") as f:
+                line = f.readline().strip()
+            if not line.startswith("gitdir:"):
+                return None
+            git_dir = os.path.normpath(os.path.join(path, line[len("gitdir:"):].strip()))
+            break
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+    common_dir = git_dir
+    commondir_file = os.path.join(git_dir, "commondir")
+    if os.path.isfile(commondir_file):
+        with open(commondir_file, "r", encoding="utf-8") as f:
+            common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+    return path, git_dir, common_dir
+
+
+class _Pack:
+    """
+    一个 pack 文件及其 v2 索引
+    """
+    def __init__(self, idx_path: str):
+        with open(idx_path, "rb") as f:
+            data = f.read()
+        if data[:4] != b"\377tOc" or struct.unpack(">I", data[4:8])[0] != 2:
+            raise _Unsupported(f"unsupported pack index: {idx_path}")
+        self.fanout = struct.unpack(">256I", data[8:8 + 1024])
+        self.count = self.fanout[255]
+        self.data = data
+        self.names_at = 8 + 1024
+        self.offsets_at = self.names_at + self.count * 24
+        self.large_at = self.offsets_at + self.count * 4
+        self.pack_path = idx_path[:-4] + ".pack"
+
+    def _name(self, i: int) -> bytes:
+        return self.data[self.names_at + i * 20: self.names_at + i * 20 + 20]
+
+    def _position(self, sha: bytes) -> int:
+        """
+        sha 在排好序的对象名中的位置 (不存在时为插入位置)
+        """
+        lo = self.fanout[sha[0] - 1] if sha[0] else 0
+        hi = self.fanout[sha[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(mid) < sha:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, sha: bytes) -> int | None:
+        i = self._position(sha)
+        if i == self.count or self._name(i) != sha:
+            return None
+        offset = struct.unpack(">I", self.data[self.offsets_at + i * 4: self.offsets_at + i * 4 + 4])[0]
+        if offset & 0x80000000:
+            at = self.large_at + (offset & 0x7fffffff) * 8
+            offset = struct.unpack(">Q", self.data[at: at + 8])[0]
+        return offset
+
+    def neighbours(self, sha: bytes) -> list[bytes]:
+        """
+        排序后紧挨着 sha 的其他对象名：与 sha 公共前缀最长的对象一定在其中
+        """
+        i = self._position(sha)
+        return [self._name(j) for j in (i - 1, i, i + 1) if 0 <= j < self.count and self._name(j) != sha]
+
+
+def _apply_delta(base: bytes, delta: bytes) -> bytes:
+    def varint(pos: int) -> tuple[int, int]:
+        value = shift = 0
+        while True:
+            c = delta[pos]
+            pos += 1
+            value |= (c & 0x7f) << shift
+            shift += 7
+            if not c & 0x80:
+                return value, pos
+
+    _, pos = varint(0)
+    size, pos = varint(pos)
+    out = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset = length = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (1 << (4 + i)):
+                    length |= delta[pos] << (8 * i)
+                    pos += 1
+            out += base[offset: offset + (length or 0x10000)]
+        elif op:
+            out += delta[pos: pos + op]
+            pos += op
+        else:
+            raise _Unsupported("invalid delta opcode")
+    if len(out) != size:
+        raise _Unsupported("delta size mismatch")
+    return bytes(out)
+
+
+class GitState:
+    def __init__(self, max_count: int = 5):
+        self.max_count = max_count
+        # 公共 git 目录 -> (HEAD 提交, 文本)
+        self._log_cache: dict[str, tuple[str, str]] = {}
+        # cwd -> (缓存键, 文本)
+        self._status_cache: dict[str, tuple[tuple, str]] = {}
+        # 公共 git 目录 -> (pack 目录 mtime, [_Pack])
+        self._packs: dict[str, tuple[int, list[_Pack]]] = {}
+        self.forks = 0
+
+    def query(self, cwd: str, watched_root: str | None = None, generation: int | None = None) -> tuple[str, str]:
+        """
+        返回 (最近更改, Git状态)
+
+        Args:
+            cwd: 当前工作目录，git status --short 的路径相对于它
+            watched_root: 文件监视器正在监视的目录，为 None 时表示无法知道工作区是否变化，每次都重新执行 git status
+            generation: 监视器记录的工作区变化计数；工作区位于 watched_root 之内时，
+                只要它与 HEAD、index 都没变，就复用上一次的 git status
+        """
+        repo = find_git_dir(cwd)
+        if repo is None:
+            return NO_LOG, NO_STATUS
+        worktree, git_dir, common_dir = repo
+
+        try:
+            head = self._resolve_head(git_dir, common_dir)
+        except (OSError, _Unsupported):
+            head = None
+
+        log_text = None
+        cached = self._log_cache.get(common_dir)
+        if head is not None and cached is not None and cached[0] == head:
+            log_text = cached[1]
+        elif head is not None:
+            try:
+                log_text = self._read_log(common_dir, head)
+                self._log_cache[common_dir] = (head, log_text)
+            except (OSError, _Unsupported, zlib.error, struct.error, IndexError, KeyError, ValueError):
+                log_text = None
+
+        status_text = None
+        status_key = None
+        if watched_root is not None and generation is not None \
+                and os.path.commonpath([watched_root, worktree]) == os.path.abspath(watched_root):
+            try:
+                index = os.stat(os.path.join(git_dir, "index"))
+                status_key = (head, index.st_mtime_ns, index.st_size, generation)
+            except OSError:
+                status_key = (head, None, None, generation)
+            cached = self._status_cache.get(cwd)
+            if cached is not None and cached[0] == status_key:
+                status_text = cached[1]
+
+        procs = {}
+        if log_text is None:
+            procs["log"] = self._spawn(["git", "log", "--oneline", f"-{self.max_count}"], cwd)
+        if status_text is None:
+            procs["status"] = self._spawn(["git", "status", "--short"], cwd)
+
+        if "log" in procs:
+            log_text = self._collect(procs["log"], NO_CHANGES, NO_LOG)
+            if head is not None and log_text not in (NO_CHANGES, NO_LOG):
+                self._log_cache[common_dir] = (head, log_text)
+        if "status" in procs:
+            status_text = self._collect(procs["status"], CLEAN, NO_STATUS)
+            if status_key is not None:
+                self._status_cache[cwd] = (status_key, status_text)
+        return log_text, status_text
+
+    def ignored(self, cwd: str, paths: list[str]) -> set[str]:
+        """
+        paths 中被 .gitignore (以及 .git/info/exclude、core.excludesFile) 忽略的路径；不在 git 仓库中或 git 不可用时为空
+        """
+        if not paths or find_git_dir(cwd) is None:
+            return set()
+        self.forks += 1
+        try:
+            result = subprocess.run(["git", "check-ignore", "--stdin", "-z"], cwd=cwd, capture_output=True,
+                                    input=b"\0".join(os.fsencode(path) for path in paths))
+        except OSError:
+            return set()
+        # 0: 有被忽略的路径，1: 没有，其他: 出错
+        if result.returncode != 0:
+            return set()
+        return {os.fsdecode(path) for path in result.stdout.split(b"\0") if path}
+
+    def _spawn(self, cmd: list[str], cwd: str) -> subprocess.Popen | None:
+        self.forks += 1
+        try:
+            return subprocess.Popen(
+                cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+            )
+        except OSError:
+            return None
+
+    @staticmethod
+    def _collect(proc: subprocess.Popen | None, empty: str, failed: str) -> str:
+        if proc is None:
+            return failed
+        stdout, _ = proc.communicate()
+        if proc.returncode == 0:
+            return stdout.strip() or empty
+        return failed
+
+    def _resolve_head(self, git_dir: str, common_dir: str) -> str | None:
+        """
+        读取 HEAD 指向的提交 sha，仓库还没有提交时返回 None
+        """
+        config = os.path.join(common_dir, "config")
+        if os.path.isfile(config):
+            with open(config, "r", encoding="utf-8", errors="replace") as f:
+                text = f.read().lower()
+            if "objectformat" in text or "refstorage" in text:
+                raise _Unsupported("extended repository format")
+        ref = "HEAD"
+        for _ in range(5):
+            content = None
+            for base in (git_dir, common_dir):
+                path = os.path.join(base, ref)
+                if os.path.isfile(path):
+                    with open(path, "r", encoding="utf-8") as f:
+                        content = f.read().strip()
+                    break
+            if content is None:
+                content = self._packed_ref(common_dir, ref)
+                if content is None:
+                    return None
+            if content.startswith("ref:"):
+                ref = content[4:].strip()
+                continue
+            return content
+        raise _Unsupported("symbolic ref loop")
+
+    @staticmethod
+    def _packed_ref(common_dir: str, ref: str) -> str | None:
+        path = os.path.join(common_dir, "packed-refs")
+        if not os.path.isfile(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith(("#", "^")):
+                    continue
+                sha, _, name = line.rstrip("\n").partition(" ")
+                if name == ref:
+                    return sha
+        return None
+
+    def _read_log(self, common_dir: str, head: str) -> str:
+        objects = os.path.join(common_dir, "objects")
+        if os.path.exists(os.path.join(common_dir, "shallow")) or os.path.isdir(os.path.join(common_dir, "refs", "replace")) \
+                or os.path.exists(os.path.join(objects, "info", "alternates")) or os.path.exists(os.path.join(common_dir, "info", "grafts")):
+            raise _Unsupported("history rewritten by shallow/replace/grafts or alternates")
+        packs = self._load_packs(objects)
+        abbrev = max(7, -(-sum(p.count for p in packs).bit_length() // 2))
+
+        commits = {}
+
+        def read_commit(sha: str) -> bytes:
+            if sha not in commits:
+                kind, body = self._read_object(objects, packs, sha)
+                if kind != "commit":
+                    raise _Unsupported(f"{sha} is not a commit")
+                commits[sha] = body
+            return commits[sha]
+
+        lines = []
+        seen = {head}
+        order = 0
+        queue = [(0, order, head)]
+        while queue and len(lines) < self.max_count:
+            _, _, sha = heapq.heappop(queue)
+            header, _, message = read_commit(sha).decode("utf-8", errors="replace").partition("\n\n")
+            for line in header.split("\n"):
+                key, _, value = line.partition(" ")
+                if key == "parent" and value not in seen:
+                    seen.add(value)
+                    order += 1
+                    heapq.heappush(queue, (-self._commit_time(read_commit(value)), order, value))
+            subject = []
+            for line in message.lstrip("\n").split("\n"):
+                if not line.strip():
+                    break
+                subject.append(line.rstrip())
+            lines.append(f"{sha[:self._unique_abbrev(objects, packs, sha, abbrev)]} {' '.join(subject)}")
+        return "\n".join(lines) or NO_CHANGES
+
+    @staticmethod
+    def _unique_abbrev(objects: str, packs: list[_Pack], sha: str, minimum: int) -> int:
+        """
+        与 git log --oneline 相同的缩写长度：至少 minimum 位，与松散对象和各个 pack 中的其他对象都不冲突
+        """
+        others = [name.hex() for pack in packs for name in pack.neighbours(bytes.fromhex(sha))]
+        try:
+            others += [sha[:2] + name for name in os.listdir(os.path.join(objects, sha[:2]))
+                       if len(name) == 38 and name != sha[2:]]
+        except OSError:
+            pass
+        common = max((len(os.path.commonprefix([sha, other])) for other in others), default=0)
+        return max(minimum, common + 1)
+
+    @staticmethod
+    def _commit_time(body: bytes) -> int:
+        for line in body.split(b"\n"):
+            if not line:
+                break
+            if line.startswith(b"committer "):
+                return int(line.rsplit(b" ", 2)[1])
+        return 0
+
+    def _load_packs(self, objects: str) -> list[_Pack]:
+        pack_dir = os.path.join(objects, "pack")
+        try:
+            mtime = os.stat(pack_dir).st_mtime_ns
+        except OSError:
+            return []
+        cached = self._packs.get(objects)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        packs = [_Pack(os.path.join(pack_dir, name)) for name in sorted(os.listdir(pack_dir)) if name.endswith(".idx")]
+        self._packs[objects] = (mtime, packs)
+        return packs
+
+    def _read_object(self, objects: str, packs: list[_Pack], sha: str) -> tuple[str, bytes]:
+        loose = os.path.join(objects, sha[:2], sha[2:])
+        if os.path.isfile(loose):
+            with open(loose, "rb") as f:
+                raw = zlib.decompress(f.read())
+            header, _, body = raw.partition(b"\0")
+            return header.split(b" ")[0].decode(), body
+        binary = bytes.fromhex(sha)
+        for pack in packs:
+            offset = pack.find(binary)
+            if offset is not None:
+                with open(pack.pack_path, "rb") as f:
+                    kind, body = self._read_packed(f, packs, objects, offset)
+                return _TYPE_NAMES[kind], body
+        raise _Unsupported(f"object {sha} not found")
+
+    def _read_packed(self, f, packs: list[_Pack], objects: str, offset: int) -> tuple[int, bytes]:
+        f.seek(offset)
+        c = f.read(1)[0]
+        kind = (c >> 4) & 7
+        while c & 0x80:
+            c = f.read(1)[0]
+        if kind == _OBJ_OFS_DELTA:
+            c = f.read(1)[0]
+            rel = c & 0x7f
+            while c & 0x80:
+                c = f.read(1)[0]
+                rel = ((rel + 1) << 7) | (c & 0x7f)
+            delta = self._inflate(f)
+            base_kind, base = self._read_packed(f, packs, objects, offset - rel)
+            return base_kind, _apply_delta(base, delta)
+        if kind == _OBJ_REF_DELTA:
+            base_sha = f.read(20).hex()
+            delta = self._inflate(f)
+            base_name, base = self._read_object(objects, packs, base_sha)
+            base_kind = {name: kind for kind, name in _TYPE_NAMES.items()}[base_name]
+            return base_kind, _apply_delta(base, delta)
+        if kind not in _TYPE_NAMES:
+            raise _Unsupported(f"unknown pack object type {kind}")
+        return kind, self._inflate(f)
+
+    @staticmethod
+    def _inflate(f) -> bytes:
+        decompressor = zlib.decompressobj()
+        out = []
+        while not decompressor.eof:
+            chunk = f.read(4096)
+            if not chunk:
+                raise _Unsupported("truncated pack object")
+            out.append(decompressor.decompress(chunk))
+        return b"".join(out)
@@ -4,16 +4,37 @@
 主程序入口
 工作状态: Done
 """
+# 最先导入，从这里开始记录启动各阶段的耗时 (--profile-startup)
+import startup_profile
 import os, time
+import shutil
+import argparse
+import json
 import rich.errors
+import rich.markup
 from rich.console import Console
+# rich.live / rich.table 只在显示表格时才导入
+startup_profile.mark("import stdlib, rich")
 
-from command_executor import Commandor
+from command_executor import Commandor, CommandResult
+from shell_session import ShellSession
 from cwd_manager import Manager
-from AI import AI
+from AI import AI, request_error
+from response_cache import ResponseCache, DEFAULT_DIRECTORY
+from session_journal import SessionJournal, DEFAULT_DIRECTORY as SESSION_DIRECTORY
 from files import FileChanger
+from file_transaction import FileTransaction, Staging
+from snapshot_store import SnapshotStore
+from file_reader import FileReader, ReadResult
+from search_index import SearchIndex
+from outline import Outliner, OUTLINERS, render as render_outline
+from patcher import parse_patch, apply_patch, diff_text
 from project_context import ProjectContexter
-from parse_airtn import parse_ai_response, Operation
+from parse_airtn import parse_ai_response, Operation, StreamParser, INVALID
+from token_counter import estimate_tokens
+from scheduler import Scheduler, Task, blocked_by, plan_dependencies, HINT_KEYS
+import async_runtime
+startup_profile.mark("import modules")
 
 api_key = os.environ.get("API_KEY")
 if not api_key:
@@ -21,10 +42,45 @@ if not api_key:
 
 base_url="https://api.siliconflow.cn/v1"
 
+def _env_number(name: str, cast=int, default=None):
+    value = os.environ.get(name)
+    return cast(value) if value else default
+
+# 客户端限流与预算，未设置时不限制
+rate_limits = {
+    "rpm": _env_number("AI_RPM", float),
+    "tpm": _env_number("AI_TPM", float),
+    "max_retries": _env_number("AI_MAX_RETRIES", default=5),
+    "max_requests": _env_number("AI_MAX_REQUESTS"),
+    "max_total_tokens": _env_number("AI_MAX_TOTAL_TOKENS"),
+}
+
 console = Console()
 
-command_executor = Commandor()
+# 命令总时长和无输出时长上限 (秒)，以及结果中保留的开头/结尾行数
+command_executor = Commandor(head_lines=_env_number("AI_OUTPUT_LINES", default=200),
+                             tail_lines=_env_number("AI_OUTPUT_LINES", default=200),
+                             timeout=_env_number("AI_CMD_TIMEOUT", float),
+                             idle_timeout=_env_number("AI_CMD_IDLE_TIMEOUT", float))
+# /readfiles 等读取文件时单个文件和一次读取合计的字节数上限
+file_reader = FileReader(max_file_bytes=_env_number("AI_READ_FILE_BYTES", default=256 * 1024),
+                         max_total_bytes=_env_number("AI_READ_TOTAL_BYTES", default=2 * 1024 * 1024))
+outliner = Outliner()
+# 确认框中最多显示的补丁行数
+PATCH_PREVIEW_LINES = 60
+# 提问前自动附上的相关代码片段: 最多的 token 数 (默认 0，不附加；会把没有打开过的文件内容发给 API，需要主动开启) 和片段数
+retrieve_tokens = _env_number("AI_RETRIEVE_TOKENS", default=0)
+retrieve_top_k = _env_number("AI_RETRIEVE_TOP_K", default=5)
+# 持久 shell 会话只支持 bash，Windows 上仍然每条命令启动一个进程
+shell_available = os.name != "nt" and shutil.which("bash") is not None
 cwd_manager = Manager()
+# %%edit 等的新内容在同意之前暂存的位置 (不在工作目录中)
+staging = Staging()
+# 每一轮文件操作之前的快照，用于 /undo；启动时在后台删除超过保留天数的轮次和内容
+snapshots = SnapshotStore()
+snapshot_days = _env_number("AI_SNAPSHOT_DAYS", float, default=14)
+# 会话日志保留的天数，启动时在后台删除更早的日志
+session_days = _env_number("AI_SESSION_DAYS", float, default=14)
 
 system_prompt = """
 你是一个AI编程助手，专门帮助用户在命令行中完成编程任务。
@@ -34,10 +90,12 @@ system_prompt = """
 
 **标记规则：**
 - 执行终端(Powershell/Bash)命令 %%run <command> [**kwargs, e.g. check=False, capture_output=True, text=True]
-- 读取文件 %%read <file> ，这会在用户的下一次问题前将文件内容插入对话。
+- 读取文件 %%read <file> [<起始行>-<结束行>]，这会在用户的下一次问题前将文件内容 (或指定的行) 插入对话。
+- 查看文件结构 %%outline <file>，这会在用户的下一次问题前插入文件中的类、函数、签名及其行号；较大的文件先查看结构，再用%%read读取需要的行。
 - 更改文件 %%edit <file>
 - 删除文件 %%delete <file>  (使用%%run del)
 - 新增文件 %%create <file>
+- 修改文件的一部分 %%patch <file>，内容为 unified diff (@@ -起始行,行数 +起始行,行数 @@，带 2~3 行上下文) 或若干个 <<<<<<< SEARCH / ======= / >>>>>>> REPLACE 块；只改动少量行时优先使用%%patch而不是%%edit
 - 新增目录 %%new_dir <dir>  (使用%%run mkdir)
 - 重命名文件 %%rename <file> <new_name>  (使用%%run mv)
 - 每个标记必须单独一行
@@ -45,11 +103,12 @@ system_prompt = """
 - 任何文件路径都必须是绝对路径，禁用相对路径 (除了%%run dir)
 - 在非必要情况下，尽量使用%%run <command>而非其他对文件操作 (除了%%edit和%%create)
 - 所有文件路径的分隔符都需要使用反斜杠
+- %%run命令默认按顺序执行 (等待之前的所有操作)；只有确定不读写本次其他操作涉及的文件时才加 independent=True 让它并行执行，也可以用 after=<n> 表示在第n个%%run (从0开始) 成功完成后再执行 (它失败时跳过)
 - 你给出的所有命令都会在用户处请求同意，若用户不同意执行命令，你将会收到SYSTEM的提示，反之，你不会收到提示
 - 给用户建议运行命令时，不需要使用%%run标记
 
 **文件内容规则：**
-- 在使用了%%edit或%%create后，若要输入文件内容，必须另起一行，用[file_start language]开始，[file_end]结束
+- 在使用了%%edit、%%create或%%patch后，若要输入文件内容，必须另起一行，用[file_start language]开始，[file_end]结束
 - 不必转义任何内容
 
 **示例：**
@@ -75,39 +134,167 @@ python main.py
 
 请确保你的回复清晰且遵循这个格式，可以添加额外的解释文字。
 """
-ai = AI(system_prompt, api_key, base_url, max_tokens=2048)
+# 回复缓存，设置 AI_CACHE=1 或 /rule cache true 后启用
+response_cache = ResponseCache(os.environ.get("AI_CACHE_DIR") or DEFAULT_DIRECTORY)
+use_cache = os.environ.get("AI_CACHE", "").lower() in ["true", "1"]
+# 同一文件再次读入时较早副本的处理方式: diff / replace / off
+ai = AI(system_prompt, api_key, base_url, max_tokens=2048, stream=True, **rate_limits,
+        cache=response_cache if use_cache else None, file_dedup=os.environ.get("AI_FILE_DEDUP") or "diff")
+startup_profile.mark("module setup")
 
 class CLI:
     def __init__(self):
         self.command_executor = command_executor
+        self.file_reader = file_reader
+        self.staging = staging
+        # 本轮同意的文件操作所在的事务，ask_for_changes 结束时提交或整体回滚
+        self.transaction = None
+        # 本轮文件操作之前的快照，以及上一轮快照在后台入库的任务
+        self.snapshots = snapshots
+        self.turn = None
+        self.snapshot_future = None
+        self.prune_future = async_runtime.in_thread(self.snapshots.prune, snapshot_days * 24 * 3600)
+        # 最近一次向 AI 提的问题 (不含上下文)，作为快照的说明
+        self.question_text = ""
+        self.outliner = outliner
         self.cwd_manager = cwd_manager
         self.ai = ai
         self.console = console
         self.whereami = self.cwd_manager.whereami
-        self.project_viewer = ProjectContexter(self.whereami)
+        # 第一次构建项目上下文 (遍历文件树、查询 git) 在后台进行，与显示标题和提示符同时完成，提问时再等待
+        self.project_viewer = ProjectContexter(self.whereami, look=False)
+        self.context_future = async_runtime.in_thread(self._first_context)
         self.ques, self.response = None, None
-        self.after_question = self.project_viewer.display_project_context()
+        self.retrieved = ""
+        self.after_question = None
         # Color settings
         self.color = "bold blue"
         self.errwarn = "bold red"
         self.hint = "bold yellow"
         self.success = "bold green"
+        # 上次运行中途崩溃时没有提交的文件修改
+        recovered, errors = FileTransaction.recover()
+        if recovered:
+            self.console.print(f"[{self.hint}][!] Rolled back {recovered} unfinished batches of file changes from the last run.[/{self.hint}]")
+        for error in errors:
+            self.console.print(f"[{self.errwarn}][-] Could not roll back {error}[/{self.errwarn}]")
         self.rules = {
-            "command": False
+            "command": False,
+            "watch": False,
+            "stream": self.ai.stream,
+            "background": False,
+            "cache": self.ai.cache is not None,
+            "parallel": True,
+            "persistent_shell": False,
+            "retrieve": retrieve_tokens > 0
         }
         self.asks = {}
         self.change_files = {}
+        # %%run 的调度参数 (sequential/after/independent)，与 asks 使用相同的键
+        self.run_hints = {}
+        self.scheduler = Scheduler(_env_number("AI_WORKERS"))
+        # 项目文件的检索索引，在后台建立和更新
+        self.search_index = SearchIndex()
+        self.index_future = async_runtime.in_thread(self._update_index, self.context_future) if self.rules["retrieve"] else None
+        if os.environ.get("AI_PERSISTENT_SHELL", "").lower() in ["true", "1"]:
+            self._set_persistent_shell(True)
+        # 流式输出时收到的文本片段，回复与之一致时直接使用边生成边解析的结果
+        self.streamed = []
+        self.text_shown = False
+        # 流式解析中途出错时的异常，之后改为等回复结束后整段解析
+        self.stream_error = None
+        # 本轮被拒绝的操作 (格式错误或无法准备)，回复写入历史之后告诉 AI
+        self.op_errors = []
+        # background 规则下尚未处理的AI回复
+        self.pending_reply = None
+        self.pending_compactions = 0
+        # full: 每次都发送完整上下文; delta: 首次完整发送，之后只发送变化; off: 不发送
+        self.context_mode = "delta"
+        self.sent_context = None
+        # 发送完整上下文时 AI 历史的压缩次数，之后再压缩说明完整上下文已不在历史中
+        self.context_compactions = 0
+        # 本次提问附带的上下文快照和压缩次数，请求成功后才记为已发送
+        self.pending_context = None
+        self.context_tokens_saved = 0
+        # 会话日志，以及最后一次写入日志的 CLI 状态
+        self.journal = None
+        self.journaled_state = None
+        # 在后台创建 AI 客户端 (导入 openai) 的任务，显示第一个提示符之后才开始
+        self.client_future = None
+        startup_profile.mark("CLI init")
+    
+    def start_journal(self, journal: SessionJournal):
+        self.journal = journal
+        # 快照按会话划分，恢复这个会话时可以继续撤销
+        self.snapshots.session = journal.session_id
+        journal.start(self.ai, self._session_state())
+        self.journaled_state = json.dumps(self._session_state(), ensure_ascii=False)
+    
+    def resume_journal(self, journal: SessionJournal):
+        """
+        从会话日志恢复历史、工作目录和待确认的操作
+        """
+        start = time.perf_counter()
+        state = journal.resume(self.ai)
+        self.journal = journal
+        self.snapshots.session = journal.session_id
+        self.journaled_state = json.dumps(state, ensure_ascii=False)
+        if os.path.isdir(state["cwd"]):
+            self.cwd_manager.whereami = self.whereami = state["cwd"]
+            self.project_viewer.current_path = self.whereami
+            self.context_future = async_runtime.submit(self._refresh_context(self.context_future))
+        self.console.print(f"[{self.success}][+] Session resumed from {journal.path}: {len(self.ai)} rounds, "
+                           f"{len(self.ai.branches)} branches, {time.perf_counter() - start:.2f}s[/{self.success}]")
+        self.asks = {key: tuple(value) for key, value in state["asks"].items()}
+        self.change_files = {key: tuple(value) for key, value in state["change_files"].items()}
+        self.run_hints = state.get("run_hints", {})
+        for key, (change_type, temp) in list(self.change_files.items()):
+            if change_type in ["edit", "create", "patch"] and not os.path.exists(temp):
+                self.console.print(f"[{self.errwarn}][-] Pending operation {key} dropped, its content is gone.[/{self.errwarn}]")
+                del self.change_files[key]
+                del self.asks[key]
+        if self.asks:
+            self.console.print(f"[{self.hint}][*] Operations still waiting for confirmation:[/{self.hint}]")
+            self.ask_for_changes()
+    
+    def _session_state(self) -> dict:
+        return {"cwd": self.whereami, "asks": self.asks, "change_files": self.change_files, "run_hints": self.run_hints}
+    
+    def _journal_state(self):
+        """
+        工作目录或待确认的操作变化时写入日志；日志较长时生成新的快照
+        """
+        if self.journal is None:
+            return
+        state = self._session_state()
+        encoded = json.dumps(state, ensure_ascii=False)
+        if encoded != self.journaled_state:
+            self.journal.write({"op": "cli", "state": state})
+            self.journaled_state = encoded
+        if self.journal.due:
+            self.journal.snapshot(self.ai, state)
     
     def question(self):
+        if self.pending_reply is not None and self.pending_reply.done():
+            self._collect_reply()
         self.console.print(f"[{self.color}]ASK {self.whereami}>>> [/{self.color}]", end="")
+        if self.client_future is None:
+            # 用户输入问题的同时导入 openai，第一次提问时不必再等待
+            self.client_future = async_runtime.in_thread(self.ai.prepare_client)
         ques = self.console.input()
         if not ques.strip(): return
         if not ques.startswith("/") and not self.rules["command"]:
-            self.ques = self.after_question + ques
+            if self.pending_reply is not None:
+                self.console.print(f"[{self.hint}][!] AI is still answering, local commands (/...) are available meanwhile.[/{self.hint}]")
+                return
+            self.question_text = ques
+            self.ques = self._context_prefix() + ques
+            # 检索到的片段只随这一次请求发送，不留在历史中
+            self.retrieved = self._retrieval_prefix(ques)
             self.ask()
         else:
             ques = ques[1:] if ques.startswith("/") else ques
-            if ques.startswith("cd"):
+            if ques.startswith("cd") and self.command_executor.session is None:
                 self.cwd_manager.parse_cd(ques)
                 if self.cwd_manager.err:
                     self.console.print(f"[{self.errwarn}][-] {self.cwd_manager.err}[/{self.errwarn}]")
@@ -115,11 +302,22 @@ class CLI:
                 self.whereami = self.cwd_manager.whereami
                 return
             elif ques == "readfiles":
-                for file in os.listdir(self.whereami):
-                    if os.path.isdir(file):
-                        continue
-                    self.ai._add_history("system", "FILE " + file + "\n" + FileChanger(file).read())
-                    self.console.print(f"[{self.success}][+] FILE {file} added.[/{self.success}]")
+                with os.scandir(self.whereami) as entries:
+                    paths = sorted(entry.path for entry in entries if entry.is_file())
+                report = self.file_reader.read_many(paths)
+                added = self.ai.add_files([(os.path.basename(result.path), result.text) for result in report.files])
+                for result in report.files:
+                    file = os.path.basename(result.path)
+                    if added[file] != "unchanged":
+                        note = f" (truncated to {self.file_reader.max_file_bytes} bytes)" if result.truncated else ""
+                        self.console.print(f"[{self.success}][+] FILE {file} {added[file]}{note}.[/{self.success}]")
+                self.console.print(f"[{self.success}][+] {len(report.files)} files read: {report.bytes} bytes, "
+                                   f"{report.cached} unchanged since last read, {report.duration:.2f}s[/{self.success}]")
+                self._report_superseded(added)
+                for reason, count in report.reasons().items():
+                    names = [os.path.basename(result.path) for result in report.skipped if result.skipped == reason]
+                    shown = ", ".join(names[:5]) + (f" and {len(names) - 5} more" if len(names) > 5 else "")
+                    self.console.print(f"[{self.hint}][!] Skipped {count} ({reason}): {shown}[/{self.hint}]")
                 return
             elif ques.startswith("readfile"):
                 try:
@@ -128,21 +326,110 @@ class CLI:
                     self.console.print(f"[{self.errwarn}][-] Wrong syntax: {ques.strip()}[/{self.errwarn}]")
                     self.console.print(f"[{self.hint}][*] Usage: /readfile <file>[/{self.hint}]")
                     return
-                if not os.path.isfile(file):
+                path = os.path.join(self.whereami, file)
+                if not os.path.isfile(path):
                     self.console.print(f"[{self.errwarn}][-] File not found: {file}[/{self.errwarn}]")
                     return
-                self.ai._add_history("system", "FILE " + file + "\n" + FileChanger(file).read())
-                self.console.print(f"[{self.success}][+] FILE {file} added.[/{self.success}]")
+                self._add_file_message(file, self.file_reader.read(path))
+                return
+            elif ques == "outline" or ques.startswith("outline "):
+                target = ques[len("outline"):].strip()
+                path = os.path.normpath(os.path.join(self.whereami, target)) if target else self.whereami
+                if os.path.isfile(path):
+                    paths = [path]
+                elif os.path.isdir(path):
+                    self._wait_context()
+                    paths = [file for file in self.project_viewer.list_files() if file.startswith(os.path.join(path, ""))]
+                else:
+                    self.console.print(f"[{self.errwarn}][-] Not found: {target}[/{self.errwarn}]")
+                    return
+                outlines, duration = self.outliner.outline_many(paths)
+                if not outlines:
+                    self.console.print(f"[{self.hint}][*] No supported source files ({', '.join(sorted(OUTLINERS))}).[/{self.hint}]")
+                    return
+                self._add_outlines([(os.path.relpath(outline.path, self.whereami), outline) for outline in outlines], show=True)
+                self.console.print(f"[{self.hint}][*] {sum(len(outline.symbols) for outline in outlines)} symbols from {len(outlines)} files, "
+                                   f"{sum(outline.cached for outline in outlines)} cached, {duration:.2f}s[/{self.hint}]")
+                return
+            elif ques == "index":
+                stats = self.search_index.stats()
+                building = self.index_future is not None and not self.index_future.done()
+                self.console.print(f"[{self.hint}][*] Search index{' (updating)' if building else ''}: {stats['files']} files, "
+                                   f"{stats['chunks']} chunks, {stats['terms']} terms[/{self.hint}]")
+                if "seconds" in stats:
+                    self.console.print(f"[{self.hint}][*] Last update: {stats['indexed']} indexed, {stats['removed']} removed, "
+                                       f"{stats['unchanged']} unchanged in {stats['seconds']:.2f}s[/{self.hint}]")
+                return
+            elif ques == "files":
+                self._show_files()
+                return
+            elif ques == "undo" or ques.startswith("undo "):
+                count = ques[len("undo"):].strip() or "1"
+                if not count.isdigit() or int(count) < 1:
+                    self.console.print(f"[{self.hint}][*] Usage: /undo [n][/{self.hint}]")
+                    return
+                self._undo(int(count))
+                return
+            elif ques == "history" or ques.startswith("history "):
+                if ques.split()[1:] != ["files"]:
+                    self.console.print(f"[{self.hint}][*] Usage: /history files[/{self.hint}]")
+                    return
+                self._show_file_history()
                 return
             elif ques == "clearfiles":
                 self.ai._clear_history_withstartswith(startswith="FILE ")
                 self.console.print(f"[{self.success}][+] All files cleared.[/{self.success}]")
                 return
+            elif ques.startswith("context"):
+                parts = ques.split()
+                if len(parts) == 1:
+                    self.console.print(f"[{self.hint}][*] Context mode: {self.context_mode}, tokens saved: {self.context_tokens_saved}[/{self.hint}]")
+                    return
+                if len(parts) != 2 or parts[1] not in ["full", "delta", "off"]:
+                    self.console.print(f"[{self.errwarn}][-] Wrong syntax: {ques.strip()}[/{self.errwarn}]")
+                    self.console.print(f"[{self.hint}][*] Usage: /context <full|delta|off>[/{self.hint}]")
+                    return
+                self.context_mode = parts[1]
+                self.sent_context = None
+                self.console.print(f"[{self.success}][+] Context mode set to {self.context_mode}[/{self.success}]")
+                return
+            elif ques.startswith("cache"):
+                parts = ques.split()
+                if len(parts) > 2 or (len(parts) == 2 and parts[1] not in ["stats", "clear"]):
+                    self.console.print(f"[{self.errwarn}][-] Wrong syntax: {ques.strip()}[/{self.errwarn}]")
+                    self.console.print(f"[{self.hint}][*] Usage: /cache <stats|clear>[/{self.hint}]")
+                    return
+                if len(parts) == 2 and parts[1] == "clear":
+                    response_cache.clear()
+                    self.console.print(f"[{self.success}][+] Response cache cleared.[/{self.success}]")
+                    return
+                stats = response_cache.stats()
+                self.console.print(f"[{self.hint}][*] Response cache {'on' if self.rules['cache'] else 'off'}: "
+                                   f"{stats['memory_hits']} memory hits, {stats['disk_hits']} disk hits, {stats['misses']} misses[/{self.hint}]")
+                self.console.print(f"[{self.hint}][*] Memory: {stats['memory_entries']} entries, {stats['memory_bytes']} bytes; "
+                                   f"disk: {stats['disk_entries']} entries, {stats['disk_bytes']} bytes ({stats['directory']})[/{self.hint}]")
+                return
+            elif ques == "limits":
+                stats = self.ai.get_conversation_stats()
+                budget = self.ai.budget
+                self.console.print(f"[{self.hint}][*] Requests: {stats['requests_sent']}/{budget.max_requests or '-'}, "
+                                   f"tokens: {stats['tokens_used']}/{budget.max_tokens or '-'}[/{self.hint}]")
+                self.console.print(f"[{self.hint}][*] Retries: {stats['retries']} ({stats['retry_wait']:.2f}s backoff), "
+                                   f"rate limit wait: {stats['rate_limit_wait']:.2f}s[/{self.hint}]")
+                return
+            elif ques.split(" ")[0] in ["branch", "branches", "checkout", "revert", "reask"]:
+                self._history_command(ques.split())
+                return
             elif ques in ["cls", "clear", "clearscreen"]:
                 self.console.clear()
                 return
             elif ques == "exit":
                 self.console.print(f"[{self.hint}][*] Exiting...[/{self.hint}]")
+                if self.journal is not None:
+                    # 退出前生成快照，下次 --resume 不需要重放
+                    self.journal.snapshot(self.ai, self._session_state())
+                    self.journal.close()
+                self._set_persistent_shell(False)
                 time.sleep(1)
                 exit(0)
             elif ques.startswith("rule"):
@@ -161,6 +448,21 @@ class CLI:
                     self.console.print(f"[{self.hint}][*] Usage: /rule <rulename> <true|false>[/{self.hint}]")
                     return
                 self.rules[rule] = value.strip().lower() in ["true", "1"]
+                if rule == "watch":
+                    if not self.rules[rule]:
+                        self.project_viewer.stop_watching()
+                    elif not self.project_viewer.start_watching():
+                        self.console.print(f"[{self.errwarn}][-] File watching needs the watchdog package with a working event backend, "
+                                           f"the file tree is still refreshed before each question.[/{self.errwarn}]")
+                        self.rules[rule] = False
+                elif rule == "stream":
+                    self.ai.stream = self.rules[rule]
+                elif rule == "cache":
+                    self.ai.cache = response_cache if self.rules[rule] else None
+                elif rule == "persistent_shell":
+                    self._set_persistent_shell(self.rules[rule])
+                elif rule == "retrieve" and self.rules[rule] and (self.index_future is None or self.index_future.done()):
+                    self.index_future = async_runtime.in_thread(self._update_index)
                 self.console.print(f"[{self.success}][+] Rule {rule} set to {self.rules[rule]}[/{self.success}]")
                 return
             elif ques == "color":
@@ -199,11 +501,275 @@ class CLI:
                     self.success = old_colors["3"]
                 else: self.console.print(f"[{self.success}][+] Color {color_index} set to {new_color}[/{self.success}]")
                 return
-            result = self.command_executor.execute(ques, cwd=self.whereami)
-            if result.returncode == 0:
-                self.console.print(f"[{self.success}][+][/{self.success}] " + result.stdout if result.stdout else f"[{self.success}][+] Done[/{self.success}]")
-            else:
-                self.console.print(f"[{self.errwarn}][-] {result.stderr}[/{self.errwarn}]")
+            self._run_cmd(ques)
+
+    def _add_file_message(self, file: str, result: ReadResult) -> bool:
+        """
+        把读取结果作为 FILE 消息加入历史；二进制、无法读取的文件只提示
+        """
+        if result.skipped is not None:
+            self.console.print(f"[{self.errwarn}][-] FILE {file} skipped: {result.skipped}[/{self.errwarn}]")
+            return False
+        added = self.ai.add_files([(file, result.text)])
+        if added[file] == "unchanged":
+            self.console.print(f"[{self.hint}][*] FILE {file} unchanged, already in history.[/{self.hint}]")
+            return True
+        note = f" (truncated to {self.file_reader.max_file_bytes} bytes)" if result.truncated else ""
+        self.console.print(f"[{self.success}][+] FILE {file} {added[file]}{note}.[/{self.success}]")
+        self._report_superseded(added)
+        return True
+
+    def _add_outlines(self, outlines: list, show: bool = False):
+        """
+        把文件大纲作为 "<文件名>#outline" 的 FILE 消息加入历史
+        """
+        entries = []
+        for file, outline in outlines:
+            if outline.error:
+                self.console.print(f"[{self.errwarn}][-] OUTLINE {file} failed: {outline.error}[/{self.errwarn}]")
+                continue
+            if not outline.symbols and len(outlines) > 1:
+                # 整个目录时没有类和函数的文件不加入
+                continue
+            text = render_outline(outline, file)
+            if show:
+                self.console.out(text, highlight=False)
+            entries.append((f"{file}#outline", text))
+        if not entries:
+            return
+        added = self.ai.add_files(entries)
+        changed = [name for name, _ in entries if added[name] != "unchanged"]
+        if len(entries) == 1:
+            name = entries[0][0]
+            self.console.print(f"[{self.success}][+] OUTLINE {name[:-len('#outline')]} {added[name]}.[/{self.success}]")
+        else:
+            self.console.print(f"[{self.success}][+] {len(entries)} outlines, {len(changed)} added or updated.[/{self.success}]")
+        self._report_superseded(added)
+
+    def _report_superseded(self, added: dict):
+        if added["superseded"] or added["dropped"]:
+            self.console.print(f"[{self.hint}][*] Older copies: {added['superseded']} replaced by diffs, {added['dropped']} removed, "
+                               f"{added['saved_tokens']} tokens saved[/{self.hint}]")
+
+    def _show_files(self):
+        stats = self.ai.file_stats()
+        if not stats:
+            self.console.print(f"[{self.hint}][*] No files in history.[/{self.hint}]")
+            return
+        from rich.table import Table
+        table = Table(title=f"Files in history ({self.ai.branch.name})")
+        table.add_column("File")
+        table.add_column("Version")
+        table.add_column("Kind")
+        table.add_column("Bytes", justify="right")
+        table.add_column("Tokens", justify="right")
+        for item in stats:
+            table.add_row(item["name"], item["digest"], item["kind"], str(item["bytes"]), str(item["tokens"]))
+        self.console.print(table)
+        self.console.print(f"[{self.hint}][*] {len(stats)} file messages, {sum(item['bytes'] for item in stats)} bytes, "
+                           f"{sum(item['tokens'] for item in stats)} tokens[/{self.hint}]")
+
+    def _undo(self, count: int):
+        """
+        把最近 count 轮 AI 的文件操作涉及的路径恢复到操作之前
+        """
+        if self.snapshot_future is not None:
+            self.snapshot_future.result()
+        try:
+            reports = self.snapshots.undo(count, self.staging, self.whereami)
+        except Exception as e:
+            self.console.print(f"[{self.errwarn}][-] Undo failed, nothing changed: {e}[/{self.errwarn}]")
+            return
+        if not reports:
+            self.console.print(f"[{self.hint}][*] Nothing to undo in this session and directory.[/{self.hint}]")
+            return
+        self.project_viewer.mark_dirty()
+        notes = []
+        for report in reports:
+            turn = report["turn"]
+            names = [os.path.relpath(path, turn.cwd) for path in report["restored"] + report["removed"]]
+            self.console.print(f"[{self.success}][+] Undid #{turn.id} ({rich.markup.escape(turn.label)}): {len(report['restored'])} restored, "
+                               f"{len(report['removed'])} removed[/{self.success}]")
+            for path in report["changed"]:
+                self.console.print(f"[{self.hint}][!] {os.path.relpath(path, turn.cwd)} had been modified after that round, those changes were undone too.[/{self.hint}]")
+            notes.append(", ".join(names))
+        self.ai._add_history("system", f"The user undid the file changes of the last {len(reports)} rounds; "
+                                       f"these files are back to their earlier state: {'; '.join(notes)}")
+
+    def _show_file_history(self):
+        turns = self.snapshots.history(cwd=self.whereami)
+        if not turns:
+            self.console.print(f"[{self.hint}][*] No file changes recorded.[/{self.hint}]")
+            return
+        from rich.table import Table
+        table = Table(title="File changes by AI (newest last, /undo n reverts the last n)")
+        table.add_column("#", justify="right")
+        table.add_column("Time")
+        table.add_column("Question")
+        table.add_column("Files")
+        for turn in turns:
+            files = [f"{entry['op']} {os.path.relpath(entry['path'], turn.cwd)}" for entry in turn.entries]
+            shown = ", ".join(files[:6]) + (f" and {len(files) - 6} more" if len(files) > 6 else "")
+            table.add_row(str(turn.id), time.strftime("%m-%d %H:%M:%S", time.localtime(turn.time)), rich.markup.escape(turn.label), shown)
+        self.console.print(table)
+        stats = self.snapshots.stats(self.whereami)
+        self.console.print(f"[{self.hint}][*] {stats['turns']} rounds, {stats['objects']} stored contents, "
+                           f"{stats['bytes']} bytes compressed[/{self.hint}]")
+
+    def _set_persistent_shell(self, enabled: bool):
+        if enabled and not shell_available:
+            self.console.print(f"[{self.errwarn}][-] Persistent shell needs bash, commands still run one process each.[/{self.errwarn}]")
+            enabled = False
+        if enabled and self.command_executor.session is None:
+            self.command_executor.session = ShellSession(cwd=self.whereami)
+        elif not enabled and self.command_executor.session is not None:
+            self.command_executor.session.close()
+            self.command_executor.session = None
+        self.rules["persistent_shell"] = enabled
+
+    def _history_command(self, parts: list[str]):
+        """
+        /branch [name], /branches, /checkout <n|name>, /revert [n], /reask
+        """
+        command = parts[0]
+        if command == "branches":
+            for i, branch in enumerate(self.ai.branches):
+                mark = "*" if branch is self.ai.branch else " "
+                origin = f", from {branch.parent.name} at round {branch.fork_round}" if branch.parent else ""
+                rounds = len(branch.archive) + min(branch.store.counts["user"], branch.store.counts["assistant"])
+                self.console.print(f"[{self.hint}] {mark} {i}> {branch.name}: {rounds} rounds, {branch.store.total_tokens} tokens{origin}[/{self.hint}]")
+            return
+        if self.pending_reply is not None:
+            self.console.print(f"[{self.hint}][!] AI is still answering, wait for the reply before changing history.[/{self.hint}]")
+            return
+        if command == "branch":
+            if len(parts) > 2:
+                self.console.print(f"[{self.hint}][*] Usage: /branch [name][/{self.hint}]")
+                return
+            try:
+                branch = self.ai.new_branch(parts[1] if len(parts) == 2 else None)
+            except ValueError as e:
+                self.console.print(f"[{self.errwarn}][-] {e}[/{self.errwarn}]")
+                return
+            self.console.print(f"[{self.success}][+] Branch {len(self.ai.branches) - 1}> {branch.name} created, use /checkout to switch to it.[/{self.success}]")
+            return
+        if command == "checkout":
+            if len(parts) != 2:
+                self.console.print(f"[{self.hint}][*] Usage: /checkout <n|name>[/{self.hint}]")
+                return
+            try:
+                branch = self.ai.checkout(parts[1])
+            except KeyError as e:
+                self.console.print(f"[{self.errwarn}][-] {e.args[0]}[/{self.errwarn}]")
+                return
+            self.console.print(f"[{self.success}][+] Switched to branch {branch.name} ({len(self.ai)} rounds)[/{self.success}]")
+        elif command == "revert":
+            if len(parts) > 2 or (len(parts) == 2 and not parts[1].isdigit()):
+                self.console.print(f"[{self.hint}][*] Usage: /revert [n][/{self.hint}]")
+                return
+            branches = len(self.ai.branches)
+            self.ai.revert(int(parts[1]) if len(parts) == 2 else 1)
+            if len(self.ai.branches) == branches:
+                self.console.print(f"[{self.hint}][*] Nothing to revert.[/{self.hint}]")
+                return
+            self.console.print(f"[{self.success}][+] Reverted to {len(self.ai)} rounds, previous state kept as branch {self.ai.branches[-1].name}[/{self.success}]")
+        elif command == "reask":
+            try:
+                self.ques = self.ai.rewind()
+                self.retrieved = ""
+            except IndexError as e:
+                self.console.print(f"[{self.errwarn}][-] {e}[/{self.errwarn}]")
+                return
+            self.console.print(f"[{self.hint}][*] Previous answer kept as branch {self.ai.branches[-1].name}[/{self.hint}]")
+            self.sent_context = None
+            self.ask()
+            return
+        # 换了分支或撤回了轮次，之前发送的上下文可能已不在历史中，下次重新发送完整上下文
+        self.sent_context = None
+    
+    def _context_prefix(self) -> str:
+        if self.context_mode == "off":
+            return ""
+        full = self._wait_context()
+        if self.context_mode == "full":
+            return full
+        delta = None
+        sent, compactions = self.sent_context, self.context_compactions
+        if self.ai.compactions != compactions:
+            sent = None
+        if sent is not None:
+            delta = self.project_viewer.display_context_delta(sent)
+        full_tokens = estimate_tokens(full)
+        if delta is None or estimate_tokens(delta) >= full_tokens:
+            delta = full
+            compactions = self.ai.compactions
+        # 请求失败时这条问题会从历史中撤回，AI 并没有收到这份上下文，所以等请求成功后再记录 (见 _context_sent)
+        self.pending_context = (self.project_viewer.snapshot(), compactions)
+        saved = full_tokens - estimate_tokens(delta)
+        if saved > 0:
+            self.context_tokens_saved += saved
+            self.console.print(f"[{self.hint}][*] Context delta saved {saved} tokens (total {self.context_tokens_saved})[/{self.hint}]")
+        return delta
+
+    def _context_sent(self, ok: bool):
+        """
+        请求结束后调用：成功时把本次附带的上下文记为已发送，失败时丢弃
+        """
+        if ok and self.pending_context is not None:
+            self.sent_context, self.context_compactions = self.pending_context
+        self.pending_context = None
+
+    def _retrieval_prefix(self, ques: str) -> str:
+        """
+        按问题从检索索引中取出最相关的代码片段；已经在对话中的文件不再附加
+        """
+        if not self.rules["retrieve"]:
+            return ""
+        start = time.perf_counter()
+        in_history = {os.path.join(self.whereami, item["name"]) for item in self.ai.file_stats()}
+        snippets = self.search_index.snippets(ques, retrieve_tokens or 1500, retrieve_top_k, in_history)
+        if not snippets:
+            return ""
+        parts = []
+        for snippet in snippets:
+            parts.append(f"--- {os.path.relpath(snippet.path, self.whereami)} (第 {snippet.start + 1}-{snippet.end} 行)\n{snippet.text}")
+        tokens = sum(estimate_tokens(part) for part in parts)
+        self.console.print(f"[{self.hint}][*] Attached {len(snippets)} relevant snippets from "
+                           f"{len({snippet.path for snippet in snippets})} files ({tokens} tokens, "
+                           f"{(time.perf_counter() - start) * 1000:.1f} ms)[/{self.hint}]")
+        body = "\n\n".join(parts)
+        return f"""
+==================================================
+相关代码片段 (根据问题自动检索，可能不完整)
+==================================================
+{body}
+==================================================
+"""
+
+    def _update_index(self, context=None):
+        if context is not None:
+            # 等新的文件树建好后再更新索引
+            try:
+                context.result()
+            except Exception:
+                pass
+        return self.search_index.update(self._index_files())
+
+    def _index_files(self) -> list[str]:
+        """
+        参与检索的文件：文件树中可见 (已跳过隐藏目录和 exclude_dirs)、不是隐藏文件、且没有被 .gitignore 忽略
+        """
+        files = [path for path in self.project_viewer.list_files() if not os.path.basename(path).startswith(".")]
+        ignored = self.project_viewer.git.ignored(self.project_viewer.current_path, files)
+        return [path for path in files if path not in ignored]
+
+    async def _refresh_index(self, context):
+        import asyncio
+        try:
+            await asyncio.wrap_future(context)
+        except Exception:
+            pass
+        await asyncio.to_thread(self._update_index)
 
     def _check_color(self):
         try:
@@ -217,85 +783,283 @@ class CLI:
             return False
 
     def ask(self):
-        self.response = parse_ai_response(self.ai.ask(self.ques))
+        compactions = self.ai.compactions
+        if self.rules["background"]:
+            self.pending_reply = self.ai.submit(self.ques, transient=self.retrieved)
+            self.pending_reply.add_done_callback(lambda _: self.console.print(
+                f"\n[{self.hint}][*] AI reply ready, press Enter to review it.[/{self.hint}]"))
+            self.pending_compactions = compactions
+            self.console.print(f"[{self.hint}][*] Asking in background...[/{self.hint}]")
+            return
+        self.asks = {}
+        self.change_files = {}
+        self.run_hints = {}
+        self.op_counter = 0
+        self.streamed = []
+        self.stream_parser = StreamParser()
+        self.stream_items = []
+        self.stream_error = None
+        self.op_errors = []
+        self.line_shown = 0
+        try:
+            answer = self.ai.ask(self.ques, on_chunk=self._render_chunk, transient=self.retrieved)
+        except BaseException:
+            self._context_sent(False)
+            raise
+        self._context_sent(request_error(answer) is None)
+        if request_error(answer) is not None:
+            # 请求失败 (重试也没有成功)：这一轮已从历史中撤回，不把错误提示当作回复解析
+            self._discard_changes()
+            if self.streamed: self.console.print()
+            self.console.print(f"[{self.errwarn}][-] {answer}[/{self.errwarn}]")
+            return
+        if self.streamed:
+            self._render_items(self.stream_parser.close())
+        self.text_shown = bool(self.streamed) and self.stream_error is None and "".join(self.streamed) == answer
+        timing = self.ai.timings[-1] if self.ai.timings else None
+        if timing and timing["cached"]:
+            self.console.print(f"[{self.hint}][*] Reply from cache[/{self.hint}]")
+        elif timing and timing["stream"] and timing["total"] is not None and timing["ttft"] is not None:
+            self.console.print(f"[{self.hint}][*] First token {timing['ttft']:.2f}s, total {timing['total']:.2f}s[/{self.hint}]")
+        if timing and timing["retries"]:
+            self.console.print(f"[{self.hint}][*] Retried {timing['retries']} times, waited {timing['waited']:.2f}s[/{self.hint}]")
+        if self.ai.compactions != compactions:
+            self.console.print(f"[{self.hint}][*] History compacted: {len(self.ai.archive)} earlier rounds summarized, {self.ai.history_tokens()} tokens now[/{self.hint}]")
+        if self.text_shown:
+            # 流式输出时操作已经边生成边准备好了，%%read 等要等回复写入历史之后再加入文件
+            # (%%patch 被拒绝的部分会以 SYSTEM 消息告诉 AI)
+            self.response = self.stream_items
+            for op in self.response:
+                if isinstance(op, Operation) and op.type in ("read", "outline", "patch"):
+                    self._prepare_op(op)
+            self._report_op_errors()
+            self.ask_for_changes()
+        else:
+            # 没有流式输出，或流中途出错被替换成了错误信息：丢弃已准备的操作，按整段回复处理
+            self._discard_changes()
+            self.response = parse_ai_response(answer)
+            self.submit_op_prep()
+    
+    def _collect_reply(self):
+        """
+        处理 background 规则下已完成的回复
+        """
+        try:
+            answer = self.pending_reply.result()
+        except BaseException:
+            self.pending_reply = None
+            self._context_sent(False)
+            raise
+        self.pending_reply = None
+        # 用这个请求自己的错误，而不是 ai.last_error (可能已被之后的请求改写)
+        self._context_sent(request_error(answer) is None)
+        if request_error(answer) is not None:
+            self.console.print(f"[{self.errwarn}][-] {answer}[/{self.errwarn}]")
+            return
+        if self.ai.compactions != self.pending_compactions:
+            self.console.print(f"[{self.hint}][*] History compacted: {len(self.ai.archive)} earlier rounds summarized, {self.ai.history_tokens()} tokens now[/{self.hint}]")
+        self.response = parse_ai_response(answer)
         self.submit_op_prep()
+        self.update()
+    
+    def _render_chunk(self, chunk: str):
+        """
+        流式回复的每个片段：实时显示正在生成的文字行，隐藏操作行和文件内容，操作一完整就准备好
+        """
+        self.streamed.append(chunk)
+        if self.stream_error is not None:
+            return
+        try:
+            self._render_items(self.stream_parser.feed(chunk))
+        except Exception as e:
+            # 在事件循环线程中调用，异常不能传回请求 (会被当作 API 错误而丢弃整个回复)；
+            # 之后不再边生成边解析，回复结束后整段重新解析
+            self.stream_error = e
+            self.console.print(f"\n[{self.errwarn}][-] Could not parse the reply while streaming ({e}), it will be parsed when complete.[/{self.errwarn}]")
+            return
+        pending = self.stream_parser.pending
+        if self.stream_parser.in_file or not pending.strip() or pending.startswith("%%") or pending == "%":
+            return
+        self.console.out(pending[self.line_shown:], end="", highlight=False)
+        self.line_shown = len(pending)
+    
+    def _render_items(self, items: list[Operation | str]):
+        for item in items:
+            self.stream_items.append(item)
+            if isinstance(item, str):
+                # 只有最早完成的那一行可能已经显示了一部分
+                self.console.out(item[self.line_shown:], highlight=False)
+                self.line_shown = 0
+            elif item.type not in ("read", "outline", "patch"):
+                self._prepare_op(item)
+    
+    def _discard_changes(self):
+        for temp in self.change_files:
+            if self.change_files[temp][0] in ["create", "edit", "patch"]:
+                os.remove(self.change_files[temp][1])
+        self.asks = {}
+        self.change_files = {}
+    
+    def _generate_runstr(self, cmd: str | list[str]) -> str:
+        cmd_str = cmd if isinstance(cmd, str) else " ".join(cmd)
+        run_s = f"[{self.hint}] {'-' * 20} Execute? ([{self.success}]y[/{self.success}]/[{self.errwarn}]n[/{self.errwarn}]) {'-' * 20}\n"
+        run_s += f"|  {cmd_str.ljust(len(run_s.splitlines()[0]) - 62)}|\n"
+        run_s += f" {'-' * (len(run_s.splitlines()[0]) - 60)}\n"
+        return run_s
+    
+    def _generate_filestr(self, filename: str, change_type: tuple[str, str | None]) -> str:
+        file_s = f"[{self.hint}]{'-' * 20} FileChange? ([{self.success}]y[/{self.success}]/[{self.errwarn}]n[/{self.errwarn}]) {'-' * 20}\n"
+        file_s += f"|  {f'{change_type[0]} {filename}'.ljust(len(file_s.splitlines()[0]) - 64)}|\n"
+        if change_type[0] in ["edit", "create"]:
+            file_s += f"|     └── {change_type[1].ljust(len(file_s.splitlines()[0]) - 71)}|\n"
+        file_s += f" {'-' * (len(file_s.splitlines()[0]) - 60)}\n"
+        return file_s
+    
+    def _generate_patchstr(self, filename: str, diff: str, applied: int, total: int) -> str:
+        patch_s = f"[{self.hint}]{'-' * 20} FileChange? ([{self.success}]y[/{self.success}]/[{self.errwarn}]n[/{self.errwarn}]) {'-' * 20}\n"
+        lines = diff.splitlines()[2:]
+        added = sum(line.startswith("+") for line in lines)
+        removed = sum(line.startswith("-") for line in lines)
+        patch_s += f"|  patch {filename} ({applied}/{total} hunks, +{added} -{removed})\n"
+        styles = {"+": self.success, "-": self.errwarn, "@": self.color}
+        for line in lines[:PATCH_PREVIEW_LINES]:
+            style = styles.get(line[:1])
+            text = rich.markup.escape(line)
+            patch_s += f"|  [{style}]{text}[/{style}]\n" if style else f"|  {text}\n"
+        if len(lines) > PATCH_PREVIEW_LINES:
+            patch_s += f"|  ... {len(lines) - PATCH_PREVIEW_LINES} more lines\n"
+        patch_s += f" {'-' * (len(patch_s.splitlines()[0]) - 60)}\n"
+        return patch_s
+    
+    def _prepare_patch(self, op: Operation):
+        """
+        把 %%patch 的各个 hunk 应用到文件当前的内容上；确认框中显示 diff，被拒绝的 hunk 告诉 AI
+        """
+        relfilename = os.path.basename(op.file.replace("\\", "/"))
+        try:
+            with open(os.path.join(self.whereami, op.file), "r", encoding="utf-8") as f:
+                original = f.read()
+        except (OSError, UnicodeDecodeError) as e:
+            self.console.print(f"[{self.errwarn}][-] PATCH {op.file} rejected: {e}[/{self.errwarn}]")
+            self.ai._add_history("system", f"PATCH {op.file} rejected: cannot read the file ({e})")
+            return
+        hunks = parse_patch(op.content)
+        if not hunks:
+            self.console.print(f"[{self.errwarn}][-] PATCH {op.file} rejected: no hunks found.[/{self.errwarn}]")
+            self.ai._add_history("system", f"PATCH {op.file} rejected: no hunks found, use unified diff (@@) or SEARCH/REPLACE blocks")
+            return
+        result = apply_patch(original, hunks)
+        if result.rejected:
+            report = result.report(op.file)
+            self.console.print(report, style=self.errwarn, markup=False, highlight=False)
+            self.ai._add_history("system", report)
+        if not result.applied or result.text == original:
+            return
+        temp_filename = self.staging.stage(relfilename, result.text)
+        diff = diff_text(relfilename, original, result.text)
+        display_str = self._generate_patchstr(relfilename, diff, len(result.applied), result.total)
+        self.asks[op.file] = (display_str, "file", ("patch", temp_filename))
+        self.change_files[op.file] = ("patch", temp_filename)
     
     def submit_op_prep(self):
-        def _generate_runstr(cmd: str | list[str]) -> str:
-            cmd_str = cmd if isinstance(cmd, str) else " ".join(cmd)
-            run_s = f"[{self.hint}] {'-' * 20} Execute? ([{self.success}]y[/{self.success}]/[{self.errwarn}]n[/{self.errwarn}]) {'-' * 20}\n"
-            run_s += f"|  {cmd_str.ljust(len(run_s.splitlines()[0]) - 62)}|\n"
-            run_s += f" {'-' * (len(run_s.splitlines()[0]) - 60)}\n"
-            return run_s
-        
-        def _generate_filestr(filename: str, change_type: tuple[str, str | None]) -> str:
-            file_s = f"[{self.hint}]{'-' * 20} FileChange? ([{self.success}]y[/{self.success}]/[{self.errwarn}]n[/{self.errwarn}]) {'-' * 20}\n"
-            file_s += f"|  {f'{change_type[0]} {filename}'.ljust(len(file_s.splitlines()[0]) - 64)}|\n"
-            if change_type[0] in ["edit", "create"]:
-                file_s += f"|     └── {change_type[1].ljust(len(file_s.splitlines()[0]) - 71)}|\n"
-            file_s += f" {'-' * (len(file_s.splitlines()[0]) - 60)}\n"
-            return file_s
-        
         self.asks = {}
         self.change_files = {}
-
-        op_counter = 0
+        self.run_hints = {}
+        self.op_counter = 0
+        
+        self.op_errors = []
         
         for op in self.response:
             if isinstance(op, str):
                 self.console.print(op)
             elif isinstance(op, Operation):
-                match op.type:
-                    case "run":
-                        key = f"run_{op_counter}"
-                        display_str = _generate_runstr(op.command)
-                        self.asks[key] = (display_str, "run", op.command)
-                        op_counter += 1
-                    
-                    case "read":
-                        self.ai._add_history("system", "FILE " + op.file + "\n" + FileChanger(op.file).read())
-                    
-                    case "edit":
-                        relfilename = op.file.split("\\")[-1]
-                        temp_filename = f"{self.whereami}\\tempfile{relfilename}"
-                        with open(temp_filename, "w", encoding="utf-8") as f:
-                            f.write(op.content.replace("\\`", "`"))
-                        display_str = _generate_filestr(relfilename, ("edit", temp_filename))
-                        self.asks[op.file] = (display_str, "file", ("edit", temp_filename))
-                        self.change_files[op.file] = ("edit", temp_filename)
-                    
-                    case "delete":
-                        relfilename = op.file.split("\\")[-1]
-                        display_str = _generate_filestr(relfilename, ("delete", None))
-                        self.asks[op.file] = (display_str, "file", ("delete", None))
-                        self.change_files[op.file] = ("delete", None)
-                    
-                    case "create":
-                        relfilename = op.file.split("\\")[-1]
-                        temp_filename = f"{self.whereami}\\tempfile{relfilename}"
-                        with open(temp_filename, "w", encoding="utf-8") as f:
-                            f.write(op.content.replace("\\`", "`"))
-                        display_str = _generate_filestr(relfilename, ("create", temp_filename))
-                        self.asks[op.file] = (display_str, "file", ("create", temp_filename))
-                        self.change_files[op.file] = ("create", temp_filename)
-                    
-                    case "new_dir":
-                        relfilename = op.dir.split("\\")[-1]
-                        display_str = _generate_filestr(relfilename, ("new_dir", op.dir))
-                        self.asks[op.dir] = (display_str, "file", ("new_dir", op.dir))
-                        self.change_files[op.dir] = ("new_dir", op.dir)
-                    
-                    case "rename":
-                        relfilename = op.file.split("\\")[-1]
-                        display_str = _generate_filestr(relfilename, ("rename", op.new_name))
-                        self.asks[op.file] = (display_str, "file", ("rename", op.new_name))
-                        self.change_files[op.file] = ("rename", op.new_name)
+                self._prepare_op(op)
 
+        self._report_op_errors()
         self.ask_for_changes()
+    
+    def _prepare_op(self, op: Operation):
+        """
+        准备一个操作；格式错误或准备失败时只拒绝这一个操作，其余操作照常进行
+        """
+        try:
+            self._prepare(op)
+        except Exception as e:
+            line = op.command if op.type == INVALID else f"%%{op.type} {op.file or op.dir or ''}".rstrip()
+            reason = op.content if op.type == INVALID else f"{type(e).__name__}: {e}"
+            self.console.print(f"[{self.errwarn}][-] Operation rejected: {rich.markup.escape(line)} ({rich.markup.escape(reason)})[/{self.errwarn}]")
+            self.op_errors.append(f"Operation rejected: {line} ({reason})")
+
+    def _report_op_errors(self):
+        """
+        回复写入历史之后，把被拒绝的操作告诉 AI
+        """
+        if self.op_errors:
+            self.ai._add_history("system", "\n".join(self.op_errors))
+            self.op_errors = []
+
+    def _prepare(self, op: Operation):
+        match op.type:
+            case "invalid":
+                raise ValueError(op.content)
+            case "run":
+                key = f"run_{self.op_counter}"
+                display_str = self._generate_runstr(op.command)
+                self.asks[key] = (display_str, "run", op.command)
+                self.run_hints[key] = {k: v for k, v in (op.kwargs or {}).items() if k in HINT_KEYS}
+                self.op_counter += 1
+            
+            case "read":
+                path = os.path.join(self.whereami, op.file)
+                if op.lines is None:
+                    self._add_file_message(op.file, self.file_reader.read(path))
+                else:
+                    # 指定的行直接从磁盘读取，大文件中超出整个文件读取上限的部分也能读到
+                    start, end = op.lines
+                    self._add_file_message(f"{op.file}:{start}-{end}", self.file_reader.read_lines(path, start, end))
+            
+            case "outline":
+                self._add_outlines([(op.file, self.outliner.outline(os.path.join(self.whereami, op.file)))])
+            
+            case "edit":
+                relfilename = op.file.split("\\")[-1]
+                temp_filename = self.staging.stage(relfilename, op.content.replace("\\`", "`"))
+                display_str = self._generate_filestr(relfilename, ("edit", temp_filename))
+                self.asks[op.file] = (display_str, "file", ("edit", temp_filename))
+                self.change_files[op.file] = ("edit", temp_filename)
+            
+            case "patch":
+                self._prepare_patch(op)
+            
+            case "delete":
+                relfilename = op.file.split("\\")[-1]
+                display_str = self._generate_filestr(relfilename, ("delete", None))
+                self.asks[op.file] = (display_str, "file", ("delete", None))
+                self.change_files[op.file] = ("delete", None)
+            
+            case "create":
+                relfilename = op.file.split("\\")[-1]
+                temp_filename = self.staging.stage(relfilename, op.content.replace("\\`", "`"))
+                display_str = self._generate_filestr(relfilename, ("create", temp_filename))
+                self.asks[op.file] = (display_str, "file", ("create", temp_filename))
+                self.change_files[op.file] = ("create", temp_filename)
+            
+            case "new_dir":
+                relfilename = op.dir.split("\\")[-1]
+                display_str = self._generate_filestr(relfilename, ("new_dir", op.dir))
+                self.asks[op.dir] = (display_str, "file", ("new_dir", op.dir))
+                self.change_files[op.dir] = ("new_dir", op.dir)
+            
+            case "rename":
+                relfilename = op.file.split("\\")[-1]
+                display_str = self._generate_filestr(relfilename, ("rename", op.new_name))
+                self.asks[op.file] = (display_str, "file", ("rename", op.new_name))
+                self.change_files[op.file] = ("rename", op.new_name)
 
     def ask_for_changes(self):
         if not self.asks:
             return
+        self._journal_state()
         
         ask_for_all = "-" * 20 + " All Operations " + "-" * 20 + "\n"
         for key in self.asks:
@@ -308,6 +1072,8 @@ class CLI:
                 change_type, change_data = op_data
                 if change_type == "edit":
                     ask_for_all += f"|  FC: edit {key.ljust(len(ask_for_all.splitlines()[0]) - 14)}  |\n"
+                elif change_type == "patch":
+                    ask_for_all += f"|  FC: patch {key.ljust(len(ask_for_all.splitlines()[0]) - 7)}  |\n"
                 elif change_type == "delete":
                     ask_for_all += f"|  FC: delete {key.ljust(len(ask_for_all.splitlines()[0]) - 7)}  |\n"
                 elif change_type == "create":
@@ -324,6 +1090,14 @@ class CLI:
         decision = self.console.input().strip().lower()
         
         keys_to_process = list(self.asks.keys())
+        self.transaction = FileTransaction()
+        self.turn = self.snapshots.begin(self.question_text[:80], self.whereami)
+        try:
+            self._apply_decision(decision, keys_to_process)
+        finally:
+            self._finish_transaction()
+    
+    def _apply_decision(self, decision: str, keys_to_process: list[str]):
         
         match decision:
             case "c":
@@ -331,7 +1105,7 @@ class CLI:
                 self.ai._add_history("system", "All operations canceled by user")
                 self.asks.clear()
                 for temp in self.change_files:
-                    if self.change_files[temp][0] == "create" or self.change_files[temp][0] == "edit":
+                    if self.change_files[temp][0] in ["create", "edit", "patch"]:
                         os.remove(self.change_files[temp][1])
                 self.change_files.clear()
             
@@ -354,7 +1128,7 @@ class CLI:
                     elif confirm == "n":
                         self.console.print(f"[{self.errwarn}][-] Operation canceled.[/{self.errwarn}]")
                         self.ai._add_history("system", f"Operation {key} canceled by user")
-                        if op_type == "create" or op_type == "edit":
+                        if key in self.change_files and self.change_files[key][0] in ["create", "edit", "patch"]:
                             os.remove(self.change_files[key][1])
                         del self.asks[key]
                         if key in self.change_files:
@@ -363,59 +1137,267 @@ class CLI:
                         if op_type == "run":
                             self._run_cmd(op_data)
                         else:
-                            self._change_file(key, op_data)
+                            self._try_change_file(key, op_data)
                         del self.asks[key]
                         if key in self.change_files:
                             del self.change_files[key]
 
+            case _ if self.rules["parallel"] and len(keys_to_process) > 1:
+                self._run_parallel(keys_to_process)
+
             case _:
-                for key in keys_to_process:
-                    if key not in self.asks:
-                        continue
-                    display_str, op_type, op_data = self.asks[key]
-                    if op_type == "run":
-                        self._run_cmd(op_data)
-                    else:
-                        self._change_file(key, op_data)
-                    del self.asks[key]
-                    if key in self.change_files:
-                        del self.change_files[key]
+                self._run_sequential(keys_to_process)
+
+    def _plan(self, keys: list[str]) -> list[Task]:
+        return plan_dependencies([Task(key, self.asks[key][1], self.asks[key][2], self.run_hints.get(key, {}))
+                                  for key in keys if key in self.asks])
+
+    def _report_skipped(self, task: Task, tasks: list[Task], dep: int):
+        """
+        报告因依赖失败而跳过的操作，并删除它的暂存文件
+        """
+        self.console.print(f"[{self.hint}][!] {task.label} skipped, [{dep}] {tasks[dep].label} {tasks[dep].status}.[/{self.hint}]")
+        self.ai._add_history("system", f"Operation {task.key} skipped because {tasks[dep].key} {tasks[dep].status}")
+        if task.op_type == "file" and task.op_data[0] in ["edit", "create", "patch"] and os.path.exists(task.op_data[1]):
+            os.remove(task.op_data[1])
+
+    def _run_sequential(self, keys: list[str]):
+        """
+        按原顺序逐个执行；跳过的规则与并发执行相同 (见 scheduler.blocked_by)
+        """
+        tasks = self._plan(keys)
+        for task in tasks:
+            dep = blocked_by(task, tasks)
+            if dep is not None:
+                task.status = "skipped"
+                self._report_skipped(task, tasks, dep)
+            elif task.op_type == "run":
+                task.result = self._exec_cmd(task.op_data)
+                self._report_cmd(task.result)
+                task.status = "done" if task.result.returncode == 0 else "failed"
+            else:
+                try:
+                    self._change_file(task.key, task.op_data)
+                    task.status = "done"
+                except Exception as e:
+                    task.error, task.status = e, "failed"
+                    self.console.print(f"[{self.errwarn}][-] {task.op_data[0]} {task.key}: {e}[/{self.errwarn}]")
+            del self.asks[task.key]
+            self.change_files.pop(task.key, None)
+            self.run_hints.pop(task.key, None)
+
+    def _run_parallel(self, keys: list[str]):
+        """
+        没有依赖关系的操作并发执行，实时显示每个操作的状态，结束后按原顺序报告结果
+        """
+        tasks = self._plan(keys)
+        from rich.live import Live
+        from rich.table import Table
+        styles = {"pending": "dim", "running": self.hint, "done": self.success, "failed": self.errwarn, "skipped": "dim"}
+
+        def table() -> Table:
+            view = Table(title=f"{len(tasks)} operations, {self.scheduler.workers} workers")
+            view.add_column("#", justify="right")
+            view.add_column("Operation")
+            view.add_column("Status")
+            view.add_column("Time", justify="right")
+            for i, task in enumerate(tasks):
+                duration = task.duration
+                view.add_row(str(i), task.label, f"[{styles[task.status]}]{task.status}[/{styles[task.status]}]",
+                             f"{duration:.2f}s" if duration is not None else "")
+            return view
+
+        def execute(task: Task):
+            if task.op_type == "run":
+                # 并发执行时每行输出前加上操作编号；可能与其他命令同时执行的命令不读取终端的输入
+                return self._exec_cmd(task.op_data, prefix=f"[{tasks.index(task)}] ",
+                                      interactive=task.hints.get("independent") is not True)
+            self._change_file(task.key, task.op_data)
+
+        def failed(task: Task) -> bool:
+            return task.error is not None or (task.op_type == "run" and task.result.returncode != 0)
+
+        with Live(table(), console=self.console, refresh_per_second=10) as live:
+            self.scheduler.run(tasks, execute, failed, on_update=lambda _: live.update(table()))
+
+        for task in tasks:
+            if task.callback_error is not None:
+                self.console.print(f"[{self.errwarn}][-] {task.label}: display error {task.callback_error}[/{self.errwarn}]")
+            if task.status == "skipped":
+                self._report_skipped(task, tasks, blocked_by(task, tasks))
+            elif task.op_type == "run":
+                self._report_cmd(task.result)
+            elif task.error is not None:
+                self.console.print(f"[{self.errwarn}][-] {task.label}: {task.error}[/{self.errwarn}]")
+            del self.asks[task.key]
+            self.change_files.pop(task.key, None)
+            self.run_hints.pop(task.key, None)
 
     def _run_cmd(self, cmd: str | list[str]):
-        result = self.command_executor.execute(cmd, cwd=self.whereami)
-        if result.returncode == 0:
-            output = result.stdout if result.stdout else "Done"
-            self.console.print(f"[{self.success}][+] {output}[/{self.success}]")
+        self._report_cmd(self._exec_cmd(cmd))
+
+    def _exec_cmd(self, cmd: str | list[str], prefix: str = "", interactive: bool = True) -> CommandResult:
+        def show(stream: str, line: str):
+            style = self.errwarn if stream == "stderr" else None
+            self.console.print(prefix + line.rstrip("\n"), style=style, markup=False, highlight=False)
+
+        cmd_str = cmd if isinstance(cmd, str) else " ".join(cmd)
+        if self.command_executor.session is not None:
+            # 持久 shell 中的 cd、export 等会保留，命令结束后跟随 shell 的工作目录
+            result = self.command_executor.stream(cmd, on_line=show, cwd=self.whereami)
+            if result.cwd and result.cwd != self.whereami:
+                self.cwd_manager.whereami = self.whereami = result.cwd
+            self.project_viewer.mark_dirty()
+            return result
+        if cmd_str.strip() == "cd" or cmd_str.startswith(("cd ", "cd..")):
+            # 子进程中的 cd 不会影响之后的命令，这里直接切换工作目录
+            self.cwd_manager.whereami = self.whereami
+            self.cwd_manager.parse_cd(cmd_str.strip())
+            if self.cwd_manager.err:
+                err, self.cwd_manager.err = self.cwd_manager.err, None
+                return CommandResult(success=False, returncode=1, stderr=err)
+            self.whereami = self.cwd_manager.whereami
+            show("stdout", f"cwd: {self.whereami}")
+            return CommandResult(success=True, returncode=0, stdout=f"cwd: {self.whereami}")
+        # 输出实时显示，结果中只保留开头和结尾
+        result = self.command_executor.stream(cmd, on_line=show, cwd=self.whereami, interactive=interactive)
+        self.project_viewer.mark_dirty()
+        return result
+
+    def _report_cmd(self, result: CommandResult):
+        summary = f"{result.duration or 0:.2f}s, {result.bytes_out} bytes"
+        if result.lines_dropped:
+            summary += f", {result.lines_dropped} lines not kept"
+        if result.success:
+            self.console.print(f"[{self.success}][+] Done ({summary})[/{self.success}]")
+            return
+        # 输出已经实时显示过，这里只说明失败原因
+        if result.timed_out or (not result.bytes_out and result.stderr):
+            reason = result.stderr.strip().splitlines()[-1]
+        elif result.error is not None and not result.bytes_out:
+            reason = str(result.error)
         else:
-            self.console.print(f"[{self.errwarn}][-] {result.stderr}[/{self.errwarn}]")
+            reason = f"Exit code {result.returncode}"
+        self.console.print(f"[{self.errwarn}][-] {reason} ({summary})[/{self.errwarn}]")
 
     def _change_file(self, file: str, change_type_data: tuple[str, str | None]):
         change_type, change_data = change_type_data
+        self.project_viewer.mark_dirty()
+        if self.transaction is None:
+            self.transaction = FileTransaction()
+        path = os.path.join(self.whereami, file)
+        changer = FileChanger(path, self.transaction)
         
-        match change_type:
-            case "edit" | "create":
-                with open(change_data, "r", encoding="utf-8") as f:
-                    content = f.read()
-                FileChanger(file).rewrite(content)
-                if os.path.exists(change_data):
-                    os.remove(change_data)
-            
-            case "delete":
-                FileChanger(file).delete()
-            
-            case "new_dir":
-                os.makedirs(os.path.join(self.whereami, change_data), exist_ok=True)
-            
-            case "rename":
-                FileChanger(file).rename(change_data)
+        try:
+            if self.turn is not None:
+                # 修改之前记录涉及的路径原来的状态
+                if change_type == "new_dir":
+                    touched = [os.path.join(self.whereami, change_data)]
+                elif change_type == "rename":
+                    touched = [path, os.path.join(os.path.dirname(path), change_data)]
+                else:
+                    touched = [path]
+                self.snapshots.capture(self.turn, touched, change_type)
+            match change_type:
+                case "edit" | "create" | "patch":
+                    changer.replace(change_data)
+                
+                case "delete":
+                    changer.delete()
+                
+                case "new_dir":
+                    self.transaction.mkdir(os.path.join(self.whereami, change_data))
+                
+                case "rename":
+                    # 新名字不是绝对路径时相对于原文件所在的目录
+                    changer.rename(os.path.join(os.path.dirname(path), change_data))
+        except Exception as e:
+            self.transaction.failed.append((file, e))
+            raise
+    
+    def _try_change_file(self, file: str, change_type_data: tuple[str, str | None]):
+        try:
+            self._change_file(file, change_type_data)
+        except Exception as e:
+            self.console.print(f"[{self.errwarn}][-] {change_type_data[0]} {file}: {e}[/{self.errwarn}]")
+    
+    def _finish_transaction(self):
+        """
+        本轮的文件操作全部成功时提交；有任何一个失败时撤销这一轮已经做过的所有文件修改
+        """
+        transaction, self.transaction = self.transaction, None
+        turn, self.turn = self.turn, None
+        if transaction is None:
+            return
+        if not transaction.failed:
+            transaction.commit()
+            if turn is not None and turn.entries:
+                self.snapshots.finish(turn)
+                # 压缩入库在后台完成，不影响下一次提问
+                self.snapshot_future = async_runtime.in_thread(self.snapshots.ingest, turn)
+            return
+        if turn is not None:
+            self.snapshots.abandon(turn)
+        errors = transaction.rollback()
+        failed = ", ".join(f"{file} ({e})" for file, e in transaction.failed)
+        self.console.print(f"[{self.errwarn}][-] File operations failed: {failed}. "
+                           f"All file changes of this round were rolled back.[/{self.errwarn}]")
+        for error in errors:
+            self.console.print(f"[{self.errwarn}][-] Could not roll back {error}[/{self.errwarn}]")
+        self.ai._add_history("system", f"File operations failed: {failed}. All file changes of this round were rolled back")
+        self.project_viewer.mark_dirty()
     
     def update(self):
         self.ques, self.response = None, None
-        self.project_viewer = ProjectContexter(self.whereami)
-        self.after_question = self.project_viewer.display_project_context()
+        self.project_viewer.current_path = self.whereami
+        # 在后台重新构建上下文，用户输入的同时完成，真正提问时再等待
+        self.context_future = async_runtime.submit(self._refresh_context(self.context_future))
+        if self.rules["retrieve"]:
+            # 等新的文件树建好后再更新索引，提问时不等待索引
+            self.index_future = async_runtime.submit(self._refresh_index(self.context_future))
         self.change_files = {}
+        self._journal_state()
+    
+    def _first_context(self):
+        with startup_profile.measure("project context"):
+            self.project_viewer.look_around()
 
-    def run(self, working: bool = True):
+    async def _refresh_context(self, previous):
+        import asyncio
+        if previous is not None:
+            try:
+                await asyncio.wrap_future(previous)
+            except Exception:
+                pass
+        await asyncio.to_thread(self.project_viewer.look_around)
+    
+    def _wait_context(self) -> str:
+        if self.context_future is not None:
+            self.context_future.result()
+            self.context_future = None
+            self.after_question = self.project_viewer.display_project_context()
+        return self.after_question
+
+    def _show_startup_profile(self):
+        from rich.table import Table
+        profile = startup_profile.report()
+        table = Table(title="Startup profile")
+        table.add_column("Phase")
+        table.add_column("Start ms", justify="right")
+        table.add_column("Duration ms", justify="right")
+        if profile["interpreter"] is not None:
+            table.add_row("python interpreter (approx.)", "", f"{profile['interpreter'] * 1000:.0f}")
+        for name, start, duration, background in profile["phases"]:
+            table.add_row(name + (" (background)" if background else ""), f"{start * 1000:.1f}", f"{duration * 1000:.1f}")
+        self.console.print(table)
+        pending = [name for name, future in (("project context", self.context_future), ("search index", self.index_future))
+                   if future is not None and not future.done()]
+        total = profile["total"] + (profile["interpreter"] or 0)
+        self.console.print(f"[{self.hint}][*] First prompt after {total * 1000:.0f} ms"
+                           + (f", still running in background: {', '.join(pending)}" if pending else "")
+                           + f"[/{self.hint}]")
+
+    def run(self, working: bool = True, profile_startup: bool = False):
         ASCIItext = r"""
   _____                          _                              ____   _       ___ 
  |  ___|   ___    _   _   _ __  | |_    ___    ___   _ __      / ___| | |     |_ _|
@@ -424,6 +1406,9 @@ class CLI:
  |_|      \___/   \__,_| |_|     \__|  \___|  \___| |_| |_|    \____| |_____| |___|
 """
         self.console.print(f"[{self.color}]" + ASCIItext + f"[/{self.color}]")
+        startup_profile.mark("banner")
+        if profile_startup:
+            self._show_startup_profile()
         while working:
             try:
                 self.question()
@@ -433,5 +1418,25 @@ class CLI:
                 raise e
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AI command line interface")
+    parser.add_argument("--resume", nargs="?", const="latest", metavar="JOURNAL",
+                        help="resume the latest session, or the session journal at JOURNAL")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="print how long each import and initialization step took before the first prompt")
+    args = parser.parse_args()
     cli = CLI()
-    cli.run(True)
+    # AI_JOURNAL=0 时不记录会话
+    if os.environ.get("AI_JOURNAL", "1").lower() not in ["false", "0"]:
+        session_directory = os.environ.get("AI_SESSION_DIR") or SESSION_DIRECTORY
+        path = SessionJournal.latest(session_directory) if args.resume == "latest" else args.resume
+        if args.resume and path is None:
+            cli.console.print(f"[{cli.errwarn}][-] No session to resume in {session_directory}[/{cli.errwarn}]")
+        if args.resume and path is not None:
+            cli.resume_journal(SessionJournal(path))
+        else:
+            cli.start_journal(SessionJournal.create(session_directory))
+        async_runtime.in_thread(SessionJournal.prune, session_days * 24 * 3600, session_directory, cli.journal.path)
+    elif args.resume:
+        cli.console.print(f"[{cli.errwarn}][-] --resume needs the session journal, which is disabled by AI_JOURNAL[/{cli.errwarn}]")
+    startup_profile.mark("session journal")
+    cli.run(True, profile_startup=args.profile_startup)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+符号大纲组件
+=======================
+说明：
+    提取源文件的结构：类、函数及其签名、所在行号和文档字符串的第一行，代替完整内容发给 AI。
+    AI 先用 %%outline 看文件的结构，再用 %%read <file> <起始行>-<结束行> 只读取需要的部分。
+    Python 文件用 ast 解析；其他语言通过 register() 按扩展名注册提取函数，这里自带了 JS/TS 和 Go 的正则版本。
+    结果按 (路径, 大小, mtime_ns) 缓存，多个文件在线程池中并行提取。
+    工作状态: Done
+"""
+import ast
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable
+
+
+@dataclass
+class Symbol:
+    kind: str
+    name: str
+    signature: str
+    line: int
+    end: int
+    doc: str = ""
+    # 嵌套层数，方法为 1
+    depth: int = 0
+
+
+@dataclass
+class Outline:
+    path: str
+    symbols: list[Symbol] = field(default_factory=list)
+    lines: int = 0
+    error: str | None = None
+    cached: bool = False
+
+
+# 扩展名 -> 提取函数 (源码 -> 符号列表)
+OUTLINERS: dict[str, Callable[[str], list[Symbol]]] = {}
+
+
+def register(*extensions: str):
+    """
+    注册某些扩展名的提取函数，提取函数接收源码字符串，返回按行号排序的 Symbol 列表
+    """
+    def decorator(func):
+        for extension in extensions:
+            OUTLINERS[extension.lower()] = func
+        return func
+    return decorator
+
+
+def _first_line(doc: str | None) -> str:
+    return doc.strip().splitlines()[0].strip() if doc and doc.strip() else ""
+
+
+@register(".py", ".pyw", ".pyi")
+def outline_python(source: str) -> list[Symbol]:
+    symbols = []
+
+    def visit(body: list[ast.stmt], depth: int):
+        for node in body:
+            decorators = "".join(f"@{ast.unparse(d)} " for d in getattr(node, "decorator_list", []))
+            if isinstance(node, ast.ClassDef):
+                bases = ", ".join(ast.unparse(base) for base in node.bases + node.keywords)
+                signature = f"{decorators}class {node.name}" + (f"({bases})" if bases else "")
+                symbols.append(Symbol("class", node.name, signature, node.lineno, node.end_lineno,
+                                      _first_line(ast.get_docstring(node)), depth))
+                visit(node.body, depth + 1)
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                prefix = "async def" if isinstance(node, ast.AsyncFunctionDef) else "def"
+                returns = f" -> {ast.unparse(node.returns)}" if node.returns else ""
+                signature = f"{decorators}{prefix} {node.name}({ast.unparse(node.args)}){returns}"
+                symbols.append(Symbol("method" if depth else "function", node.name, signature, node.lineno,
+                                      node.end_lineno, _first_line(ast.get_docstring(node)), depth))
+            elif isinstance(node, (ast.If, ast.Try)) and depth == 0:
+                # if TYPE_CHECKING / try: import ... 中定义的符号也算模块级
+                visit(node.body, depth)
+
+    visit(ast.parse(source).body, 0)
+    return symbols
+
+
+def _regex_outliner(patterns: list[tuple[str, re.Pattern]]) -> Callable[[str], list[Symbol]]:
+    """
+    按行匹配的简单提取函数：只给出符号所在行，结束行按下一个同级符号估计
+    """
+    def outline(source: str) -> list[Symbol]:
+        symbols = []
+        lines = source.splitlines()
+        for number, line in enumerate(lines, 1):
+            for kind, pattern in patterns:
+                match = pattern.match(line)
+                if match:
+                    depth = 1 if line[:1].isspace() else 0
+                    symbols.append(Symbol(kind, match.group("name"), line.strip().rstrip("{").strip(),
+                                          number, number, depth=depth))
+                    break
+        for i, symbol in enumerate(symbols):
+            following = [s.line - 1 for s in symbols[i + 1:] if s.depth <= symbol.depth]
+            symbol.end = following[0] if following else len(lines)
+        return symbols
+    return outline
+
+
+register(".js", ".jsx", ".mjs", ".cjs", ".ts", ".tsx")(_regex_outliner([
+    ("class", re.compile(r"\s*(?:export\s+)?(?:default\s+)?(?:abstract\s+)?class\s+(?P<name>[\w$]+)")),
+    ("interface", re.compile(r"\s*(?:export\s+)?(?:interface|type)\s+(?P<name>[\w$]+)")),
+    ("function", re.compile(r"\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*(?P<name>[\w$]+)")),
+    ("function", re.compile(r"\s*(?:export\s+)?(?:const|let)\s+(?P<name>[\w$]+)\s*=\s*(?:async\s+)?(?:\([^)]*\)|[\w$]+)\s*=>")),
+    ("method", re.compile(r"\s+(?:public\s+|private\s+|protected\s+|static\s+|async\s+)*(?P<name>(?!if\b|for\b|while\b|switch\b|catch\b)[\w$]+)\s*\([^)]*\)\s*(?::[^{]+)?\{\s*$")),
+]))
+
+register(".go")(_regex_outliner([
+    ("function", re.compile(r"func\s+(?:\([^)]*\)\s*)?(?P<name>\w+)")),
+    ("type", re.compile(r"type\s+(?P<name>\w+)")),
+]))
+
+
+def render(outline: Outline, name: str | None = None) -> str:
+    """
+    大纲的文本形式：每个符号一行，行号范围在前，方法缩进
+    """
+    header = f"{name or outline.path} ({outline.lines} 行, {len(outline.symbols)} 个符号)"
+    if outline.error:
+        return f"{header}\n  [无法提取: {outline.error}]"
+    rows = [header]
+    width = len(str(outline.lines)) * 2 + 2
+    for symbol in outline.symbols:
+        doc = f"  # {symbol.doc}" if symbol.doc else ""
+        rows.append(f"  L{f'{symbol.line}-{symbol.end}':<{width}} {'    ' * symbol.depth}{symbol.signature}{doc}")
+    return "\n".join(rows)
+
+
+class Outliner:
+    def __init__(self, max_file_bytes: int = 1024 * 1024, workers: int | None = None):
+        """
+        Args:
+            max_file_bytes: 超过该大小的文件不提取
+            workers: 线程数
+        """
+        self.max_file_bytes = max_file_bytes
+        self.workers = workers or min(16, (os.cpu_count() or 1) + 4)
+        # 路径 -> (大小, mtime_ns, Outline)
+        self._cache: dict[str, tuple[int, int, Outline]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def supports(path: str) -> bool:
+        return os.path.splitext(path)[1].lower() in OUTLINERS
+
+    def outline(self, path: str) -> Outline:
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            return Outline(path, error=e.strerror or str(e))
+        with self._lock:
+            entry = self._cache.get(path)
+        if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+            cached = entry[2]
+            return Outline(path, cached.symbols, cached.lines, cached.error, cached=True)
+        result = self._extract(path, stat.st_size)
+        with self._lock:
+            self._cache[path] = (stat.st_size, stat.st_mtime_ns, result)
+        return result
+
+    def outline_many(self, paths: list[str]) -> tuple[list[Outline], float]:
+        """
+        并行提取多个文件 (不支持的扩展名跳过)，返回结果和耗时
+        """
+        start = time.perf_counter()
+        paths = [path for path in paths if self.supports(path)]
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="aicli-outline") as pool:
+            results = list(pool.map(self.outline, paths))
+        return results, time.perf_counter() - start
+
+    def _extract(self, path: str, size: int) -> Outline:
+        outliner = OUTLINERS.get(os.path.splitext(path)[1].lower())
+        if outliner is None:
+            return Outline(path, error="unsupported file type")
+        if size > self.max_file_bytes:
+            return Outline(path, error=f"larger than {self.max_file_bytes} bytes")
+        try:
+            with open(path, "rb") as f:
+                source = f.read().decode("utf-8", errors="replace")
+        except OSError as e:
+            return Outline(path, error=e.strerror or str(e))
+        lines = len(source.splitlines())
+        try:
+            symbols = outliner(source)
+        except (SyntaxError, ValueError, RecursionError) as e:
+            return Outline(path, lines=lines, error=f"{type(e).__name__}: {e}")
+        return Outline(path, symbols, lines)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
@@ -23,35 +23,80 @@ class Operation:
     new_name: str = None
     dir: str = None
     language: str = None
+    # %%read <file> <起始行>-<结束行> 的行号范围 (从 1 开始，包含两端)
+    lines: tuple[int, int] = None
 
-def parse_ai_response(response: str) -> list[Operation | str]:
-    parts = response.split("\n")
-    ops = []
-    edit = False
-    create = False
-    in_block = False
-    language = None
-    contents = []
-    file = None
-    for line in parts:
-        if edit or create:
+# 格式错误的操作行 (例如 %%rename 缺少新名字) 解析为 type=INVALID 的操作：command 为原来的行，content 为原因
+INVALID = "invalid"
+
+class StreamParser:
+    """
+    增量解析器：可以一段一段地喂入AI回复 (例如流式输出的片段)，
+    每当一行文字或一个操作完整时就立即返回，不必等整段回复结束。
+    按行处理，跨片段的 [file_start ...] / [file_end] 等行会先缓存起来，
+    所以对同一段回复，无论怎样切分，结果都与 parse_ai_response 相同。
+    """
+    def __init__(self):
+        self.pending = ""
+        self.edit = False
+        self.create = False
+        self.patch = False
+        self.in_block = False
+        self.language = None
+        self.contents = []
+        self.file = None
+
+    @property
+    def in_file(self) -> bool:
+        """
+        是否处于 %%edit / %%create / %%patch 与 [file_end] 之间
+        """
+        return self.edit or self.create or self.patch
+
+    def feed(self, chunk: str) -> list[Operation | str]:
+        """
+        喂入一段文本，返回其中已经完整的文字行和操作
+        """
+        *lines, self.pending = (self.pending + chunk).split("\n")
+        ops = []
+        for line in lines:
+            self._feed_checked(line, ops)
+        return ops
+
+    def close(self) -> list[Operation | str]:
+        """
+        回复结束，处理最后一行
+        """
+        ops = []
+        line, self.pending = self.pending, ""
+        self._feed_checked(line, ops)
+        return ops
+
+    def _feed_checked(self, line: str, ops: list[Operation | str]) -> None:
+        try:
+            self._feed_line(line, ops)
+        except (IndexError, ValueError) as e:
+            ops.append(Operation(type=INVALID, command=line, content=f"{type(e).__name__}: {e}"))
+
+    def _feed_line(self, line: str, ops: list[Operation | str]) -> None:
+        if self.in_file:
             if line.startswith("[file_start"):
-                language = line.split(" ")[1][:-1]
-                in_block = True
-                continue
+                self.language = line.split(" ")[1][:-1]
+                self.in_block = True
+                return
             if line == "[file_end]":
-                in_block = False
+                self.in_block = False
                 ops.append(Operation(
-                    type="edit" if edit else "create",
-                    file=file,
-                    content="\n".join(contents).replace("[file_end]", ""),
-                    language=language
+                    type="edit" if self.edit else "create" if self.create else "patch",
+                    file=self.file,
+                    content="\n".join(self.contents).replace("[file_end]", ""),
+                    language=self.language
                 ))
-                contents = []; create, edit = False, False
-                continue
-            if in_block:
-                contents.append(line)
-                continue 
+                self.contents = []; self.create, self.edit, self.patch = False, False, False
+                return
+            if self.in_block:
+                self.contents.append(line)
+                return 
 
         elif line.startswith("%%"):
             _op, *args = line.split(" ")
@@ -74,51 +119,141 @@ def parse_ai_response(response: str) -> list[Operation | str]:
                         command=cmd,
                         kwargs=kwargs
                     ))
-                    continue
+                    return
                 case "%%read":
-                    file = args[0]
+                    self.file = args[0]
+                    start, _, end = args[1].partition("-") if len(args) > 1 else ("", "", "")
                     ops.append(Operation(
                         type="read",
-                        file=file
+                        file=self.file,
+                        lines=(int(start), int(end)) if start.isdigit() and end.isdigit() else None
                     ))
-                    continue
+                    return
+                case "%%outline":
+                    self.file = args[0]
+                    ops.append(Operation(
+                        type="outline",
+                        file=self.file
+                    ))
+                    return
                 case "%%edit":
-                    file = args[0]
-                    edit = True
-                    continue
+                    self.file = args[0]
+                    self.edit = True
+                    return
                 case "%%create":
-                    file = args[0]
-                    create = True
-                    continue
+                    self.file = args[0]
+                    self.create = True
+                    return
+                case "%%patch":
+                    self.file = args[0]
+                    self.patch = True
+                    return
                 case "%%delete":
-                    file = args[0]
+                    self.file = args[0]
                     ops.append(Operation(
                         type="delete",
-                        file=file
+                        file=self.file
                     ))
-                    continue
+                    return
                 case "%%new_dir":
                     dir = args[0]
                     ops.append(Operation(
                         type="new_dir",
                         dir=dir
                     ))
-                    continue
+                    return
                 case "%%rename":
-                    file = args[0]
+                    self.file = args[0]
                     new_name = args[1]
                     ops.append(Operation(
                         type="rename",
-                        file=file,
+                        file=self.file,
                         new_name=new_name
                     ))
-                    continue
+                    return
 
-        if not (edit or create or in_block) and line.strip():
+        if not (self.in_file or self.in_block) and line.strip():
             ops.append(line)
-    return ops
+
+
+def parse_ai_response(response: str) -> list[Operation | str]:
+    parser = StreamParser()
+    return parser.feed(response) + parser.close()
 
 if __name__ == "__main__":
+    import random
+
+    def batch_parse(response: str) -> list[Operation | str]:
+        """
+        整段解析的参照实现：StreamParser 之前的逐行循环 (加上之后新增的 %%patch、%%outline 和 %%read 行号)，
+        与 StreamParser 分开维护，用来检查增量解析
+        """
+        ops = []
+        edit = create = patch = in_block = False
+        language = file = None
+        contents = []
+        for line in response.split("\n"):
+            if edit or create or patch:
+                if line.startswith("[file_start"):
+                    language = line.split(" ")[1][:-1]
+                    in_block = True
+                    continue
+                if line == "[file_end]":
+                    in_block = False
+                    ops.append(Operation(type="edit" if edit else "create" if create else "patch", file=file,
+                                         content="\n".join(contents).replace("[file_end]", ""), language=language))
+                    contents = []; edit = create = patch = False
+                    continue
+                if in_block:
+                    contents.append(line)
+                    continue
+            elif line.startswith("%%"):
+                _op, *args = line.split(" ")
+                match _op:
+                    case "%%run":
+                        cmd, kwargs = [], {}
+                        for cmdpart in args:
+                            if "=" in cmdpart:
+                                key, value = cmdpart.split("=")
+                                if key.startswith("["): key = key[1:]
+                                if value.endswith("]"): value = value[:-1]
+                                if value.endswith(","): value = value[:-1]
+                                if value.isdigit(): value = int(value)
+                                if value == "True": value = True
+                                if value == "False": value = False
+                                kwargs[key] = value
+                            else: cmd.append(cmdpart)
+                        ops.append(Operation(type="run", command=cmd, kwargs=kwargs))
+                        continue
+                    case "%%read":
+                        file = args[0]
+                        start, _, end = args[1].partition("-") if len(args) > 1 else ("", "", "")
+                        ops.append(Operation(type="read", file=file,
+                                             lines=(int(start), int(end)) if start.isdigit() and end.isdigit() else None))
+                        continue
+                    case "%%outline":
+                        file = args[0]
+                        ops.append(Operation(type="outline", file=file))
+                        continue
+                    case "%%edit" | "%%create" | "%%patch":
+                        file = args[0]
+                        edit, create, patch = _op == "%%edit", _op == "%%create", _op == "%%patch"
+                        continue
+                    case "%%delete":
+                        file = args[0]
+                        ops.append(Operation(type="delete", file=file))
+                        continue
+                    case "%%new_dir":
+                        ops.append(Operation(type="new_dir", dir=args[0]))
+                        continue
+                    case "%%rename":
+                        file = args[0]
+                        ops.append(Operation(type="rename", file=file, new_name=args[1]))
+                        continue
+            if not (edit or create or patch or in_block) and line.strip():
+                ops.append(line)
+        return ops
+
     test = """
 %%create hello.md
 [file_start markdown]
@@ -127,4 +262,28 @@ rm -rf /
 ```
 [file_end]
 """
-    print(parse_ai_response(test))
\ No newline at end of file
+    print(parse_ai_response(test))
+
+    # 随机切分同一段回复，增量解析的结果必须与整段解析的参照实现一致
+    pieces = ["%%run echo hi check=False", "%%read C:\\a.py", "%%read C:\\a.py 10-40", "%%outline C:\\a.py",
+              "%%edit C:\\b.py", "%%create C:\\c.py", "%%patch C:\\h.py", "@@ -1,2 +1,2 @@", "-old", "+new",
+              "[file_start python]", "[file_end]", "%%delete C:\\d.py", "%%new_dir C:\\e",
+              "%%rename C:\\f.py g.py", "%%unknown x", "print('%%run')", "plain text", "", "   "]
+    rng = random.Random(0)
+    for _ in range(2000):
+        response = "\n".join(rng.choice(pieces) for _ in range(rng.randint(0, 30)))
+        expected = batch_parse(response)
+        assert parse_ai_response(response) == expected, response
+        cuts = sorted(rng.sample(range(len(response) + 1), min(len(response) + 1, rng.randint(0, 10))))
+        parser, got, last = StreamParser(), [], 0
+        for cut in cuts + [len(response)]:
+            got += parser.feed(response[last:cut])
+            last = cut
+        got += parser.close()
+        assert got == expected, (response, cuts)
+    print("StreamParser == batch parser on 2000 random splits")
+
+    # 格式错误的操作行只影响这一行
+    ops = parse_ai_response("before\n%%rename C:\\a.py\n%%delete C:\\b.py\nafter")
+    assert [getattr(op, "type", op) for op in ops] == ["before", INVALID, "delete", "after"], ops
+    print("malformed operation lines become INVALID operations")
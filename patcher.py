@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+补丁组件
+=======================
+说明：
+    %%patch 只包含要修改的片段，不必像 %%edit 那样重新输出整个文件，这里负责解析和应用这些片段 (hunk)。
+    支持两种格式：unified diff (@@ -a,b +c,d @@，行首为空格/-/+)，以及
+    <<<<<<< SEARCH / ======= / >>>>>>> REPLACE 的查找替换块。
+    每个 hunk 依次尝试：精确匹配 -> 忽略空白匹配 -> 去掉最外侧的上下文行 (fuzz，仅 unified diff)
+    -> 相似度足够高的唯一位置；多处匹配时取离 @@ 行号最近的一处，没有行号时拒绝。
+    匹配不到的 hunk 会被拒绝并给出最接近的位置和相似度，其余 hunk 照常应用。
+    工作状态: Done
+"""
+import difflib
+import re
+from dataclasses import dataclass, field
+
+SEARCH_MARK = "<<<<<<< SEARCH"
+DIVIDER = "======="
+REPLACE_MARK = ">>>>>>> REPLACE"
+_HEADER = re.compile(r"@@ -(\d+)(?:,(\d+))? \+\d+(?:,\d+)? @@")
+
+
+@dataclass
+class Hunk:
+    old: list[str]
+    new: list[str]
+    # @@ 中的原始行号 (从 1 开始)，查找替换块没有
+    line: int | None = None
+    # 开头、结尾未改动的上下文行数
+    leading: int = 0
+    trailing: int = 0
+
+
+@dataclass
+class Rejection:
+    index: int
+    reason: str
+    hunk: Hunk
+    # 最接近的位置 (从 1 开始) 及其相似度
+    near: int | None = None
+    similarity: float = 0.0
+
+
+@dataclass
+class PatchResult:
+    text: str
+    # (hunk 编号, 应用到的行号, 匹配方式)
+    applied: list[tuple[int, int, str]] = field(default_factory=list)
+    rejected: list[Rejection] = field(default_factory=list)
+    total: int = 0
+
+    def report(self, name: str) -> str:
+        """
+        被拒绝的 hunk 的说明，会原样发给 AI 以便重新生成
+        """
+        rows = [f"PATCH {name}: {len(self.applied)}/{self.total} hunks applied, {len(self.rejected)} rejected"]
+        for rejection in self.rejected:
+            near = f"; closest match at line {rejection.near} ({rejection.similarity:.0%} similar)" if rejection.near else ""
+            rows.append(f"- hunk {rejection.index + 1}: {rejection.reason}{near}")
+            rows.extend(f"    {line}" for line in rejection.hunk.old[:8])
+            if len(rejection.hunk.old) > 8:
+                rows.append(f"    ... ({len(rejection.hunk.old) - 8} more lines)")
+        return "\n".join(rows)
+
+
+def parse_patch(text: str) -> list[Hunk]:
+    """
+    解析 unified diff 或查找替换块，格式无法识别时返回空列表
+    """
+    lines = text.splitlines()
+    if any(line.startswith(SEARCH_MARK) for line in lines):
+        return _parse_search_replace(lines)
+    if any(line.startswith("@@") for line in lines):
+        return _parse_unified(lines)
+    return []
+
+
+def _parse_search_replace(lines: list[str]) -> list[Hunk]:
+    hunks, old, new, state = [], [], [], None
+    for line in lines:
+        if line.startswith(SEARCH_MARK):
+            old, new, state = [], [], "old"
+        elif line.startswith(DIVIDER) and state == "old":
+            state = "new"
+        elif line.startswith(REPLACE_MARK) and state == "new":
+            hunks.append(Hunk(old, new))
+            state = None
+        elif state == "old":
+            old.append(line)
+        elif state == "new":
+            new.append(line)
+    return hunks
+
+
+def _file_header(lines: list[str], i: int) -> bool:
+    """
+    第一个 @@ 之后的 lines[i] 是否属于 ---/+++ 文件头：只有紧跟着 @@ 的一对 --- 和 +++ 行才是 (多个文件的 diff)；
+    hunk 中删除 "-- 注释"、YAML 的 "---" 等内容的行也以 --- 开头，不能当成文件头
+    """
+    line = lines[i]
+    if line.startswith("---"):
+        return i + 1 < len(lines) and lines[i + 1].startswith("+++") and _file_header(lines, i + 1)
+    return line.startswith("+++") and i > 0 and lines[i - 1].startswith("---") and (
+        i + 1 == len(lines) or lines[i + 1].startswith("@@"))
+
+
+def _parse_unified(lines: list[str]) -> list[Hunk]:
+    hunks, current = [], None
+    for i, line in enumerate(lines):
+        header = _HEADER.match(line)
+        if line.startswith("@@"):
+            current = Hunk([], [], int(header.group(1)) if header else None)
+            if header and header.group(2) == "0":
+                # 纯插入时 @@ 行号是插入位置的前一行
+                current.line += 1
+            hunks.append(current)
+            continue
+        # "\ No newline at end of file"
+        if current is None or line.startswith("\\ ") or _file_header(lines, i):
+            continue
+        marker, body = (line[0], line[1:]) if line else (" ", "")
+        if marker not in " -+":
+            # 模型常漏掉上下文行开头的空格
+            marker, body = " ", line
+        if marker != "+":
+            current.old.append(body)
+        if marker != "-":
+            current.new.append(body)
+    for hunk in hunks:
+        _count_context(hunk)
+    return [hunk for hunk in hunks if hunk.old or hunk.new]
+
+
+def _count_context(hunk: Hunk) -> None:
+    # 首尾相同的行就是上下文
+    limit = min(len(hunk.old), len(hunk.new))
+    while hunk.leading < limit and hunk.old[hunk.leading] == hunk.new[hunk.leading]:
+        hunk.leading += 1
+    while (hunk.trailing < limit - hunk.leading
+           and hunk.old[-1 - hunk.trailing] == hunk.new[-1 - hunk.trailing]):
+        hunk.trailing += 1
+
+
+def _normalize(line: str) -> str:
+    return " ".join(line.split())
+
+
+def _find(lines: list[str], old: list[str], key=None) -> list[int]:
+    if key is not None:
+        lines, old = [key(line) for line in lines], [key(line) for line in old]
+    n, first = len(old), old[0]
+    return [i for i in range(len(lines) - n + 1) if lines[i] == first and lines[i:i + n] == old]
+
+
+def _similar(lines: list[str], old: list[str]) -> list[tuple[float, int]]:
+    """
+    与 old 行数相同的各个窗口的相似度，从高到低
+    """
+    target = "\n".join(_normalize(line) for line in old)
+    normalized = [_normalize(line) for line in lines]
+    matcher = difflib.SequenceMatcher(autojunk=False)
+    matcher.set_seq2(target)
+    scores = []
+    for i in range(max(0, len(lines) - len(old) + 1)):
+        matcher.set_seq1("\n".join(normalized[i:i + len(old)]))
+        if matcher.real_quick_ratio() < 0.6 or matcher.quick_ratio() < 0.6:
+            continue
+        scores.append((matcher.ratio(), i))
+    return sorted(scores, reverse=True)
+
+
+def _reindent(matched: list[str], old: list[str], new: list[str]) -> list[str]:
+    """
+    忽略空白匹配时，若文件中的行比 hunk 统一多一段缩进，替换内容也补上这段缩进
+    """
+    extras = set()
+    for actual, expected in zip(matched, old):
+        if not actual.strip():
+            continue
+        indent = actual[:len(actual) - len(actual.lstrip())]
+        hunk_indent = expected[:len(expected) - len(expected.lstrip())]
+        if not indent.endswith(hunk_indent):
+            return new
+        extras.add(indent[:len(indent) - len(hunk_indent)])
+    if len(extras) != 1:
+        return new
+    extra = extras.pop()
+    return [extra + line if line.strip() else line for line in new]
+
+
+def apply_patch(original: str, hunks: list[Hunk], min_similarity: float = 0.9) -> PatchResult:
+    """
+    依次应用各个 hunk
+
+    Args:
+        min_similarity: 前几种匹配都失败时，接受的最低相似度
+    """
+    newline = "\r\n" if "\r\n" in original else "\n"
+    lines = original.splitlines()
+    result = PatchResult(original, total=len(hunks))
+    # 已应用的 hunk 造成的行号偏移
+    offset = 0
+    for index, hunk in enumerate(hunks):
+        hint = hunk.line - 1 + offset if hunk.line is not None else None
+        if hunk.old == hunk.new:
+            # 只有上下文行：多半是某些 -/+ 行被误解析了，当成已应用会掩盖问题
+            result.rejected.append(Rejection(index, "hunk contains no changes", hunk))
+            continue
+        if not hunk.old:
+            # 纯插入：有行号时插到该行，否则追加到末尾
+            at = min(max(hint, 0), len(lines)) if hint is not None else len(lines)
+            lines[at:at] = hunk.new
+            offset += len(hunk.new)
+            result.applied.append((index, at + 1, "insert"))
+            continue
+        found = _locate(lines, hunk, hint, min_similarity)
+        if isinstance(found, Rejection):
+            found.index = index
+            result.rejected.append(found)
+            continue
+        at, old, new, how = found
+        if how != "exact":
+            new = _reindent(lines[at:at + len(old)], old, new)
+        lines[at:at + len(old)] = new
+        offset += len(new) - len(old)
+        result.applied.append((index, at + 1, how))
+    text = newline.join(lines)
+    if lines and original.endswith(("\n", "\r")):
+        text += newline
+    result.text = text
+    return result
+
+
+def _locate(lines: list[str], hunk: Hunk, hint: int | None, min_similarity: float):
+    """
+    找到 hunk 应用的位置，返回 (行下标, 实际匹配的旧行, 替换成的新行, 匹配方式) 或 Rejection
+    """
+    # 依次去掉最外侧的 0、1、2 行上下文
+    for fuzz in range(0, 3):
+        lead, trail = min(fuzz, hunk.leading), min(fuzz, hunk.trailing)
+        if fuzz and not (lead or trail):
+            break
+        old = hunk.old[lead:len(hunk.old) - trail]
+        new = hunk.new[lead:len(hunk.new) - trail]
+        if not old:
+            break
+        for key, how in ((None, "exact"), (_normalize, "whitespace")):
+            candidates = _find(lines, old, key)
+            if not candidates:
+                continue
+            if len(candidates) > 1 and hint is None:
+                shown = ", ".join(str(i + 1) for i in candidates[:5])
+                return Rejection(0, f"matches {len(candidates)} places (lines {shown}), add more context", hunk)
+            target = hint + lead if hint is not None else 0
+            at = min(candidates, key=lambda i: abs(i - target))
+            return at, old, new, how if not fuzz else f"{how}, fuzz {fuzz}"
+    scores = _similar(lines, hunk.old)
+    if not scores:
+        return Rejection(0, "no match", hunk)
+    best, at = scores[0]
+    if best < min_similarity:
+        return Rejection(0, "no match", hunk, at + 1, best)
+    rivals = [i for score, i in scores[1:] if score > best - 0.02 and abs(i - at) >= len(hunk.old)]
+    if rivals and hint is None:
+        return Rejection(0, f"several places are equally similar (lines {at + 1}, {rivals[0] + 1})", hunk, at + 1, best)
+    if rivals:
+        at = min([at] + rivals, key=lambda i: abs(i - hint))
+    return at, lines[at:at + len(hunk.old)], hunk.new, f"similar {best:.0%}"
+
+
+def diff_text(name: str, old: str, new: str, context: int = 2) -> str:
+    return "".join(difflib.unified_diff(old.splitlines(keepends=True), new.splitlines(keepends=True),
+                                        f"a/{name}", f"b/{name}", n=context))
@@ -9,31 +9,122 @@
 """
 import os
 import platform
-import subprocess
+import threading
+import time
+
+from git_state import GitState
+
+# mtime 距当前时间小于该值的目录下一轮仍会重新列出
+_RACY_NS = 2_000_000_000
+
+
+class _DirNode:
+    """
+    文件树缓存中的一个目录
+    """
+    __slots__ = ("path", "mtime_ns", "denied", "entries", "children", "rendered", "render_key")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime_ns: int | None = None
+        self.denied = False
+        self.entries: list[tuple[str, bool]] = []
+        self.children: dict[str, _DirNode] = {}
+        self.rendered: str | None = None
+        self.render_key: tuple | None = None
+
 
 class ProjectContexter:
-    def __init__(self, whereami: str, exclude_dirs: list[str] = None, max_depth: int = 4):
+    def __init__(self, whereami: str, exclude_dirs: list[str] = None, max_depth: int = 4, look: bool = True):
+        """
+        Args:
+            look: 是否立即构建上下文；为 False 时由调用者稍后 (例如在后台线程中) 调用 look_around()
+        """
         self.current_path = whereami
         self.exclude_dirs = exclude_dirs or ['.git', '__pycache__', 'node_modules', '.idea', '.vscode', 'venv']
         self.max_depth = max_depth
+        self._nodes: dict[str, _DirNode] = {}
+        self._files_text: str | None = None
+        self._dirty = False
+        self._verifying = False
+        self._lock = threading.Lock()
+        self.watcher = None
+        self.git = GitState()
+        self.project_info = None
         
-        self.look_around()
+        if look:
+            self.look_around()
     
     def look_around(self) -> None:
+        # 可能在后台线程中运行，期间再次 mark_dirty() 的标记要留给下一次
+        self._verifying, self._dirty = self._dirty, False
+        recent_changes, git_status = self._see_git_state()
         info = {
             "where_am_i": self.current_path,
             "whats_here": self._see_files(),
-            "recent_changes": self._see_changes(),
-            "git_status": self._see_git(),
+            "recent_changes": recent_changes,
+            "git_status": git_status,
             "os": self._get_os_info()
         }
         self.project_info = info
+        self._verifying = False
         return info
     
     def _see_files(self) -> str:
-        return self._generate_file_tree(self.current_path)
+        with self._lock:
+            watcher = self.watcher
+            if watcher is not None and watcher.root != self.current_path:
+                watcher.stop()
+                watcher = type(watcher)(self, debounce=watcher.debounce, max_delay=watcher.max_delay)
+                self.watcher = watcher = watcher if watcher.start() else None
+            if self._trusted() and self._files_text is not None:
+                pending = watcher.pop_pending()
+                if not pending:
+                    return self._files_text
+                for path in pending:
+                    node = self._nodes.get(path)
+                    if node is not None:
+                        node.mtime_ns = None
+            self._files_text = self._generate_file_tree(self.current_path)
+            return self._files_text
+    
+    def start_watching(self, **options) -> bool:
+        """
+        在后台线程中监视 current_path，使文件树在下一次提问前就已是最新的；
+        没有可用的事件后端 (未安装 watchdog 等) 时返回 False，仍在每轮提问前遍历目录
+
+        Args:
+            **options: 传给 fs_watcher.Watcher 的参数 (debounce, max_delay)
+        """
+        from fs_watcher import Watcher
+        self.stop_watching()
+        watcher = Watcher(self, **options)
+        self.watcher = watcher if watcher.start() else None
+        return self.watcher is not None
+    
+    def mark_dirty(self) -> None:
+        """
+        CLI 自己执行了命令或改动了文件后调用：监视器的事件可能还没送达，
+        下一次 look_around() 会 stat 所有目录并重新执行 git status，而不是直接信任缓存
+        """
+        self._dirty = True
+    
+    def _trusted(self) -> bool:
+        return self.watcher is not None and self.watcher.trusted and not (self._dirty or self._verifying)
+    
+    def stop_watching(self) -> None:
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
     
     def _generate_file_tree(self, root_path: str, prefix: str = "", depth: int = 0, is_last: bool = True) -> str:
+        """
+        生成文件树
+
+        目录结构缓存在 self._nodes 中，跨轮次复用：
+        每轮只对目录做一次 stat，mtime 变化的目录才会重新 scandir，
+        未变化的子树直接复用上一轮渲染好的文本。
+        """
         if depth > self.max_depth:
             return ""
             
@@ -50,34 +141,108 @@ class ProjectContexter:
                 line += "/"
             line += "\n"
         
-        result = [line]
+        if not os.path.isdir(root_path) or base_name in self.exclude_dirs:
+            return line
         
-        if os.path.isdir(root_path) and base_name not in self.exclude_dirs:
-            try:
-                items = os.listdir(root_path)
-                items.sort()
-                dirs = [item for item in items if os.path.isdir(os.path.join(root_path, item)) 
-                       and not item.startswith('.') and item not in self.exclude_dirs]
-                files = [item for item in items if os.path.isfile(os.path.join(root_path, item)) 
-                        and not item.startswith('.')]
-                sorted_items = dirs + files
-                
-                for i, item in enumerate(sorted_items):
-                    item_path = os.path.join(root_path, item)
-                    is_last_item = (i == len(sorted_items) - 1)
-                    new_prefix = prefix + ("    " if is_last else "│   ")
-                    
-                    child_tree = self._generate_file_tree(
-                        item_path, new_prefix, depth + 1, is_last_item
-                    )
-                    if child_tree:
-                        result.append(child_tree)
-                        
-            except PermissionError:
-                error_line = prefix + ("    " if is_last else "│   ") + "└── [Permission Denied]\n"
-                result.append(error_line)
+        node = self._nodes.get(root_path)
+        if node is None:
+            node = self._nodes[root_path] = _DirNode(root_path)
+        self._refresh_node(node, depth)
+        return line + self._render_node(node, prefix, depth, is_last)
+    
+    def _refresh_node(self, node: "_DirNode", depth: int) -> bool:
+        """
+        检查目录及其可见范围内的子目录是否变化，返回子树是否变化
+        """
+        if depth >= self.max_depth:
+            # 最深一层的目录只显示名字，原实现仍会 listdir 它，这里只检查权限
+            denied = not os.access(node.path, os.R_OK)
+            changed = denied != node.denied
+            node.denied = denied
+        else:
+            changed = False
+            # inotify 监视器运行时由它负责让节点失效 (mtime_ns = None)，不必再逐个 stat
+            trusted = self._trusted()
+            if trusted and node.mtime_ns is not None:
+                mtime_ns = node.mtime_ns
+            else:
+                try:
+                    mtime_ns = os.stat(node.path).st_mtime_ns
+                except OSError:
+                    mtime_ns = None
+            if mtime_ns is None or mtime_ns != node.mtime_ns:
+                self._list_node(node)
+                # 与 git 的 racy 检测相同：mtime 离现在太近时，同一时间片内的后续修改无法通过 mtime 发现
+                racy = mtime_ns is None or (not trusted and time.time_ns() - mtime_ns < _RACY_NS)
+                node.mtime_ns = None if racy else mtime_ns
+                changed = True
+            for child in node.children.values():
+                if self._refresh_node(child, depth + 1):
+                    changed = True
+        if changed:
+            node.rendered = None
+        return changed
+    
+    def _list_node(self, node: "_DirNode") -> None:
+        dirs, files = [], []
+        try:
+            with os.scandir(node.path) as it:
+                for entry in it:
+                    name = entry.name
+                    if name.startswith('.'):
+                        continue
+                    try:
+                        if entry.is_dir():
+                            if name not in self.exclude_dirs:
+                                dirs.append(name)
+                        elif entry.is_file():
+                            files.append(name)
+                    except OSError:
+                        continue
+            node.denied = False
+        except PermissionError:
+            node.denied = True
+        dirs.sort()
+        files.sort()
+        node.entries = [(d, True) for d in dirs] + [(f, False) for f in files]
         
-        return "".join(result)
+        children = {}
+        for d in dirs:
+            child_path = os.path.join(node.path, d)
+            child = node.children.get(d) or self._nodes.get(child_path) or _DirNode(child_path)
+            children[d] = self._nodes[child_path] = child
+        for name, child in node.children.items():
+            if name not in children:
+                self._forget_node(child)
+        node.children = children
+    
+    def _forget_node(self, node: "_DirNode") -> None:
+        self._nodes.pop(node.path, None)
+        for child in node.children.values():
+            self._forget_node(child)
+    
+    def _render_node(self, node: "_DirNode", prefix: str, depth: int, is_last: bool) -> str:
+        key = (prefix, depth, is_last)
+        if node.rendered is not None and node.render_key == key:
+            return node.rendered
+        
+        child_prefix = prefix + ("    " if is_last else "│   ")
+        result = []
+        if node.denied:
+            result.append(child_prefix + "└── [Permission Denied]\n")
+        elif depth < self.max_depth:
+            for i, (name, is_dir) in enumerate(node.entries):
+                is_last_item = (i == len(node.entries) - 1)
+                connector = "└── " if is_last_item else "├── "
+                if not is_dir:
+                    result.append(f"{child_prefix}{connector}{name}\n")
+                    continue
+                result.append(f"{child_prefix}{connector}{name}/\n")
+                result.append(self._render_node(node.children[name], child_prefix, depth + 1, is_last_item))
+        
+        node.rendered = "".join(result)
+        node.render_key = key
+        return node.rendered
     
     def get_simple_tree(self) -> str:
         tree_lines = [f"{os.path.basename(self.current_path)}/\n"]
@@ -112,29 +277,17 @@ class ProjectContexter:
         _build_simple(self.current_path)
         return "".join(tree_lines)
     
+    def _see_git_state(self) -> tuple[str, str]:
+        watcher = self.watcher
+        if self._trusted():
+            return self.git.query(self.current_path, watcher.root, watcher.generation)
+        return self.git.query(self.current_path)
+    
     def _see_changes(self) -> str:
-        try:
-            result = subprocess.run(
-                ['git', 'log', '--oneline', '-5'],
-                capture_output=True, text=True, cwd=self.current_path
-            )
-            if result.returncode == 0:
-                return result.stdout.strip() or "No recent changes found"
-        except:
-            pass
-        return "Git not available or no changes"
+        return self._see_git_state()[0]
     
     def _see_git(self) -> str:
-        try:
-            result = subprocess.run(
-                ['git', 'status', '--short'],
-                capture_output=True, text=True, cwd=self.current_path
-            )
-            if result.returncode == 0:
-                return result.stdout.strip() or "Working directory clean"
-        except:
-            pass
-        return "Not a git repository or git not available"
+        return self._see_git_state()[1]
         
     def _get_os_info(self) -> str:
         p = platform.system()
@@ -158,7 +311,95 @@ Git状态:
 {self.project_info['git_status']}
 ==================================================
         """
-
+    
+    def snapshot(self) -> dict:
+        """
+        当前上下文的快照，供下一轮 display_context_delta() 比较
+        """
+        snap = dict(self.project_info)
+        snap["paths"] = self._list_paths()
+        return snap
+    
+    def _list_paths(self) -> set[str]:
+        paths = set()
+        
+        def _walk(node: _DirNode, rel: str, depth: int):
+            if node.denied or depth >= self.max_depth:
+                return
+            for name, is_dir in node.entries:
+                path = os.path.join(rel, name) if rel else name
+                if is_dir:
+                    paths.add(path + os.sep)
+                    _walk(node.children[name], path, depth + 1)
+                else:
+                    paths.add(path)
+        
+        with self._lock:
+            root = self._nodes.get(self.current_path)
+            if root is not None:
+                _walk(root, "", 0)
+        return paths
+    
+    def list_files(self) -> list[str]:
+        """
+        文件树中可见的所有文件的绝对路径 (复用已缓存的遍历结果，不访问磁盘)
+        """
+        files = []
+        
+        def _walk(node: _DirNode, depth: int):
+            if node.denied or depth >= self.max_depth:
+                return
+            for name, is_dir in node.entries:
+                if is_dir:
+                    _walk(node.children[name], depth + 1)
+                else:
+                    files.append(os.path.join(node.path, name))
+        
+        with self._lock:
+            root = self._nodes.get(self.current_path)
+            if root is not None:
+                _walk(root, 0)
+        return files
+    
+    def display_context_delta(self, previous: dict) -> str | None:
+        """
+        与上一次发送的快照相比的变化，没有变化时返回空字符串；
+        位置或操作系统变了 (差异没有意义) 时返回 None，调用者应发送完整上下文
+        """
+        if previous["where_am_i"] != self.project_info["where_am_i"] or previous["os"] != self.project_info["os"]:
+            return None
+        sections = []
+        
+        paths = self._list_paths()
+        added, removed = sorted(paths - previous["paths"]), sorted(previous["paths"] - paths)
+        if added:
+            sections.append("新增路径:\n" + "\n".join(f"+ {p}" for p in added))
+        if removed:
+            sections.append("删除路径:\n" + "\n".join(f"- {p}" for p in removed))
+        
+        if self.project_info["recent_changes"] != previous["recent_changes"]:
+            old_lines = set(previous["recent_changes"].splitlines())
+            new_lines = [line for line in self.project_info["recent_changes"].splitlines() if line not in old_lines]
+            sections.append("最近更改:\n" + "\n".join(new_lines or self.project_info["recent_changes"].splitlines()))
+        
+        if self.project_info["git_status"] != previous["git_status"]:
+            old_lines = previous["git_status"].splitlines()
+            new_lines = self.project_info["git_status"].splitlines()
+            old_set, new_set = set(old_lines), set(new_lines)
+            diff = [f"+ {line}" for line in new_lines if line not in old_set]
+            diff += [f"- {line}" for line in old_lines if line not in new_set]
+            sections.append("Git状态变化:\n" + "\n".join(diff))
+        
+        if not sections:
+            return ""
+        body = "\n\n".join(sections)
+        return f"""
+==================================================
+项目上下文变化 (相对上一次发送)
+==================================================
+{body}
+==================================================
+        """
 
 
 if __name__ == "__main__":
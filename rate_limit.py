@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+重试与限流组件
+=======================
+说明：
+    RetryPolicy: 对 429、过载、5xx 和连接错误进行指数退避重试 (full jitter)，服务端给出 Retry-After 时以它为准。
+    TokenBucket / EndpointLimiter: 客户端令牌桶限流，按接口地址 (base_url) 共享，
+    同时限制每分钟请求数和每分钟 token 数；收到 Retry-After 时同一接口的其它请求也一起等待。
+    Budget: 本次会话允许的请求数和 token 总数，用完后不再发送请求。
+    工作状态: Done
+"""
+import random
+import time
+
+# 这些状态码表示请求本身没问题，稍后重试可能成功
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def retry_after(e: Exception) -> float | None:
+    """
+    从错误响应的 Retry-After / retry-after-ms 头中取出需要等待的秒数
+    """
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    def __init__(self, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0):
+        """
+        Args:
+            max_retries: 最多重试次数 (不含第一次请求)
+            base_delay: 第一次重试的退避上限 (秒)，之后每次翻倍
+            max_delay: 单次等待的上限 (秒)，Retry-After 超过它时也不再重试
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, e: Exception) -> bool:
+        # 只有请求出错后才会调用，此时 openai 已经导入
+        import openai
+        if isinstance(e, openai.APIConnectionError):
+            return True
+        if isinstance(e, openai.APIStatusError):
+            # 额度用完同样返回 429，重试没有意义
+            if getattr(e, "code", None) == "insufficient_quota":
+                return False
+            return e.status_code in RETRY_STATUS
+        return "overload" in str(e).lower()
+
+    def delay(self, attempt: int, e: Exception) -> float | None:
+        """
+        第 attempt 次重试 (从 0 开始) 前需要等待的秒数，返回 None 表示不应重试
+        """
+        if attempt >= self.max_retries or not self.should_retry(e):
+            return None
+        after = retry_after(e)
+        if after is not None:
+            return after if after <= self.max_delay else None
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        """
+        Args:
+            rate: 每秒补充的令牌数
+            capacity: 桶容量，即允许的突发量
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+
+class EndpointLimiter:
+    def __init__(self, rpm: float | None = None, tpm: float | None = None):
+        """
+        Args:
+            rpm: 每分钟请求数上限，None 表示不限
+            tpm: 每分钟 token 数上限 (提示词估算值加 max_tokens)，None 表示不限
+        """
+        self.requests = TokenBucket(rpm / 60, rpm) if rpm else None
+        self.tokens = TokenBucket(tpm / 60, tpm) if tpm else None
+        self.blocked_until = 0.0
+        # 在事件循环中第一次使用时才创建，启动时不必导入 asyncio
+        self._lock = None
+
+    def configure(self, rpm: float | None, tpm: float | None) -> None:
+        self.requests = TokenBucket(rpm / 60, rpm) if rpm else None
+        self.tokens = TokenBucket(tpm / 60, tpm) if tpm else None
+
+    def block(self, seconds: float) -> None:
+        """
+        服务端要求等待时，让该接口上的所有请求都至少等到那个时刻
+        """
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self, tokens: int = 0) -> float:
+        """
+        等待直到可以发送一个约 tokens 大小的请求，返回等待的秒数
+        """
+        import asyncio
+        start = time.monotonic()
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # 排队依次取令牌，先到的请求先发送
+        async with self._lock:
+            while True:
+                wait = self.blocked_until - time.monotonic()
+                if self.requests is not None:
+                    wait = max(wait, self.requests.wait_time(1))
+                if self.tokens is not None:
+                    wait = max(wait, self.tokens.wait_time(tokens))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+        return time.monotonic() - start
+
+
+_limiters: dict[str, EndpointLimiter] = {}
+
+
+def limiter_for(endpoint: str, rpm: float | None = None, tpm: float | None = None) -> EndpointLimiter:
+    """
+    同一接口地址共用一个限流器；传入 rpm/tpm 时更新其设置
+    """
+    limiter = _limiters.get(endpoint)
+    if limiter is None:
+        limiter = _limiters[endpoint] = EndpointLimiter(rpm, tpm)
+    elif rpm is not None or tpm is not None:
+        limiter.configure(rpm, tpm)
+    return limiter
+
+
+class Budget:
+    def __init__(self, max_requests: int | None = None, max_tokens: int | None = None):
+        """
+        Args:
+            max_requests: 本次会话最多发送的请求数 (重试也算)，None 表示不限
+            max_tokens: 本次会话最多消耗的 token 数 (提示词加回复)，None 表示不限
+        """
+        self.max_requests = max_requests
+        self.max_tokens = max_tokens
+        self.requests = 0
+        self.tokens = 0
+
+    def check(self, tokens: int = 0) -> None:
+        if self.max_requests is not None and self.requests >= self.max_requests:
+            raise BudgetExceeded(f"请求数已达上限 {self.max_requests}")
+        if self.max_tokens is not None and self.tokens + tokens > self.max_tokens:
+            raise BudgetExceeded(f"token 用量将超过上限 {self.max_tokens} (已用 {self.tokens})")
+
+    def spend(self, requests: int = 0, tokens: int = 0) -> None:
+        self.requests += requests
+        self.tokens += tokens
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+回复缓存组件
+=======================
+说明：
+    以 (model, temperature, max_tokens, messages) 的哈希为键缓存AI回复，
+    相同的对话状态 (reask、脚本化会话的重放、temperature=0 的确定性运行) 直接返回缓存，不再请求接口。
+    分为内存和磁盘两层，各自按字节数做 LRU 淘汰；磁盘层每条回复一个 JSON 文件，以修改时间作为最近使用时间。
+    工作状态: Done
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "aicli", "responses")
+
+
+def cache_key(model: str, temperature: float, max_tokens: int, messages: list[dict]) -> str:
+    payload = json.dumps([model, temperature, max_tokens, messages], ensure_ascii=False, sort_keys=True,
+                         separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, directory: str | None = DEFAULT_DIRECTORY,
+                 memory_bytes: int = 8 * 1024 * 1024, disk_bytes: int = 256 * 1024 * 1024):
+        """
+        Args:
+            directory: 磁盘层目录，None 表示只使用内存层
+            memory_bytes: 内存层最多保存的回复字节数
+            disk_bytes: 磁盘层最多占用的字节数
+        """
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        # key -> (回复, 字节数)，按最近使用排序
+        self._memory: OrderedDict[str, tuple[str, int]] = OrderedDict()
+        self._memory_size = 0
+        # 磁盘层索引 key -> 文件大小，按最近使用排序；第一次访问磁盘层时才扫描目录
+        self._disk: OrderedDict[str, int] | None = None
+        self._disk_size = 0
+        self._lock = threading.Lock()
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        self.stores = 0
+        self.evictions = {"memory": 0, "disk": 0}
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits["memory"] += 1
+                return self._memory[key][0]
+            response = self._disk_get(key)
+            if response is None:
+                self.misses += 1
+                return None
+            self.hits["disk"] += 1
+            self._memory_put(key, response)
+            return response
+
+    def put(self, key: str, response: str, model: str | None = None) -> None:
+        with self._lock:
+            self.stores += 1
+            self._memory_put(key, response)
+            self._disk_put(key, response, model)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+            index = self._disk_index()
+            for key in list(index):
+                self._disk_remove(key)
+            self._disk = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            index = self._disk_index()
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_size,
+                "disk_entries": len(index),
+                "disk_bytes": self._disk_size,
+                "memory_hits": self.hits["memory"],
+                "disk_hits": self.hits["disk"],
+                "misses": self.misses,
+                "stores": self.stores,
+                "memory_evictions": self.evictions["memory"],
+                "disk_evictions": self.evictions["disk"],
+                "directory": self.directory,
+            }
+
+    def _memory_put(self, key: str, response: str) -> None:
+        size = len(response.encode("utf-8"))
+        if size > self.memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_size -= self._memory.pop(key)[1]
+        self._memory[key] = (response, size)
+        self._memory_size += size
+        while self._memory_size > self.memory_bytes:
+            _, (_, old_size) = self._memory.popitem(last=False)
+            self._memory_size -= old_size
+            self.evictions["memory"] += 1
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def _disk_index(self) -> OrderedDict:
+        if self._disk is not None:
+            return self._disk
+        self._disk = OrderedDict()
+        self._disk_size = 0
+        if self.directory is None:
+            return self._disk
+        entries = []
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if not entry.name.endswith(".json"):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime_ns, entry.name[:-5], stat.st_size))
+        except OSError:
+            return self._disk
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_size += size
+        return self._disk
+
+    def _disk_get(self, key: str) -> str | None:
+        if self.directory is None:
+            return None
+        index = self._disk_index()
+        path = self._path(key)
+        # 不在索引中也尝试打开，其它同时运行的 aicli 可能刚写入
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                response = json.load(f)["response"]
+            os.utime(path)
+        except FileNotFoundError:
+            if key in index:
+                self._disk_size -= index.pop(key)
+            return None
+        except (OSError, ValueError, KeyError):
+            self._disk_remove(key)
+            return None
+        if key not in index:
+            index[key] = os.path.getsize(path)
+            self._disk_size += index[key]
+        index.move_to_end(key)
+        return response
+
+    def _disk_put(self, key: str, response: str, model: str | None) -> None:
+        if self.directory is None:
+            return
+        index = self._disk_index()
+        data = json.dumps({"model": model, "created": time.time(), "response": response}, ensure_ascii=False)
+        size = len(data.encode("utf-8"))
+        if size > self.disk_bytes:
+            return
+        path = self._path(key)
+        temp = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(temp, path)
+        except OSError:
+            return
+        if key in index:
+            self._disk_size -= index.pop(key)
+        index[key] = size
+        self._disk_size += size
+        while self._disk_size > self.disk_bytes and len(index) > 1:
+            self._disk_remove(next(iter(index)))
+            self.evictions["disk"] += 1
+
+    def _disk_remove(self, key: str) -> None:
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_size -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
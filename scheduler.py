@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+操作调度组件
+=======================
+说明：
+    用户同意的操作 (%%run 命令和文件操作) 之间没有依赖时在有限大小的线程池中并发执行，有依赖时按原顺序等待。
+    以下情况视为有依赖：
+        - %%run 命令默认等待之前的所有操作，之后的操作也都等待它 (无法从命令本身可靠地判断它读写哪些文件)
+        - 带 independent=True 的命令才可能与其他操作并发，此时只在涉及相同的文件路径
+          (文件操作的路径、命令参数中像路径的部分，按文件名比较) 时等待
+        - cd 命令，或带 sequential=True 的命令：即使标了 independent=True 也按顺序执行
+        - 文件操作之间：涉及相同的文件路径
+        - %%run 中的 after=<n>：在第 n 个 %%run (从 0 开始) 完成后执行
+    以上只决定执行顺序。操作只在真正的依赖失败时跳过 (标记为 skipped)，并行和按顺序执行时规则相同：
+        - 涉及相同文件路径的更早的操作出错 (抛出异常或被跳过)
+        - after=<n> 指定的命令失败 (包括退出码不为 0)；命令的退出码不影响没有用 after 指定它的操作
+    结果按原顺序返回。
+    工作状态: Done
+"""
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+# 调度用的 %%run 参数，不会传给命令本身
+HINT_KEYS = ("sequential", "after", "independent")
+
+
+@dataclass
+class Task:
+    key: str
+    op_type: str
+    op_data: Any
+    hints: dict = field(default_factory=dict)
+    deps: set[int] = field(default_factory=set)
+    # 涉及相同路径的更早的操作，和 after= 指定的命令；它们失败时跳过这个任务
+    requires: set[int] = field(default_factory=set)
+    after: set[int] = field(default_factory=set)
+    status: str = "pending"
+    result: Any = None
+    error: Exception | None = None
+    # on_update / failed 回调中抛出的异常，不影响任务本身的结果
+    callback_error: Exception | None = None
+    started: float | None = None
+    finished: float | None = None
+
+    @property
+    def duration(self) -> float | None:
+        if self.started is None:
+            return None
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def label(self) -> str:
+        if self.op_type == "run":
+            return self.op_data if isinstance(self.op_data, str) else " ".join(self.op_data)
+        change_type, change_data = self.op_data
+        return f"{change_type} {self.key}" + (f" -> {change_data}" if change_type == "rename" else "")
+
+
+def _names(path: str) -> set[str]:
+    """
+    路径的规范形式和文件名，Windows 和 POSIX 分隔符都认
+    """
+    path = path.strip("\"'").replace("\\", "/").rstrip("/")
+    if not path:
+        return set()
+    return {os.path.normpath(path), path.rsplit("/", 1)[-1]}
+
+
+def _command_words(cmd: str | list[str]) -> list[str]:
+    return cmd.split() if isinstance(cmd, str) else list(cmd)
+
+
+def _touched(task: Task) -> set[str]:
+    if task.op_type == "run":
+        names = set()
+        for word in _command_words(task.op_data):
+            # 只看像路径的参数 (含 . / \)，跳过选项
+            for part in re.split(r"[<>|;&=]", word):
+                if part and not part.startswith("-") and re.search(r"[./\\]", part) and part not in (".", ".."):
+                    names |= _names(part)
+        return names
+    change_type, change_data = task.op_data
+    names = _names(task.key)
+    if change_type == "rename" and change_data:
+        names |= _names(change_data)
+    return names
+
+
+def _is_barrier(task: Task) -> bool:
+    if task.op_type != "run":
+        return False
+    words = _command_words(task.op_data)
+    if bool(words and words[0] in ("cd", "cd..")) or task.hints.get("sequential") is True:
+        return True
+    # 只有明确声明 independent=True 的命令才不作为屏障
+    return task.hints.get("independent") is not True
+
+
+def plan_dependencies(tasks: list[Task]) -> list[Task]:
+    """
+    为每个任务计算它需要等待的 (更早的) 任务
+    """
+    runs = [i for i, task in enumerate(tasks) if task.op_type == "run"]
+    touched = [_touched(task) for task in tasks]
+    barriers = [_is_barrier(task) for task in tasks]
+    for i, task in enumerate(tasks):
+        after = task.hints.get("after")
+        if after is not None:
+            for ref in str(after).split(","):
+                ref = ref.strip().removeprefix("run_")
+                if ref.isdigit() and int(ref) < len(runs) and runs[int(ref)] < i:
+                    task.after.add(runs[int(ref)])
+        for j in range(i):
+            if touched[i] & touched[j]:
+                task.requires.add(j)
+            elif barriers[i] or barriers[j]:
+                task.deps.add(j)
+        task.deps |= task.requires | task.after
+    return tasks
+
+
+def blocked_by(task: Task, tasks: list[Task]) -> int | None:
+    """
+    返回使 task 不能执行的那个依赖 (失败或被跳过)，没有则返回 None；依赖都已结束时调用
+    """
+    for i in sorted(task.requires | task.after):
+        dep = tasks[i]
+        if dep.status == "skipped" or (dep.status == "failed" and (i in task.after or dep.error is not None)):
+            return i
+    return None
+
+
+class Scheduler:
+    def __init__(self, workers: int | None = None):
+        """
+        Args:
+            workers: 最多同时执行的操作数，默认为 CPU 数加 4 (至多 8)，命令大多在等待子进程
+        """
+        self.workers = workers or min(8, (os.cpu_count() or 1) + 4)
+
+    def run(self, tasks: list[Task], execute: Callable[[Task], Any],
+            failed: Callable[[Task], bool] = lambda task: task.error is not None,
+            on_update: Callable[[Task], None] | None = None) -> list[Task]:
+        """
+        按依赖关系执行任务
+
+        Args:
+            execute: 在工作线程中执行一个任务，返回值保存到 task.result
+            failed: 判断任务是否失败 (见 blocked_by：失败只影响真正依赖它的任务)
+            on_update: 任务状态变化时调用 (在工作线程中调用)；抛出的异常记录在 task.callback_error 中
+        """
+        lock = threading.Lock()
+        done = threading.Event()
+        waiting = {i: set(task.deps) for i, task in enumerate(tasks)}
+        dependents: dict[int, list[int]] = {i: [] for i in range(len(tasks))}
+        for i, task in enumerate(tasks):
+            for dep in task.deps:
+                dependents[dep].append(i)
+        remaining = [len(tasks)]
+        if not tasks:
+            return tasks
+
+        def notify(task: Task):
+            if on_update is None:
+                return
+            try:
+                on_update(task)
+            except Exception as e:
+                task.callback_error = task.callback_error or e
+
+        def finish(i: int, pool: ThreadPoolExecutor):
+            # 在持有 lock 时调用：释放依赖 i 的任务
+            ready = []
+            for j in dependents[i]:
+                waiting[j].discard(i)
+                if not waiting[j]:
+                    ready.append(j)
+            remaining[0] -= 1
+            if not remaining[0]:
+                done.set()
+            for j in ready:
+                if blocked_by(tasks[j], tasks) is not None:
+                    tasks[j].status = "skipped"
+                    notify(tasks[j])
+                    finish(j, pool)
+                else:
+                    pool.submit(work, j, pool)
+
+        def work(i: int, pool: ThreadPoolExecutor):
+            task = tasks[i]
+            try:
+                task.status = "running"
+                task.started = time.perf_counter()
+                notify(task)
+                try:
+                    task.result = execute(task)
+                except Exception as e:
+                    task.error = e
+                task.finished = time.perf_counter()
+                try:
+                    task.status = "failed" if failed(task) else "done"
+                except Exception as e:
+                    task.callback_error = task.callback_error or e
+                    task.status = "failed"
+                notify(task)
+            finally:
+                # 无论回调是否出错都要释放后续任务，否则 done.wait() 永远等不到
+                with lock:
+                    if task.status == "running":
+                        task.status = "failed"
+                    task.finished = task.finished or time.perf_counter()
+                    finish(i, pool)
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="aicli-op") as pool:
+            with lock:
+                for i in range(len(tasks)):
+                    if not waiting[i]:
+                        pool.submit(work, i, pool)
+            done.wait()
+        return tasks
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+检索索引组件
+=======================
+说明：
+    对项目文件建立本地倒排索引，提问前用 BM25 按问题给代码片段打分，自动附上最相关的几段，完全离线。
+    文件列表来自 ProjectContexter 已有的目录遍历；每个文件按 CHUNK_LINES 行切成片段，片段是打分的单位。
+    update() 对比每个文件的 (大小, mtime_ns)，只重新索引变化的文件、移除消失的文件。
+    标识符会按下划线和驼峰拆开 (ConversationStore -> conversationstore, conversation, store)，中文按相邻两字切分。
+    片段正文不保存在内存中，选中后才从文件中读取。
+    工作状态: Done
+"""
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from token_counter import estimate_tokens
+
+CHUNK_LINES = 40
+# 非字母数字的 ASCII 字节换成空格后按空白切分，比正则快得多；>= 0x80 的字节 (UTF-8 多字节字符) 保留
+_SEPARATORS = bytes(c if chr(c).isalnum() or c >= 0x80 else 0x20 for c in range(256))
+_CAMEL = re.compile(rb"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+")
+_CJK = re.compile(r"[一-鿿]+|[A-Za-z0-9]+")
+_parts_cache: dict[bytes, tuple[bytes, ...]] = {}
+
+
+def _extra_terms(raw: bytes) -> tuple[bytes, ...]:
+    """
+    含大写字母或非 ASCII 字符的词额外对应的索引词：驼峰拆出的各部分 (小写)，中文按相邻两字切分
+    """
+    terms = _parts_cache.get(raw)
+    if terms is not None:
+        return terms
+    if raw.isascii():
+        lower = raw.lower()
+        terms = tuple(part.lower() for part in _CAMEL.findall(raw) if len(part) > 1 and part.lower() != lower)
+    else:
+        terms = []
+        for part in _CJK.findall(raw.decode("utf-8", errors="ignore")):
+            if part.isascii():
+                terms.append(part.lower().encode())
+            else:
+                terms.extend(part[i:i + 2].encode() for i in range(max(1, len(part) - 1)))
+        terms = tuple(terms)
+    if len(_parts_cache) < 500_000:
+        _parts_cache[raw] = terms
+    return terms
+
+
+def count_tokens(data: bytes | str) -> Counter:
+    """
+    文本中各个索引词 (小写的 UTF-8 字节串) 的出现次数
+
+    绝大多数词只需小写，计数完全在 C 中完成；只有含大写或非 ASCII 字符的词才逐个处理
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    words = data.translate(_SEPARATORS).split()
+    counts = Counter(data.lower().translate(_SEPARATORS).split())
+    if data.isascii():
+        special = set(words).difference(counts)
+    else:
+        special = {word for word in set(words) if not word.isascii() or not word.islower()}
+        for word in [word for word in counts if not word.isascii()]:
+            del counts[word]
+    if special:
+        original = Counter(words)
+        for word in special:
+            n = original[word]
+            for term in _extra_terms(word):
+                counts[term] += n
+    return counts
+
+
+def tokenize(text: str) -> list[bytes]:
+    return list(count_tokens(text))
+
+
+@dataclass
+class Snippet:
+    path: str
+    start: int
+    end: int
+    score: float
+    text: str = ""
+
+
+class SearchIndex:
+    def __init__(self, max_file_bytes: int = 256 * 1024, k1: float = 1.2, b: float = 0.75,
+                 workers: int | None = None):
+        """
+        Args:
+            max_file_bytes: 只索引每个文件的前 max_file_bytes 字节
+            k1, b: BM25 参数
+            workers: 读取文件的线程数
+        """
+        self.max_file_bytes = max_file_bytes
+        self.k1 = k1
+        self.b = b
+        self.workers = workers or min(16, (os.cpu_count() or 1) + 4)
+        # 词 -> {片段编号: 词频}
+        self.postings: dict[bytes, dict[int, int]] = {}
+        # 片段编号 -> (路径, 起始行, 结束行, 长度, 词表)，删除后为 None，编号可复用
+        self.docs: list[tuple[str, int, int, int, tuple[bytes, ...]] | None] = []
+        self._free: list[int] = []
+        # 路径 -> (大小, mtime_ns, 片段编号列表)
+        self.files: dict[str, tuple[int, int, list[int]]] = {}
+        self.total_length = 0
+        self.doc_count = 0
+        self.last_update: dict = {}
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
+
+    def update(self, paths: list[str]) -> dict:
+        """
+        让索引与 paths 一致：新文件和 (大小, mtime_ns) 变化的文件重新索引，不在 paths 中的文件移除
+
+        Returns:
+            {"indexed", "removed", "unchanged", "seconds"}
+        """
+        # 同一时刻只有一个 update；search 只在修改单个文件时等待，建索引期间也能用已有的部分查询
+        with self._update_lock:
+            start = time.perf_counter()
+            wanted = set(paths)
+            stale = []
+            for path in paths:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                known = self.files.get(path)
+                if known is None or known[0] != stat.st_size or known[1] != stat.st_mtime_ns:
+                    stale.append((path, stat.st_size, stat.st_mtime_ns))
+            removed = [path for path in self.files if path not in wanted]
+            for path in removed:
+                with self._lock:
+                    self._remove(path)
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="aicli-index") as pool:
+                for (path, size, mtime_ns), chunks in zip(stale, pool.map(lambda item: self._chunk(item[0]), stale)):
+                    with self._lock:
+                        self._remove(path)
+                        self.files[path] = (size, mtime_ns, [self._add(path, *chunk) for chunk in chunks])
+            self.last_update = {"indexed": len(stale), "removed": len(removed),
+                                "unchanged": len(paths) - len(stale), "seconds": time.perf_counter() - start}
+            return self.last_update
+
+    def _chunk(self, path: str) -> list[tuple[int, int, Counter]]:
+        try:
+            with open(path, "rb") as f:
+                data = f.read(self.max_file_bytes)
+        except OSError:
+            return []
+        if b"\0" in data[:8192]:
+            return []
+        lines = data.split(b"\n")
+        if len(lines) > 1 and not lines[-1]:
+            lines.pop()
+        # 文件名本身也是很强的线索，计入每个片段
+        name_tokens = count_tokens(os.path.basename(path))
+        chunks = []
+        for start in range(0, len(lines), CHUNK_LINES):
+            counts = count_tokens(b"\n".join(lines[start:start + CHUNK_LINES]))
+            counts.update(name_tokens)
+            chunks.append((start, min(start + CHUNK_LINES, len(lines)), counts))
+        return chunks
+
+    def _add(self, path: str, start: int, end: int, counts: Counter) -> int:
+        length = sum(counts.values())
+        doc = self._free.pop() if self._free else len(self.docs)
+        entry = (path, start, end, length, tuple(counts))
+        if doc == len(self.docs):
+            self.docs.append(entry)
+        else:
+            self.docs[doc] = entry
+        postings = self.postings
+        for term, tf in counts.items():
+            posting = postings.get(term)
+            if posting is None:
+                postings[term] = {doc: tf}
+            else:
+                posting[doc] = tf
+        self.total_length += length
+        self.doc_count += 1
+        return doc
+
+    def _remove(self, path: str) -> None:
+        known = self.files.pop(path, None)
+        if known is None:
+            return
+        for doc in known[2]:
+            _, _, _, length, terms = self.docs[doc]
+            for term in terms:
+                posting = self.postings[term]
+                del posting[doc]
+                if not posting:
+                    del self.postings[term]
+            self.docs[doc] = None
+            self._free.append(doc)
+            self.total_length -= length
+            self.doc_count -= 1
+
+    def search(self, query: str, top_k: int = 5, exclude: set[str] = frozenset(),
+               max_df: float = 0.5) -> list[Snippet]:
+        """
+        按 BM25 返回得分最高的 top_k 个片段 (不含正文)
+
+        Args:
+            exclude: 不返回这些路径的片段 (例如已经在对话中的文件)
+            max_df: 出现在超过该比例片段中的词不参与打分，这类词区分度很低却最耗时
+        """
+        with self._lock:
+            if not self.doc_count:
+                return []
+            n = self.doc_count
+            average = self.total_length / n
+            scores: dict[int, float] = {}
+            for term in set(tokenize(query)):
+                posting = self.postings.get(term)
+                if not posting or len(posting) > max_df * n:
+                    continue
+                df = len(posting)
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                k1, b, docs = self.k1, self.b, self.docs
+                for doc, tf in posting.items():
+                    norm = k1 * (1 - b + b * docs[doc][3] / average)
+                    scores[doc] = scores.get(doc, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+            best = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+            result = []
+            for doc, score in best:
+                path, start, end, _, _ = self.docs[doc]
+                if path in exclude:
+                    continue
+                result.append(Snippet(path, start, end, score))
+                if len(result) >= top_k:
+                    break
+            return result
+
+    def snippets(self, query: str, token_budget: int, top_k: int = 5, exclude: set[str] = frozenset(),
+                 min_ratio: float = 0.25) -> list[Snippet]:
+        """
+        检索并读取片段正文，合计不超过 token_budget；得分低于最高分 min_ratio 倍的片段不要
+        """
+        chosen, used = [], 0
+        hits = self.search(query, top_k, exclude)
+        for hit in hits:
+            if hit.score < hits[0].score * min_ratio:
+                break
+            try:
+                with open(hit.path, "rb") as f:
+                    lines = f.read(self.max_file_bytes).split(b"\n")
+            except OSError:
+                continue
+            # 与建索引时相同的分行方式，行号才对得上
+            hit.text = b"\n".join(lines[hit.start:hit.end]).decode("utf-8", errors="ignore")
+            tokens = estimate_tokens(hit.text)
+            if used + tokens > token_budget:
+                continue
+            used += tokens
+            chosen.append(hit)
+        return chosen
+
+    def stats(self) -> dict:
+        return {"files": len(self.files), "chunks": self.doc_count, "terms": len(self.postings), **self.last_update}
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+会话日志组件
+=======================
+说明：
+    把 AI 历史的每次修改 (追加、截断、分支、压缩……) 以及 CLI 的状态 (工作目录、待确认的操作) 追加写入 JSONL 文件，
+    程序崩溃或退出后可以用 --resume 恢复会话，不必重新读文件、重新提问。
+    文件的第一行总是一个快照，之后是快照以来的修改记录；记录数或体积超过阈值时重新生成快照，
+    先写入临时文件再原子替换，因此恢复时只需读取一个快照并重放较短的尾部。
+    每条记录写入后立即 flush，进程崩溃不会丢失；最后一行因崩溃写了一半时恢复时会被截掉。
+    日志中有完整的对话和读过的文件内容，目录和文件只有当前用户可以访问；超过保留时间的日志由 prune() 删除。
+    工作状态: Done
+"""
+import glob
+import json
+import os
+import threading
+import time
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".aicli", "sessions")
+VERSION = 1
+
+
+def _open_private(path: str, mode: str):
+    """
+    以 "w" 或 "a" 打开文件，新建时权限为 0o600
+    """
+    flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if mode == "a" else os.O_TRUNC)
+    return open(os.open(path, flags, 0o600), mode, encoding="utf-8")
+
+
+class SessionJournal:
+    def __init__(self, path: str, snapshot_records: int = 2000, snapshot_bytes: int = 32 * 1024 * 1024):
+        """
+        Args:
+            path: 日志文件路径
+            snapshot_records: 快照之后累计多少条记录时重新生成快照
+            snapshot_bytes: 快照之后累计写入多少字节时重新生成快照
+        """
+        self.path = path
+        self.snapshot_records = snapshot_records
+        self.snapshot_bytes = snapshot_bytes
+        self.records = 0
+        self.tail_bytes = 0
+        self.snapshots = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, directory: str = DEFAULT_DIRECTORY, **options) -> "SessionJournal":
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        try:
+            # 旧版本按 umask 创建的目录
+            os.chmod(directory, 0o700)
+        except OSError:
+            pass
+        name = time.strftime("session-%Y%m%d-%H%M%S") + f"-{os.getpid()}.jsonl"
+        return cls(os.path.join(directory, name), **options)
+
+    @staticmethod
+    def latest(directory: str = DEFAULT_DIRECTORY) -> str | None:
+        """
+        最近修改过的会话日志
+        """
+        paths = glob.glob(os.path.join(directory, "session-*.jsonl"))
+        return max(paths, key=os.path.getmtime) if paths else None
+
+    @staticmethod
+    def prune(max_age: float, directory: str = DEFAULT_DIRECTORY, keep: str | None = None) -> int:
+        """
+        删除超过 max_age 秒没有修改过的会话日志 (以及崩溃遗留的临时文件)，keep 指定的日志除外；返回删除的个数
+        """
+        cutoff = time.time() - max_age
+        removed = 0
+        keep = os.path.abspath(keep) if keep else None
+        for path in glob.glob(os.path.join(directory, "session-*.jsonl*")):
+            if os.path.abspath(path) == keep:
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+
+    @property
+    def session_id(self) -> str:
+        """
+        会话的标识 (日志文件名，不含扩展名)，恢复会话后保持不变
+        """
+        return os.path.splitext(os.path.basename(self.path))[0]
+
+    @property
+    def due(self) -> bool:
+        return self.records >= self.snapshot_records or self.tail_bytes >= self.snapshot_bytes
+
+    def write(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line)
+            self._file.flush()
+            self.records += 1
+            self.tail_bytes += len(line)
+
+    def snapshot(self, ai, cli_state: dict) -> None:
+        """
+        把当前完整状态写成新日志的第一行，替换掉旧日志
+        """
+        # 与修改历史时的加锁顺序一致：先 AI 的锁，再日志的锁，期间不会有新的记录
+        with ai._lock, self._lock:
+            state = {"op": "snapshot", "version": VERSION, "time": time.time(), "ai": ai.export_state(), "cli": cli_state}
+            temp = self.path + ".tmp"
+            with _open_private(temp, "w") as f:
+                f.write(json.dumps(state, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            if self._file is not None:
+                self._file.close()
+            os.replace(temp, self.path)
+            self._file = _open_private(self.path, "a")
+            self.records = 0
+            self.tail_bytes = 0
+            self.snapshots += 1
+
+    def start(self, ai, cli_state: dict) -> None:
+        """
+        新会话：写入初始快照并开始记录
+        """
+        self.snapshot(ai, cli_state)
+        ai.attach_journal(self)
+
+    def resume(self, ai) -> dict:
+        """
+        恢复会话：载入快照、重放尾部记录，之后继续追加到同一个文件
+
+        Returns:
+            恢复出的 CLI 状态
+        """
+        with open(self.path, "rb") as f:
+            data = f.read()
+        valid = len(data)
+        lines = data.split(b"\n")
+        if lines and lines[-1]:
+            # 崩溃时写了一半的最后一行
+            valid -= len(lines[-1])
+        lines = lines[:-1]
+        snapshot = json.loads(lines[0])
+        if snapshot.get("op") != "snapshot" or snapshot.get("version") != VERSION:
+            raise ValueError(f"不是有效的会话日志: {self.path}")
+        ai.import_state(snapshot["ai"])
+        cli_state = snapshot["cli"]
+        for line in lines[1:]:
+            record = json.loads(line)
+            if record["op"] == "cli":
+                cli_state = record["state"]
+            else:
+                ai.apply(record)
+        if valid != len(data):
+            with open(self.path, "r+b") as f:
+                f.truncate(valid)
+        self._file = _open_private(self.path, "a")
+        self.records = len(lines) - 1
+        self.tail_bytes = valid - len(lines[0]) - 1
+        ai.attach_journal(self)
+        return cli_state
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+持久 Shell 会话组件
+=======================
+说明：
+    启动一个长期运行的 bash，通过管道逐条发送命令，省去每条命令启动 shell/解释器的开销，
+    并保留 export 的环境变量、真实的 cd (包括 cd -、cd a && make) 等状态。
+    每条命令后面跟着打印一行带随机标记的结束行 (stdout 中含退出码和新的工作目录，stderr 中只有标记)，
+    读到两边的结束行就说明这条命令的输出已经读完。
+    命令通过 eval 执行且 stdin 为 /dev/null，引号不配对等语法错误只会让这条命令失败，不会吞掉结束行。
+    超时时结束整个 shell 进程组，下一条命令会在原来的工作目录中自动重启 shell (环境变量会丢失)。
+    同一时刻只执行一条命令。
+    工作状态: Done
+"""
+import locale
+import os
+import queue
+import subprocess as subp
+import threading
+import time
+import uuid
+from typing import Callable
+
+from command_executor import CommandResult, OutputBuffer, kill_process_group
+
+
+def _quote(text: str) -> str:
+    return "'" + text.replace("'", "'\\''") + "'"
+
+
+class ShellSession:
+    def __init__(self, shell: str = "bash", cwd: str | None = None, env: dict | None = None):
+        """
+        Args:
+            shell: 使用的 shell，需兼容 bash 的语法
+            cwd: 初始工作目录
+            env: 环境变量，默认继承当前进程
+        """
+        self.shell = shell
+        self.cwd = cwd or os.getcwd()
+        self.env = env
+        self.process: subp.Popen | None = None
+        self.restarts = 0
+        self.commands = 0
+        self._lines: queue.Queue = queue.Queue()
+        self._marker = uuid.uuid4().hex
+        self._encoding = locale.getpreferredencoding(False)
+        self._lock = threading.Lock()
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self) -> None:
+        if self.alive:
+            return
+        if self.process is not None:
+            self.restarts += 1
+        self._lines = queue.Queue()
+        self.process = subp.Popen([self.shell, "--noprofile", "--norc"], cwd=self.cwd, env=self.env,
+                                  stdin=subp.PIPE, stdout=subp.PIPE, stderr=subp.PIPE, start_new_session=True)
+        for pipe, name in ((self.process.stdout, "stdout"), (self.process.stderr, "stderr")):
+            threading.Thread(target=self._read, args=(pipe, name, self._lines), daemon=True).start()
+
+    @staticmethod
+    def _read(pipe, name: str, lines: queue.Queue) -> None:
+        for raw in iter(pipe.readline, b""):
+            lines.put((name, raw))
+        lines.put((name, None))
+        pipe.close()
+
+    def close(self) -> None:
+        with self._lock:
+            if self.alive:
+                try:
+                    self.process.stdin.close()
+                    self.process.wait(timeout=1)
+                except (OSError, subp.TimeoutExpired):
+                    kill_process_group(self.process)
+            self.process = None
+
+    def run(
+        self,
+        cmd: str | list[str],
+        cwd: str | None = None,
+        on_line: Callable[[str, str], None] | None = None,
+        timeout: float | None = None,
+        idle_timeout: float | None = None,
+        head_lines: int = 200,
+        tail_lines: int = 200
+    ) -> CommandResult:
+        """
+        在会话中执行一条命令
+
+        Args:
+            cmd: 命令，列表会按空格拼回原来的命令行
+            cwd: 执行前切换到的目录，None 表示沿用会话当前目录
+            on_line: 每读到一行时调用 on_line(stream, line)
+            timeout / idle_timeout: 总时长和无输出时长上限 (秒)，超时会重启 shell
+            head_lines / tail_lines: 结果中保留的开头、结尾行数
+
+        Returns:
+            CommandResult，cwd 为命令执行后 shell 所在的目录
+        """
+        command = cmd if isinstance(cmd, str) else " ".join(cmd)
+        with self._lock:
+            start = time.perf_counter()
+            self.start()
+            self.commands += 1
+            marker = f"__aicli_{self._marker}_{self.commands}__"
+            script = ""
+            if cwd is not None and cwd != self.cwd:
+                script += f"cd -- {_quote(cwd)}\n"
+            script += (f"eval {_quote(command)} < /dev/null\n"
+                       f"__aicli_rc=$?\n"
+                       f"printf '%s %d %s\\n' {marker} \"$__aicli_rc\" \"$PWD\"\n"
+                       f"printf '%s\\n' {marker} >&2\n")
+            try:
+                self.process.stdin.write(script.encode(self._encoding))
+                self.process.stdin.flush()
+            except OSError as e:
+                return CommandResult(success=False, returncode=1, error=e, stderr=f"Shell session died: {e}")
+
+            buffers = {"stdout": OutputBuffer(head_lines, tail_lines), "stderr": OutputBuffer(head_lines, tail_lines)}
+            pending = {"stdout", "stderr"}
+            returncode, timed_out = None, None
+            started = last_output = time.monotonic()
+            marker_bytes = marker.encode()
+            while pending:
+                try:
+                    name, raw = self._lines.get(timeout=0.1)
+                except queue.Empty:
+                    now = time.monotonic()
+                    if timeout is not None and now - started > timeout:
+                        timed_out = "timeout"
+                    elif idle_timeout is not None and now - last_output > idle_timeout:
+                        timed_out = "idle"
+                    if timed_out:
+                        kill_process_group(self.process)
+                        break
+                    continue
+                if raw is None:
+                    # shell 退出了 (例如命令中有 exit)
+                    pending.discard(name)
+                    continue
+                last_output = time.monotonic()
+                index = raw.find(marker_bytes)
+                if index >= 0:
+                    # 没有以换行结尾的输出会和结束行连在一起
+                    raw, tail = raw[:index], raw[index + len(marker_bytes):]
+                    if name == "stdout":
+                        code, _, pwd = tail.strip().decode(self._encoding, errors="replace").partition(" ")
+                        returncode, self.cwd = int(code), pwd
+                    pending.discard(name)
+                    if not raw:
+                        continue
+                line = raw.decode(self._encoding, errors="replace")
+                buffers[name].add(line, len(raw))
+                if on_line is not None:
+                    on_line(name, line)
+
+            if returncode is None:
+                # 结束行没有出现：shell 已退出或被结束，下次执行时重启
+                self.process.wait()
+                returncode = self.process.returncode
+            result = CommandResult(
+                success=returncode == 0 and timed_out is None,
+                returncode=returncode,
+                stdout=buffers["stdout"].text(),
+                stderr=buffers["stderr"].text(),
+                bytes_out=buffers["stdout"].bytes + buffers["stderr"].bytes,
+                lines_dropped=buffers["stdout"].dropped + buffers["stderr"].dropped,
+                duration=time.perf_counter() - start,
+                timed_out=timed_out,
+                cwd=self.cwd
+            )
+            if timed_out:
+                limit = timeout if timed_out == "timeout" else idle_timeout
+                reason = "timed out" if timed_out == "timeout" else "produced no output"
+                result.stderr += f"Command {reason} after {limit}s and was killed, shell session restarted\n"
+                result.error = subp.TimeoutExpired(command, limit)
+            return result
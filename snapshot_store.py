@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+文件快照组件
+=======================
+说明：
+    AI 的每一轮文件操作 (edit/create/patch/delete/rename/new_dir) 执行之前，记录所涉及路径原来的状态，
+    之后可以用 /undo [n] 一次撤销最近 n 轮的修改。
+    文件内容按 sha256 保存在 objects/ 下 (zlib 压缩)，相同内容只存一份，各轮之间自动去重。
+    执行操作前只把原文件 reflink (支持写时复制的文件系统) 或硬链接到 pending/，每个文件只需几十微秒；
+    文件修改都是 rename 替换 (见 file_transaction)，原来的 inode 不会被改写，因此硬链接就是完整的快照。
+    这一轮结束后再在后台线程中计算哈希、压缩并存入 objects/，同时记录修改后的哈希，撤销时用来发现之后又被改过的文件。
+    各轮的记录追加写入 turns.jsonl (多个同时运行的实例共用，追加时加文件锁)，重启后仍可撤销。
+    每一轮记录所属的会话 (session) 和工作目录：/undo 和 /history files 只涉及当前会话、且与当前目录相关的轮次，
+    不会撤销另一个项目或另一个正在运行的实例的修改。轮次的编号是随机的，不同实例之间不会重复。
+    prune() 删除超过保留期限的轮次，并删除不再被引用的内容。
+    工作状态: Done
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import uuid
+import zlib
+
+from file_transaction import FileLock, FileTransaction, Staging
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".aicli", "snapshots")
+# Linux 上 reflink 的 ioctl 编号 (FICLONE)
+_FICLONE = 0x40049409
+
+
+def clone_file(source: str, target: str, reflink: bool = True) -> str:
+    """
+    尽量不复制内容地得到 source 的一份快照，返回使用的方式: reflink / hardlink / copy
+    """
+    if reflink and sys.platform.startswith("linux"):
+        import fcntl
+        try:
+            with open(source, "rb") as src, open(target, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+            return "reflink"
+        except OSError:
+            try:
+                os.remove(target)
+            except OSError:
+                pass
+    try:
+        os.link(source, target)
+        return "hardlink"
+    except OSError:
+        shutil.copyfile(source, target)
+        return "copy"
+
+
+class Turn:
+    """
+    一轮文件操作的快照
+    """
+    def __init__(self, turn_id: str, label: str, cwd: str, session: str | None = None):
+        self.id = turn_id
+        self.label = label
+        self.cwd = cwd
+        self.session = session
+        self.time = time.time()
+        # 每个路径一项: path, op, kind (file/dir/None，操作前的类型), before (哈希), pending (尚未入库的快照), after
+        self.entries: list[dict] = []
+        self.undone = False
+        self.ingested = False
+        self._paths: set[str] = set()
+
+    def to_record(self) -> dict:
+        return {"id": self.id, "label": self.label, "cwd": self.cwd, "session": self.session, "time": self.time,
+                "entries": [{key: entry.get(key) for key in ("path", "op", "kind", "before", "pending", "after")}
+                            for entry in self.entries]}
+
+
+class SnapshotStore:
+    def __init__(self, directory: str = DEFAULT_DIRECTORY, level: int = 1, session: str | None = None):
+        """
+        Args:
+            directory: 快照目录
+            level: zlib 压缩级别
+            session: 当前会话的标识，默认随机生成；恢复会话时设为原会话的标识，可以继续撤销之前的轮次
+        """
+        self.directory = directory
+        self.objects = os.path.join(directory, "objects")
+        self.pending = os.path.join(directory, "pending")
+        self.log_path = os.path.join(directory, "turns.jsonl")
+        self.lock_path = os.path.join(directory, "turns.lock")
+        self.level = level
+        self.session = session or f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.turns: list[Turn] = []
+        # 各设备是否支持 reflink，避免每个文件都尝试一次失败的 ioctl
+        self._reflink: dict[int, bool] = {}
+        self._lock = threading.Lock()
+        for path in (self.objects, self.pending):
+            os.makedirs(path, mode=0o700, exist_ok=True)
+        self._load()
+
+    # ---- 内容存储 ----
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+    def put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+            with open(temp, "wb") as f:
+                f.write(zlib.compress(data, self.level))
+            os.replace(temp, path)
+        else:
+            # 更新时间，prune() 不会删除刚刚又被用到、但还没有记入日志的内容
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        with open(self._object_path(digest), "rb") as f:
+            return zlib.decompress(f.read())
+
+    # ---- 每一轮的快照 ----
+
+    def begin(self, label: str, cwd: str) -> Turn:
+        return Turn(uuid.uuid4().hex[:12], label, cwd, self.session)
+
+    def capture(self, turn: Turn, paths: list[str], op: str) -> None:
+        """
+        在修改 paths 之前调用：记录它们现在的状态 (同一轮中已经记录过的路径跳过)
+        """
+        for path in paths:
+            path = os.path.abspath(path)
+            with self._lock:
+                if path in turn._paths:
+                    continue
+                turn._paths.add(path)
+            entry = {"path": path, "op": op, "kind": None, "before": None, "pending": None, "after": None}
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            if stat is not None and os.path.isdir(path):
+                entry["kind"] = "dir"
+            elif stat is not None:
+                entry["kind"] = "file"
+                pending = os.path.join(self.pending, f"{turn.id}-{uuid.uuid4().hex[:12]}")
+                method = clone_file(path, pending, self._reflink.get(stat.st_dev, True))
+                self._reflink[stat.st_dev] = method == "reflink"
+                entry["pending"] = pending
+            with self._lock:
+                turn.entries.append(entry)
+
+    def finish(self, turn: Turn) -> None:
+        """
+        这一轮的修改已经提交：记入日志 (之后再用 ingest() 把快照存入 objects)
+        """
+        if not turn.entries:
+            return
+        with self._lock:
+            self.turns.append(turn)
+            self._append(turn.to_record())
+
+    def abandon(self, turn: Turn) -> None:
+        """
+        这一轮的修改已经整体回滚，不需要快照
+        """
+        for entry in turn.entries:
+            if entry["pending"]:
+                Staging.discard(entry["pending"])
+        turn.entries = []
+
+    def ingest(self, turn: Turn) -> None:
+        """
+        计算快照和当前内容的哈希，快照压缩存入 objects 后删除 pending 中的链接；适合在后台线程中运行
+        """
+        updates = []
+        for entry in turn.entries:
+            if entry["pending"]:
+                with open(entry["pending"], "rb") as f:
+                    entry["before"] = self.put(f.read())
+            try:
+                with open(entry["path"], "rb") as f:
+                    entry["after"] = hashlib.sha256(f.read()).hexdigest()
+            except OSError:
+                entry["after"] = None
+            updates.append({"path": entry["path"], "before": entry["before"], "after": entry["after"]})
+        with self._lock:
+            self._append({"id": turn.id, "ingested": updates})
+            for entry in turn.entries:
+                if entry["pending"]:
+                    Staging.discard(entry["pending"])
+                    entry["pending"] = None
+            turn.ingested = True
+
+    def _before(self, entry: dict) -> bytes:
+        if entry["before"] is not None:
+            return self.get(entry["before"])
+        with open(entry["pending"], "rb") as f:
+            return f.read()
+
+    def _scoped(self, cwd: str | None) -> list[Turn]:
+        """
+        当前会话中还没有撤销、且与 cwd 相关 (cwd 在这一轮的工作目录之内，或反过来) 的轮次，按时间顺序
+        """
+        turns = [turn for turn in self.turns if not turn.undone and turn.session == self.session]
+        if cwd is None:
+            return turns
+        cwd = os.path.abspath(cwd)
+        return [turn for turn in turns if _related(turn.cwd, cwd)]
+
+    def undo(self, n: int = 1, staging: Staging | None = None, cwd: str | None = None) -> list[dict]:
+        """
+        撤销当前会话最近 n 轮 (未撤销的) 修改，整体在一个文件事务中完成
+
+        Args:
+            cwd: 只撤销与该目录相关的轮次
+
+        Returns:
+            每轮一项 {"turn", "restored", "removed", "changed"}，changed 为这一轮之后又被修改过的文件 (同样被恢复)
+        """
+        staging = staging or Staging()
+        with self._lock:
+            turns = self._scoped(cwd)[-n:][::-1]
+        transaction = FileTransaction()
+        reports = []
+        try:
+            for turn in turns:
+                report = {"turn": turn, "restored": [], "removed": [], "changed": []}
+                for entry in reversed(turn.entries):
+                    path = entry["path"]
+                    if entry["after"] is not None and _hash_file(path) != entry["after"]:
+                        report["changed"].append(path)
+                    if entry["kind"] == "file":
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        transaction.write(path, staging.stage(path, self._before(entry)))
+                        report["restored"].append(path)
+                    elif entry["kind"] is None and os.path.isfile(path):
+                        transaction.delete(path)
+                        report["removed"].append(path)
+                    elif entry["kind"] is None and os.path.isdir(path) and not os.listdir(path):
+                        os.rmdir(path)
+                        report["removed"].append(path)
+                reports.append(report)
+        except Exception:
+            transaction.rollback()
+            raise
+        transaction.commit()
+        with self._lock:
+            for turn in turns:
+                turn.undone = True
+                self._append({"id": turn.id, "undone": True})
+        return reports
+
+    def history(self, limit: int = 20, cwd: str | None = None) -> list[Turn]:
+        with self._lock:
+            return self._scoped(cwd)[-limit:]
+
+    def stats(self, cwd: str | None = None) -> dict:
+        count = size = 0
+        for root, _, files in os.walk(self.objects):
+            for name in files:
+                count += 1
+                size += os.path.getsize(os.path.join(root, name))
+        with self._lock:
+            turns = len(self._scoped(cwd))
+        return {"turns": turns, "objects": count, "bytes": size}
+
+    def prune(self, max_age: float) -> dict:
+        """
+        删除 (所有会话中) 早于 max_age 秒之前、或已经撤销的轮次，重写日志，
+        再删除不被剩下的轮次引用、且同样早于 max_age 的内容和 pending 中遗留的快照
+
+        Returns:
+            {"turns": 删除的轮次数, "objects": 删除的内容数, "bytes": 释放的字节数}
+        """
+        cutoff = time.time() - max_age
+        removed = {"turns": 0, "objects": 0, "bytes": 0}
+        with FileLock(self.lock_path):
+            # 以磁盘上的日志为准，其中包括其他实例记录的轮次
+            turns = self._read_log()
+            kept = [turn for turn in turns.values() if turn.time >= cutoff and not turn.undone]
+            removed["turns"] = len(turns) - len(kept)
+            if removed["turns"]:
+                temp = f"{self.log_path}.{uuid.uuid4().hex[:8]}.tmp"
+                with open(temp, "w", encoding="utf-8") as f:
+                    for turn in kept:
+                        record = turn.to_record()
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                        if turn.ingested:
+                            f.write(json.dumps({"id": turn.id, "ingested": [
+                                {key: entry.get(key) for key in ("path", "before", "after")} for entry in turn.entries
+                            ]}, ensure_ascii=False) + "\n")
+                os.replace(temp, self.log_path)
+            referenced = {entry["before"] for turn in kept for entry in turn.entries if entry.get("before")}
+            pending = {entry["pending"] for turn in kept for entry in turn.entries if entry.get("pending")}
+        with self._lock:
+            ids = {turn.id for turn in kept}
+            self.turns = [turn for turn in self.turns if turn.id in ids or turn.time >= cutoff]
+            referenced |= {entry["before"] for turn in self.turns for entry in turn.entries if entry.get("before")}
+            pending |= {entry["pending"] for turn in self.turns for entry in turn.entries if entry.get("pending")}
+        for root, _, files in os.walk(self.objects):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                    if os.path.basename(root) + name not in referenced and stat.st_mtime < cutoff:
+                        os.remove(path)
+                        removed["objects"] += 1
+                        removed["bytes"] += stat.st_size
+                except OSError:
+                    pass
+        try:
+            entries = list(os.scandir(self.pending))
+        except OSError:
+            entries = []
+        for entry in entries:
+            try:
+                if entry.path not in pending and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+        return removed
+
+    # ---- 日志 ----
+
+    def _append(self, record: dict) -> None:
+        # 其他实例可能同时追加或在 prune() 中重写日志
+        with FileLock(self.lock_path):
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _load(self) -> None:
+        self.turns = sorted(self._read_log().values(), key=lambda turn: turn.time)
+
+    def _read_log(self) -> dict[str, Turn]:
+        turns: dict[str, Turn] = {}
+        try:
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except OSError:
+            return turns
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "entries" in record:
+                turn = Turn(record["id"], record["label"], record["cwd"], record.get("session"))
+                turn.time, turn.entries = record["time"], record["entries"]
+                turns[turn.id] = turn
+            elif record.get("id") in turns:
+                turn = turns[record["id"]]
+                if record.get("undone"):
+                    turn.undone = True
+                for update in record.get("ingested", []):
+                    for entry in turn.entries:
+                        if entry["path"] == update["path"]:
+                            entry.update(update, pending=None)
+                if "ingested" in record:
+                    turn.ingested = True
+        return turns
+
+
+def _related(a: str, b: str) -> bool:
+    """
+    两个目录相同，或一个在另一个之内
+    """
+    a, b = os.path.normcase(os.path.abspath(a)), os.path.normcase(os.path.abspath(b))
+    try:
+        common = os.path.commonpath([a, b])
+    except ValueError:
+        # Windows 上不同的盘符
+        return False
+    return common in (a, b)
+
+
+def _hash_file(path: str) -> str | None:
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
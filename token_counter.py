@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Token估算
+=======================
+说明：
+    不依赖具体模型的分词器，粗略估算文本的 token 数，用于上下文节省统计和历史预算。
+    ASCII 文本大约 4 个字符一个 token，中文等非 ASCII 字符大约一个字符一个 token。
+    工作状态: Done
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if text.isascii():
+        return (len(text) + 3) // 4
+    # utf-8 下 ASCII 占 1 字节，常见的中日韩字符占 3 字节，用多出的字节数估算非 ASCII 字符数
+    non_ascii = (len(text.encode("utf-8", errors="replace")) - len(text)) // 2
+    return (len(text) - non_ascii + 3) // 4 + non_ascii